@@ -1,11 +1,15 @@
+import os
+import sys
 import pandas as pd
-import numpy as np
 
-# Read fecal shedding model
-shedding = pd.read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/FecalSheddingModel.csv', index_col=0)
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.deconvolution import load_shedding_kernel, deconvolve_frame
+from pipeline.fetch import read_csv
+from pipeline.formatting import melt_measures, write_outputs
 
-# Read prepared wastewater data
-ww = pd.read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Canada/ww_BC_Canada.csv', index_col=0)
+# Read prepared wastewater data (downloaded only if it changed since the last run)
+ww = read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Canada/ww_BC_Canada.csv', index_col=0)
 
 
 # Population served
@@ -107,30 +111,12 @@ ww['NH'] = ww['Prince George']
 
 
 # Make list of 14 first entries in gc in billions column of shedding
-shedding_list = shedding['gc in billions'].tolist()[:14]
-
-# Initialize new infections columns
-ww['VCH_new_inf_total'] = 0
-ww['FH_new_inf_total'] = 0
-ww['VIHA_new_inf_total'] = 0
-ww['IH_new_inf_total'] = 0
-ww['NH_new_inf_total'] = 0
-
-
-# Fill in the rest of the new infections columns
-for i in range(13, len(ww)):
-    ww.iloc[i,ww.columns.get_loc('VCH_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('VCH')]- ((ww.iloc[i-1,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('VCH_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('FH_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('FH')]- ((ww.iloc[i-1,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('FH_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-
-for i in range(231, len(ww)):
-    ww.iloc[i,ww.columns.get_loc('VIHA_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('VIHA')]- ((ww.iloc[i-1,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('VIHA_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-for i in range(204, len(ww)):
-    ww.iloc[i,ww.columns.get_loc('IH_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('IH')]- ((ww.iloc[i-1,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('IH_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-
-for i in range(408, len(ww)):
-    ww.iloc[i,ww.columns.get_loc('NH_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('NH')]- ((ww.iloc[i-1,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('NH_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    
-    
+shedding_list = load_shedding_kernel('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/FecalSheddingModel.csv')
+
+# Estimate the new infections of all health authorities at once, each starting once its data is available
+ww = pd.concat([ww, deconvolve_frame(ww, ['VCH', 'FH', 'VIHA', 'IH', 'NH'], shedding_list, start=[13, 13, 231, 204, 408])], axis=1)
+
+
 # Correct for whole Health Authority population
 p_covered_VCH = 0.88141
 p_covered_FH = 0.67549
@@ -172,26 +158,12 @@ df = df[['Date', 'Metro_Vancouver_3day', 'Island_Health_3day', 'Interior_Health_
 df.columns = ['Date', 'MetroVancouver_wastewater', 'IslandHealth_wastewater', 'InteriorHealth_wastewater', 'NorthernHealth_wastewater', 'MetroVancouver_inf', 'IslandHealth_inf', 'InteriorHealth_inf', 'NorthernHealth_inf']
 
 # "Melt" the data so each row is a unique date-region combination
-df_melted = df.melt(id_vars='Date', var_name='Region_and_Measure', value_name='Value')
-
-# Separate the Region_and_Measure column into separate 'Region' and 'Measure' columns
-df_melted[['Region', 'Measure']] = df_melted['Region_and_Measure'].str.split('_', expand=True, n=1)
-
-# Drop the now redundant 'Region_and_Measure' column
-df_melted = df_melted.drop(columns='Region_and_Measure')
-
-# To make data uniform across different files, add a 'Country' column
-df_melted['Country'] = 'Canada'
-
-# Reorder the columns
-df_melted = df_melted[['Country', 'Region', 'Date', 'Measure', 'Value']]
+df_melted = melt_measures(df, 'Canada')
 
 # Remove all entries after today
 import datetime
 today = pd.Timestamp(datetime.date.today())
 df_melted['Date'] = pd.to_datetime(df_melted['Date'])
 df_melted = df_melted[df_melted['Date'] <= today]
-df_melted.to_csv('Canada_cleaned.csv', index=False)
-
-# Json
-df_melted.to_json('Canada_cleaned.json', orient='records')
+# Save as csv, json, in the Parquet dataset and as dashboard shards
+write_outputs(df_melted, 'Canada')
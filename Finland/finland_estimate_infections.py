@@ -1,12 +1,17 @@
 # Purpose: To read and process the wastewater data from Finland to estimate the number of newly infected individuals
+import os
+import sys
 import pandas as pd
 import numpy as np
 
-# Read fecal shedding model
-shedding = pd.read_csv('FecalSheddingModel.csv', index_col=0)
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.deconvolution import load_shedding_kernel, deconvolve_frame
+from pipeline.fetch import read_csv
+from pipeline.formatting import concat_long, melt_measures, write_outputs
 
-# Read Finnish data
-ww_fi = pd.read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/fi_wastewater_data.csv')
+# Read Finnish data (downloaded only if it changed since the last run)
+ww_fi = read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/fi_wastewater_data.csv')
 
 # Select columns of interest
 ww = ww_fi[['Date of sample', 'Location of treatment plant', 'Normalized RNA count using the RNA standard']]
@@ -87,31 +92,11 @@ ww['Vaasa_3day'] = (ww['Vaasa_mil_gc/cap'].shift(1) + ww['Vaasa_mil_gc/cap'] + w
 
 # Estimate new infections
 # Make list of 14 first entries in gc in billions column of shedding
-shedding_list = shedding['gc in billions'].tolist()[:14]
-
-# Initialize new infections columns
-ww['Espoo_new_inf_total'] = 0
-ww['Helsinki_new_inf_total'] = 0
-ww['Joensuu_new_inf_total'] = 0
-ww['Jyväskylä_new_inf_total'] = 0
-ww['Kuopio_new_inf_total'] = 0
-ww['Oulu_new_inf_total'] = 0
-ww['Tampere_new_inf_total'] = 0
-ww['Turku_new_inf_total'] = 0
-ww['Vaasa_new_inf_total'] = 0
-
-# Fill in the rest of the new infections columns
-for i in range(15, len(ww)):
-    ww.iloc[i,ww.columns.get_loc('Espoo_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Espoo')]- ((ww.iloc[i-1,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Espoo_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-for i in range(13, len(ww)):
-    ww.iloc[i,ww.columns.get_loc('Helsinki_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Helsinki')]- ((ww.iloc[i-1,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Helsinki_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Joensuu_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Joensuu')]- ((ww.iloc[i-1,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Joensuu_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Jyväskylä_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Jyväskylä')]- ((ww.iloc[i-1,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Jyväskylä_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Kuopio_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Kuopio')]- ((ww.iloc[i-1,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Kuopio_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Oulu_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Oulu')]- ((ww.iloc[i-1,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Oulu_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Tampere_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Tampere')]- ((ww.iloc[i-1,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Tampere_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Turku_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Turku')]- ((ww.iloc[i-1,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Turku_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-    ww.iloc[i,ww.columns.get_loc('Vaasa_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc('Vaasa')]- ((ww.iloc[i-1,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc('Vaasa_new_inf_total')]*shedding_list[13])))/shedding_list[0]
+shedding_list = load_shedding_kernel('FecalSheddingModel.csv')
+
+# Estimate the new infections of all locations at once, starting Espoo two days later
+locations = ['Espoo', 'Helsinki', 'Joensuu', 'Jyväskylä', 'Kuopio', 'Oulu', 'Tampere', 'Turku', 'Vaasa']
+ww = pd.concat([ww, deconvolve_frame(ww, locations, shedding_list, start=[15, 13, 13, 13, 13, 13, 13, 13, 13])], axis=1)
 
 # Make new column with 3-day average of new infections by taking the last day, the present day and the next day
 ww['Espoo_new_inf_3day'] = (ww['Espoo_new_inf_total'].shift(1) + ww['Espoo_new_inf_total'] + ww['Espoo_new_inf_total'].shift(-1)) / 3
@@ -126,7 +111,7 @@ ww['Vaasa_new_inf_3day'] = (ww['Vaasa_new_inf_total'].shift(1) + ww['Vaasa_new_i
 
 
 # Compare our estimated cases with officially estimated cases
-estim_cases = pd.read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/FinlandEstimCasesSewersheds.csv')
+estim_cases = read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/FinlandEstimCasesSewersheds.csv')
 
 # Select columns of interest
 estim_cases = estim_cases[['Treatment plant', 'Date of reporting', 'COVID-19 cases, estimate']]
@@ -186,19 +171,7 @@ df = df[['Date', 'Espoo_3day', 'Helsinki_3day', 'Joensuu_3day',
 df.columns = ['Date', 'Espoo_wastewater', 'Helsinki_wastewater', 'Joensuu_wastewater', 'Jyväskylä_wastewater', 'Kuopio_wastewater', 'Oulu_wastewater', 'Tampere_wastewater', 'Turku_wastewater', 'Vaasa_wastewater', 'Espoo_inf', 'Helsinki_inf', 'Joensuu_inf', 'Jyväskylä_inf', 'Kuopio_inf', 'Oulu_inf', 'Tampere_inf', 'Turku_inf', 'Vaasa_inf']
 
 # "Melt" the data so each row is a unique date-region combination
-df_melted = df.melt(id_vars='Date', var_name='Region_and_Measure', value_name='Value')
-
-# Separate the Region_and_Measure column into separate 'Region' and 'Measure' columns
-df_melted[['Region', 'Measure']] = df_melted['Region_and_Measure'].str.split('_', expand=True, n=1)
-
-# Drop the now redundant 'Region_and_Measure' column
-df_melted = df_melted.drop(columns='Region_and_Measure')
-
-# To make data uniform across different files, add a 'Country' column
-df_melted['Country'] = 'Finland'
-
-# Reorder the columns
-df_melted = df_melted[['Country', 'Region', 'Date', 'Measure', 'Value']]
+df_melted = melt_measures(df, 'Finland')
 
 
 df2 = estim_cases.copy()
@@ -215,24 +188,10 @@ df2 = df2[['Date', 'Viikinmäki', 'Kuhasalo',
 df2.columns = ['Date', 'Helsinki_official', 'Joensuu_official', 'Jyväskylä_official', 'Kuopio_official', 'Oulu_official', 'Tampere_official', 'Turku_official', 'Vaasa_official']
 
 # "Melt" the data so each row is a unique date-region combination
-df2_melted = df2.melt(id_vars='Date', var_name='Region_and_Measure', value_name='Value')
-
-# Separate the Region_and_Measure column into separate 'Region' and 'Measure' columns
-df2_melted[['Region', 'Measure']] = df2_melted['Region_and_Measure'].str.split('_', expand=True, n=1)
-
-# Drop the now redundant 'Region_and_Measure' column
-df2_melted = df2_melted.drop(columns='Region_and_Measure')
-
-# To make data uniform across different files, add a 'Country' column
-df2_melted['Country'] = 'Finland'
-
-# Reorder the columns
-df2_melted = df2_melted[['Country', 'Region', 'Date', 'Measure', 'Value']]
-
+df2_melted = melt_measures(df2, 'Finland')
 
-cleaned = pd.concat([df_melted, df2_melted], axis=0)
 
-cleaned.to_csv('Finland_cleaned.csv', index=False)
+cleaned = concat_long([df_melted, df2_melted])
 
-# Json
-cleaned.to_json('Finland_cleaned.json', orient='records')
+# Save as csv, json, in the Parquet dataset and as dashboard shards
+write_outputs(cleaned, 'Finland')
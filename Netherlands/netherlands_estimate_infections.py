@@ -1,12 +1,18 @@
 # Purpose: To read and process the wastewater data from the Netherlands to estimate the number of newly infected individuals
+import os
+import sys
 import pandas as pd
-import numpy as np
 
-# Read fecal shedding model
-shedding = pd.read_csv('FecalSheddingModel.csv', index_col=0)
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.aggregation import mean_by_region, region_weights, sum_by_region, to_long
+from pipeline.deconvolution import load_shedding_kernel, deconvolve_frame
+from pipeline.fetch import read_csv
+from pipeline.formatting import concat_long, write_outputs
+from pipeline.series import SiteSeries
 
-# Read Netherlands data from Github, separating columns by ;
-ww_ne = pd.read_csv('https://data.rivm.nl/covid-19/COVID-19_rioolwaterdata.csv', sep=';')
+# Read Netherlands data from RIVM, separating columns by ; (downloaded only if it changed since the last run)
+ww_ne = read_csv('https://data.rivm.nl/covid-19/COVID-19_rioolwaterdata.csv', sep=';')
 #ww_ne = pd.read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Netherlands/nl_wastewater_data_test.csv')
 
 # Select columns of interest
@@ -19,11 +25,8 @@ ww['Date'] = pd.to_datetime(ww['Date'])
 # Using only dates after 2021-07-01 (previously 2022-01-01)
 ww = ww[ww['Date'] > '2021-07-01']
 
-# Get all unique Locations
-locations = ww['Location'].unique()
-
-# Load the population data and assume string values in columns
-pop = pd.read_csv('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Code/main/Netherlands/Netherlands_people_served_by_sewershed.csv')
+# Load the population data of this repository and assume string values in columns
+pop = pd.read_csv('Netherlands/Netherlands_people_served_by_sewershed.csv')
 
 # Rename the columns
 pop.columns = ['Code', 'Inhabitants']
@@ -36,159 +39,65 @@ ww['mil_gc_per_capita_per_day'] = ww['RNA_flow_per_100000'] / 100000000000
 ww['bil_gc_per_day'] = ww['mil_gc_per_capita_per_day'] * ww['Inhabitants']
 ww['bil_gc_per_day'] = ww['bil_gc_per_day'] / 1000
 
-# Transform dataframe such that dates are unique and every location has one column
-ww2 = ww.copy()
-ww = ww.pivot(index='Date', columns='Location', values='bil_gc_per_day')
-ww2 = ww2.pivot(index='Date', columns='Location', values='mil_gc_per_capita_per_day')
-
-# Make new column for each location with the name plus "_mil_gc/cap"
-for col in ww2.columns:
-    ww2[col + '_mil_gc/cap'] = ww2[col]
-
-# Delete the old columns
-ww2 = ww2.drop(columns=locations)
-
-# Add the new columns to the original dataframe
-ww = ww.merge(ww2, how='left', left_on='Date', right_on='Date')
+# Transform dataframe into one (dates x locations) array per measure
+series = SiteSeries.from_long(ww, 'Date', 'Location', {'bil_gc': 'bil_gc_per_day', 'mil_gc/cap': 'mil_gc_per_capita_per_day'})
 
 # Add missing dates and interpolate missing values using linear interpolation
-ww = ww.resample('D').asfreq()
-ww = ww.interpolate(method='linear', axis = 0)
+series = series.daily()
 
-# Make new columns with 7 day rolling average for each location
-#for loc in locations:
-#    ww[loc + '_7day_avg'] = ww[loc + '_mil_gc/cap'].rolling(window = 7,min_periods=1).mean()
-
-# Make new columns with 3-day average by taking the last day, the present day and the next day
-for loc in locations:
-    ww[loc + '_3day_avg'] = (ww[loc + '_mil_gc/cap'].shift(1) + ww[loc + '_mil_gc/cap'] + ww[loc + '_mil_gc/cap'].shift(-1)) / 3
+# Make new measure with 3-day average by taking the last day, the present day and the next day
+series['3day_avg'] = series.centered_mean('mil_gc/cap')
 
 
 # Estimate new infections
 # Make list of 14 first entries in gc in billions column of shedding
-shedding_list = shedding['gc in billions'].tolist()[:14]
-
-# Initialize new infections columns
-for loc in locations:
-    ww[loc + '_new_inf_total'] = 0
-
-
-# Fill in the rest of the new infections columns
-for loc in locations:
-    for i in range(13, len(ww)):
-        ww.iloc[i,ww.columns.get_loc(loc + '_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc(loc)]- ((ww.iloc[i-1,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[13])))/shedding_list[0]
+shedding_list = load_shedding_kernel('FecalSheddingModel.csv')
 
-# Make new column with 3-day average of new infections by taking the last day, the present day and the next day
-for loc in locations:
-    ww[loc + '_new_inf_3day'] = (ww[loc + '_new_inf_total'].shift(1) + ww[loc + '_new_inf_total'] + ww[loc + '_new_inf_total'].shift(-1)) / 3
+# Estimate the new infections of all locations at once
+series['new_inf_total'] = deconvolve_frame(series.frame('bil_gc'), series.sites, shedding_list).to_numpy()
 
-# Restructure for Tableau
-df_new = ww.copy()
+# Make new measure with 3-day average of new infections by taking the last day, the present day and the next day
+series['new_inf_3day'] = series.centered_mean('new_inf_total')
 
 # Delete last row to avoid null entries
-df_new = df_new[:-1]
-
-# Get new index
-df_new = df_new.reset_index()
-
-# Select the columns we need, that is Date, all ending in '_7day' and all ending in '_new_inf_3day'
-df = df_new[['Date']]
-for col in df_new.columns:
-    if col.endswith('_3day_avg') or col.endswith('_new_inf_3day'):
-        df[col] = df_new[col]
-
-# Rename the columns by sustituting '_3day_avg' with '_wastewater' and '_new_inf_3day' with '_inf'
-df.columns = df.columns.str.replace('_3day_avg', '_wastewater')
-df.columns = df.columns.str.replace('_new_inf_3day', '_inf')
-
-# "Melt" the data so each row is a unique date-region combination
-df_melted = df.melt(id_vars='Date', var_name='Region_and_Measure', value_name='Value')
-
-# Separate the Region_and_Measure column into separate 'Region' and 'Measure' columns
-df_melted[['Region', 'Measure']] = df_melted['Region_and_Measure'].str.split('_', expand=True, n=1)
-
-# Drop the now redundant 'Region_and_Measure' column
-df_melted = df_melted.drop(columns='Region_and_Measure')
-
-# To make data uniform across different files, add a 'Country' column
-df_melted['Country'] = 'Netherlands'
-
-# Reorder the columns
-df_melted = df_melted[['Country', 'Region', 'Date', 'Measure', 'Value']]
+series = series.take(slice(None, -1))
 
 # Change any negative values to 0
-df_melted['Value'] = df_melted['Value'].clip(lower=0)
+for measure in ('3day_avg', 'new_inf_3day'):
+    series[measure] = series[measure].clip(min=0)
+
+# Long format rows of every location, with '3day_avg' as 'wastewater' and 'new_inf_3day' as 'inf'
+df_melted = series.to_long('Netherlands', {'3day_avg': 'wastewater', 'new_inf_3day': 'inf'})
 
 # Load the sewershed fraction data
 sewershed_data = pd.read_csv("Sewershed area fraction covered by province.csv")
 
-# Filter the first dataframe to only include rows where "Measure" is "inf"
-infection_data = df_melted[df_melted["Measure"] == "inf"]
-
-# Join the two dataframes on the "Region" column from the first dataframe and the "rwzi_name" column from the second dataframe
-combined_data = infection_data.merge(sewershed_data, left_on="Region", right_on="rwzi_name", how="inner")
-
-# Group by "Date" and "province" and calculate the sum of "Value" multiplied by "fraction" for each group
-grouped_data = combined_data.groupby(["Date", "province"]).apply(lambda df: (df["Value"] * df["fraction"]).sum()).reset_index()
-
-# Rename the columns to match the original dataframe
-grouped_data.columns = ["Date", "Region", "Value"]
-
-# Add the "Country" and "Measure" columns
-grouped_data["Country"] = "Netherlands"
-grouped_data["Measure"] = "inf"
-
-# Reorder the columns to match the original dataframe
-grouped_data = grouped_data[["Country", "Region", "Date", "Measure", "Value"]]
-
 # Calculate the population served by the sewershed in each province
 sewershed_data["pop_served"] = sewershed_data["population"] * sewershed_data["fraction"]
 
-# Filter the first dataframe to only include rows where "Measure" is "wastewater"
-wastewater_data = df_melted[df_melted["Measure"] == "wastewater"]
-
-# Join the two dataframes on the "Region" column from the first dataframe and the "rwzi_name" column from the second dataframe
-combined_data2 = wastewater_data.merge(sewershed_data, left_on="Region", right_on="rwzi_name", how="inner")
+# Infections and wastewater of every sewershed as (dates x sewersheds) arrays
+infection_data = series['new_inf_3day']
+wastewater_data = series['3day_avg']
+dates = series.dates
+sites = series.sites
 
-# For each date and province, calculate the sum of wastewater values weighted by the sewershed's population serving the province
-grouped_waste = combined_data2.groupby(["Date", "province"]).apply(lambda df: (df["Value"] * df["pop_served"]).sum()).reset_index()
+# Sparse sewershed -> province matrices weighted by the fraction of the sewershed in the province and by
+# the population it serves there; every province is also rolled up into the national total
+parents = {province: 'Netherlands' for province in sewershed_data['province'].unique()}
+fractions, regions = region_weights(sites, sewershed_data, 'rwzi_name', 'province', 'fraction', parents=parents)
+populations, _ = region_weights(sites, sewershed_data, 'rwzi_name', 'province', 'pop_served', parents=parents)
 
-# Add a column of 0s and 1s to combined_data2 to indicate whether the value is >0 or not
-combined_data2["Value>0"] = np.where(combined_data2["Value"] > 0, 1, 0)
-
-# For each date and province, calculate the sum of populations served by the sewersheds
-grouped_pop = combined_data2.groupby(["Date", "province"]).apply(lambda df: (df["pop_served"] * df["Value>0"]).sum()).reset_index()
-#grouped_pop = combined_data2.groupby(["Date", "province"])["pop_served"].sum().reset_index()
-
-# Join the two grouped dataframes on "Date" and "province"
-grouped_data2 = grouped_waste.merge(grouped_pop, on=["Date", "province"], how="inner")
-
-# Divide the total wastewater value by the total population for each province to get the per capita wastewater value
-grouped_data2["Value"] = grouped_data2["0_x"] / grouped_data2["0_y"]
-#grouped_data2["Value"] = grouped_data2[0] / grouped_data2["pop_served"]
-
-# Drop the unnecessary columns
-grouped_data2 = grouped_data2.drop(columns=["0_x", "0_y"])
-#grouped_data2 = grouped_data2.drop(columns=[0, "pop_served"])
-
-# Rename the columns to match the original dataframe
-grouped_data2.columns = ["Date", "Region", "Value"]
-
-# Add the "Country" and "Measure" columns
-grouped_data2["Country"] = "Netherlands"
-grouped_data2["Measure"] = "wastewater"
-
-# Reorder the columns to match the original dataframe
-grouped_data2 = grouped_data2[["Country", "Region", "Date", "Measure", "Value"]]
+# Sum the infections of each province, and average the wastewater values weighted by the population
+# of the sewersheds that report a value on each date
+infections = sum_by_region(infection_data, fractions)
+wastewater, _ = mean_by_region(wastewater_data, populations)
 
 # Append the new dataframe to the inf dataframe
-grouped_data3 = pd.concat([grouped_data, grouped_data2], ignore_index=True)
+grouped_data3 = concat_long([to_long(infections, dates, regions, 'Netherlands', 'inf'),
+                             to_long(wastewater, dates, regions, 'Netherlands', 'wastewater')])
 
 # Append the new dataframe to the original dataframe
-updated_netherlands_data = pd.concat([grouped_data3, df_melted], ignore_index=True)
-
-# CSV
-updated_netherlands_data.to_csv('Netherlands_cleaned.csv', index=False)
+updated_netherlands_data = concat_long([grouped_data3, df_melted])
 
-# Json
-updated_netherlands_data.to_json('Netherlands_cleaned.json', orient='records')
+# Save as csv, json, in the Parquet dataset and as dashboard shards
+write_outputs(updated_netherlands_data, 'Netherlands')
@@ -1,9 +1,38 @@
+import argparse
+import os
+import sys
 from scipy.io import loadmat
-from scipy.integrate import solve_ivp
 import numpy as np
-from scipy.integrate import odeint
 from scipy.optimize import basinhopping
-import time
+
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.seirv import METHODS, PARAM_BOUNDS, multi_start_fit, simulate_seirv_model, sse_obj_func
+from pipeline.seirv_posterior import error_variance, predictive_quantiles, sample_posterior
+from pipeline.seirv_rolling import rolling_fit
+
+parser = argparse.ArgumentParser(description='Fit the SEIRV model to the wastewater data of the DITP plant.')
+parser.add_argument('--mode', choices=['multistart', 'basinhopping', 'mcmc', 'rolling'], default='multistart',
+                    help='Parallel seeded multi-start search, the original single basinhopping chain, '
+                         'the multi-start search followed by posterior sampling, '
+                         'or the multi-start search followed by warm-started refits over later windows')
+parser.add_argument('--starts', type=int, default=256, help='Maximum number of starts of the multi-start search')
+parser.add_argument('--processes', type=int, default=None,
+                    help='Worker processes for the starts of the fit (default: number of CPUs)')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the multi-start search')
+parser.add_argument('--screen', type=int, default=1,
+                    help='Start every uniform search from the best of this many draws, simulated together in one batch')
+parser.add_argument('--walkers', type=int, default=32, help='Walkers of the posterior sampler')
+parser.add_argument('--steps', type=int, default=2000, help='Steps of the posterior sampler')
+parser.add_argument('--thin', type=int, default=10, help='Save the walkers every this many steps')
+parser.add_argument('--chain', default='seirv_chain.csv', help='CSV file of the saved chain; an existing chain is resumed')
+parser.add_argument('--window-step', type=int, default=7, help='Days between the ends of the refitted windows')
+parser.add_argument('--expanding', action='store_true', help='Refit on windows from day 1 instead of sliding windows')
+parser.add_argument('--windows-output', default='seirv_windows.csv', help='CSV file of the parameters of every window')
+parser.add_argument('--solver', choices=METHODS, default='odeint', help='ODE solver of the simulations')
+parser.add_argument('--time-varying', action='store_true',
+                    help='Decay of the virus in the sewer follows the temperature of every day (getDecay) instead of day 1')
+args = parser.parse_args()
 
 # Load the MATLAB files
 data_SEIRV_fit = loadmat('data_SEIRV_fit.mat')
@@ -13,144 +42,102 @@ CRNA2 = data_SEIRV_fit['cRNA2'].flatten()
 F2 = data_SEIRV_fit['F2'].flatten()
 
 # Calculate V
-V = CRNA2 * F2
+V_all = CRNA2 * F2
 
 # Split 1 week after first day of vaccine (12/11/2020)
 split = 78
-V = V[:split]
+V = V_all[:split]
 
 # Define the time span
 tspan = np.arange(1, len(V) + 1)
 
-# Define constants from the MATLAB code
-tau0 = 189.6
-Q0 = 2.5
-T0 = 20
-A = 3.624836409841919
-B = 0.020222716119084
-C = 4.466530666828714
-D = 16.229757918464635
-
-def getDecay(t):
-    # Compute temperature-adjusted decay rate of viral RNA
-    T = A * np.sin(B * t - C) + D
-    tau = tau0 * Q0 ** (-(T - T0) / 10)
-    k = np.log(2) / tau
-    return k
-
-def SEIRV(t, y, param):
-    # Parameters to be fit
-    lambda_, alpha, beta, _ = param
-
-    # Other parameters
-    traveltime = 18  # hours
-    k = getDecay(t)
-    eta = 1 - np.exp(-k * traveltime)
-    sigma = 1 / 3
-    gamma = 1 / 8
-
-    # Variables
-    S, E, I, R, V, E_cumulative = y
-
-    # Compute derivatives
-    dS = -lambda_ * S * I
-    dE = lambda_ * S * I - sigma * E
-    dI = sigma * E - gamma * I
-    dR = gamma * I
-    dV = alpha * beta * (1 - eta) * I
-    dE_cumulative = lambda_ * S * I
-
-    return [dS, dE, dI, dR, dV, dE_cumulative]
-
-
-
 # Parameters to be fitted
 # lambda: transmission rate per day per person
 # alpha: fecal load in gram
 # beta: viral shedding in stool in viral RNA copies per gram
 # E0: initial exposed population
 
-# Constants
+# Constants (see pipeline/seirv.py)
 # sigma: rate of movement from E to I (inverse of duration of incubation period)
 # gamma: rate of movement from I to R (inverse of duration of infectiousness)
 # N0: total population served by DITP
 # eta: fraction of viruses that survive the travel time to the wastewater treatment plant
 # V0: initial virus concentration in wastewater
 
-sigma = 1 / 3
-gamma = 1 / 8
 N0 = 2300000
-eta = 1 - np.exp(-getDecay(1) * 18)  # traveltime = 18 hours
-
-def seirv_model(y, t, lambda_, alpha, beta, E0):
-    S, E, I, R, V, E_cumulative = y
-    dS = -lambda_ * S * I
-    dE = lambda_ * S * I - sigma * E
-    dI = sigma * E - gamma * I
-    dR = gamma * I
-    dV = alpha * beta * (1 - eta) * I
-    dE_cumulative = lambda_ * S * I
-    return [dS, dE, dI, dR, dV, dE_cumulative]
-
-def simulate_seirv_model(param, tspan, V0):
-    lambda_, alpha, beta, E0 = param
-    I0 = V0 / (alpha * beta * (1 - eta))
-    R0 = 0
-    S0 = N0 - (E0 + I0 + R0)
-    ICs = [S0, E0, I0, R0, V0, E0]
-    sol = odeint(seirv_model, ICs, tspan, args=(lambda_, alpha, beta, E0))
-    return sol
-
-def sse_obj_func(param, tspan, data):
-    sol = simulate_seirv_model(param, tspan, data[0])
-    cumVirus = sol[:, 4]
-    dailyVirus = np.diff(cumVirus)
-    temp = np.log10(data[1:]) - np.log10(np.abs(dailyVirus))
-    adiff = temp[~np.isnan(temp)]
-    return np.sum(adiff ** 2)
 
 # Define the bounds of the parameters
-param_bounds = [(0, 1E-4), (51, 796), (4.48526e7, 4.48526e7), (10, 5000)]
-
-# The objective function is the same (sse_obj_func), but we need to flatten it to 1D for basinhopping
-flat_sse_obj_func = lambda x: sse_obj_func(x, tspan=tspan, data=V)
-
-# Initialize a random starting point
-#np.random.seed(0)
-#print(time.time())
-init_guess = np.random.uniform(low=[b[0] for b in param_bounds], high=[b[1] for b in param_bounds]) #solution from paper: [9.06e-08, 360, 4.48526e7, 1182]
-
-# Define a function to check if a point is within bounds
-def in_bounds(x, bounds):
-    return np.all([low <= xi <= high for xi, (low, high) in zip(x, bounds)])
-
-# Define a function for generating a new random point within bounds
-def random_within_bounds(x, bounds):
-    return np.array([np.random.uniform(low, high) for (low, high) in bounds])
-
-# Define the function for generating a new trial step
-def new_trial_step(x):
-    return random_within_bounds(x, param_bounds)
-
-# Define the function for accepting or rejecting the new trial step
-def accept_trial(f_new, x_new, f_old, x_old):
-    return in_bounds(x_new, param_bounds)
-
+param_bounds = PARAM_BOUNDS
+
+if args.mode in ('multistart', 'mcmc', 'rolling'):
+    # Independent seeded L-BFGS-B searches on all cores, sharing the best solution between rounds
+    res = multi_start_fit(tspan, V, N0, param_bounds, max_starts=args.starts, processes=args.processes, seed=args.seed,
+                          screen=args.screen, method=args.solver, time_varying=args.time_varying)
+
+    # Distribution of the optima found by the starts
+    print(f'{res.nstarts} starts, best objective {res.fun:.6g} at {res.x}')
+    print('Objective quantiles (0, 10, 50, 90, 100%):', np.quantile(res.optima_fun, [0, 0.1, 0.5, 0.9, 1]))
+    print('Share of starts within 1% of the best:', np.mean(res.optima_fun <= res.fun * 1.01))
+else:
+    # Initialize a random starting point
+    init_guess = np.random.uniform(low=[b[0] for b in param_bounds], high=[b[1] for b in param_bounds]) #solution from paper: [9.06e-08, 360, 4.48526e7, 1182]
+
+    # Define a function to check if a point is within bounds
+    def in_bounds(x, bounds):
+        return np.all([low <= xi <= high for xi, (low, high) in zip(x, bounds)])
+
+    # Define a function for generating a new random point within bounds
+    def random_within_bounds(x, bounds):
+        return np.array([np.random.uniform(low, high) for (low, high) in bounds])
+
+    # Define the function for generating a new trial step
+    def new_trial_step(x):
+        return random_within_bounds(x, param_bounds)
+
+    # Define the function for accepting or rejecting the new trial step
+    def accept_trial(f_new, x_new, f_old, x_old):
+        return in_bounds(x_new, param_bounds)
+
+    # Run basinhopping optimization
+    res = basinhopping(sse_obj_func, init_guess, niter=25, T=1.0, stepsize=0.5,
+                       minimizer_kwargs={'method': 'L-BFGS-B', 'bounds': param_bounds, 'args': (tspan, V, N0, args.solver, args.time_varying)},
+                       take_step=new_trial_step, accept_test=accept_trial, seed=0)
 
+# Print the results
+print(res.x, res.fun)
 
-# Run basinhopping optimization
-res = basinhopping(sse_obj_func, init_guess, niter=25, T=1.0, stepsize=0.5,
-                   minimizer_kwargs={'method': 'L-BFGS-B', 'bounds': param_bounds, 'args': (tspan, V)},
-                   take_step=new_trial_step, accept_test=accept_trial, seed=0)
+if args.mode == 'mcmc':
+    # Posterior around the point estimate, with the error variance of its residuals
+    chain = sample_posterior(tspan, V, N0, res.x, error_variance(res.fun, V, param_bounds), param_bounds,
+                             walkers=args.walkers, steps=args.steps, thin=args.thin, chain_path=args.chain,
+                             processes=args.processes, seed=args.seed, time_varying=args.time_varying)
+    second_half = chain[chain['step'] >= chain['step'].max() / 2]
+    print('Posterior quantiles (2.5, 50, 97.5%) of the second half of the chain:')
+    print(second_half[['lambda_', 'alpha', 'beta', 'E0']].quantile([0.025, 0.5, 0.975]))
 
-# Print the results
-res.x, res.fun
+if args.mode == 'rolling':
+    # Windows of `split` days over the whole series, the first of them being the window fitted above
+    windows_fit = rolling_fit(V_all, N0, split, args.window_step, args.expanding, param_bounds, first_fit=res,
+                              method=args.solver, time_varying=args.time_varying)
+    windows_fit.to_csv(args.windows_output, index=False)
+    print(windows_fit.to_string(index=False))
 
 
 
 # PLOTTING
 import matplotlib.pyplot as plt
 
+# Plot the transmission rate and effective reproduction number of every window against its last day
+if args.mode == 'rolling':
+    fig, (ax_lambda, ax_r) = plt.subplots(2, 1, sharex=True, figsize=(12, 6))
+    ax_lambda.plot(windows_fit['last_day'], windows_fit['lambda_'], '.-', color='green')
+    ax_lambda.set_ylabel('lambda (per day per person)')
+    ax_r.plot(windows_fit['last_day'], windows_fit['R_t'], '.-', color='green')
+    ax_r.axhline(1, color='black', linewidth=0.5)
+    ax_r.set_ylabel('R_t at window start')
+    ax_r.set_xlabel('Last day of the window')
+    fig.suptitle('Parameters of the refitted windows')
+
 
 # Load newRepCases2 from MATLAB file
 newRepCases2 = data_SEIRV_fit['newRepCases2'].flatten()
@@ -159,7 +146,7 @@ newRepCases2 = data_SEIRV_fit['newRepCases2'].flatten()
 tspan_pred = np.arange(1, len(V) + 1 + 30)  # extend for 30 days
 
 # Simulate the SEIRV model with the optimized parameters
-sol_opt = simulate_seirv_model(res.x, tspan_pred, V[0])
+sol_opt = simulate_seirv_model(res.x, tspan_pred, V[0], N0, args.solver, args.time_varying)
 
 # Plot the estimated daily incidence and the observed daily incidence
 plt.figure(figsize=(12, 6))
@@ -170,6 +157,14 @@ plt.plot(tspan_pred, np.log10(newRepCases2[:split+30]), '.', markersize=10, colo
 # Plot the estimated daily incidence using the optimized parameters
 plt.plot(tspan_pred[:-1], np.log10(np.diff(sol_opt[:, 5])), '-', color='green', label='Estimated daily incidence (optimized)')
 
+# Plot the 50% and 95% posterior predictive bands of the daily incidence
+if args.mode == 'mcmc':
+    bands = predictive_quantiles(chain, tspan_pred, V[0], N0, time_varying=args.time_varying)
+    plt.fill_between(bands.index, np.log10(bands[0.025]), np.log10(bands[0.975]), color='green', alpha=0.15,
+                     label='95% posterior interval')
+    plt.fill_between(bands.index, np.log10(bands[0.25]), np.log10(bands[0.75]), color='green', alpha=0.3,
+                     label='50% posterior interval')
+
 plt.xlabel('Days')
 plt.ylabel('Log10 daily incidence')
 plt.legend()
@@ -0,0 +1,96 @@
+# Purpose: To estimate the newly infected individuals in the US counties of the Biobot data, by state and census region
+import os
+import sys
+import pandas as pd
+import numpy as np
+
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.aggregation import mean_by_region, region_weights, sum_by_region, to_long
+from pipeline.deconvolution import load_shedding_kernel, deconvolve_frame
+from pipeline.formatting import concat_long, write_outputs
+from pipeline.series import SiteSeries
+
+# Wastewater flow per person and day in mL (about 100 US gallons), to turn the concentrations into gene copies per person
+flow_per_capita = 378541
+
+# Read the weekly county concentrations saved by wwUSbiobot_c.py (copies/mL)
+ww = pd.read_csv('US_Biobot_counties.csv', parse_dates=['date'],
+                 usecols=['census_region', 'county_fips', 'date', 'state_abbr', 'eff_conc_sarscov2_weekly'])
+ww.columns = ['census_region', 'county_fips', 'Date', 'conc', 'state_abbr']
+
+# Convert negative values to 0
+ww['conc'] = ww['conc'].clip(lower=0)
+
+# Bring values to billion gene copies per day for every 100,000 people of the county
+ww['bil_gc_per_100k'] = ww['conc'] * flow_per_capita * 100000 / 1e9
+
+# Transform dataframe into one (dates x counties) array per measure
+series = SiteSeries.from_long(ww, 'Date', 'county_fips', {'conc': 'conc', 'bil_gc': 'bil_gc_per_100k'})
+
+# First and last sample of every county
+observed = ~np.isnan(series['conc'])
+first_sample = series.dates[observed.argmax(axis=0)].to_numpy()
+last_sample = series.dates[len(series.dates) - 1 - observed[::-1].argmax(axis=0)].to_numpy()
+
+# Add the days between the weekly samples and interpolate them linearly
+series = series.daily()
+
+# Days before the first or after the last sample of a county (which the interpolation fills with its last sample)
+outside = (series.dates.to_numpy()[:, None] < first_sample) | (series.dates.to_numpy()[:, None] > last_sample)
+
+# Make new measure with 3-day average by taking the last day, the present day and the next day
+series['3day_avg'] = series.centered_mean('conc')
+
+
+# Estimate new infections
+# Make list of 14 first entries in gc in billions column of shedding
+shedding_list = load_shedding_kernel('FecalSheddingModel.csv')
+
+# Fill all empty cells with 0
+series.fillna(0)
+
+# Estimate the new infections per 100,000 people of all counties at once
+series['new_inf_total'] = deconvolve_frame(series.frame('bil_gc'), series.sites, shedding_list).to_numpy()
+
+# Make new measure with 3-day average of new infections by taking the last day, the present day and the next day
+series['new_inf_3day'] = series.centered_mean('new_inf_total')
+
+# Delete last row to avoid null entries
+series = series.take(slice(None, -1))
+outside = outside[:-1]
+
+# No values for a county outside the period it reported
+series['3day_avg'][outside] = np.nan
+series['new_inf_3day'][outside] = np.nan
+
+# Keep the daily concentrations and infections of every county for further analysis
+series.save('.cache/us_biobot_counties.npz', ['3day_avg', 'new_inf_3day'])
+
+
+# Every county is in one state, every state in one census region, and every census region in the nation
+counties = ww[['county_fips', 'state_abbr', 'census_region']].drop_duplicates('county_fips')
+parents = dict(zip(counties['state_abbr'], counties['census_region']))
+parents.update({region: 'United States' for region in counties['census_region'].unique()})
+
+# Sparse county -> state, census region and nation matrix, counting each county once
+weights, regions = region_weights(series.sites, counties, 'county_fips', 'state_abbr', parents=parents)
+
+# Average the infections per 100,000 people and the concentrations of the counties that have a value on each
+# date (the population of the counties is not in the data), changing any negative values to 0. A county whose
+# estimate is 0 on a date still counts in the average. Like the NWSS sewersheds, the counties themselves are
+# only kept in the .npz file, not in the outputs.
+infections, _ = mean_by_region(series['new_inf_3day'].clip(min=0), weights, mask=~np.isnan(series['new_inf_3day']))
+wastewater, _ = mean_by_region(series['3day_avg'].clip(min=0), weights, mask=~np.isnan(series['3day_avg']))
+
+# Number of counties reporting on each date: those between their first and last sample
+counties_reporting = sum_by_region(~outside, weights)
+
+# Append the dataframes for inf, wastewater and the number of reporting counties
+dates = series.dates
+us_counties_data = concat_long([to_long(infections, dates, regions, 'United_States_counties', 'inf_per_100k'),
+                                to_long(wastewater, dates, regions, 'United_States_counties', 'wastewater'),
+                                to_long(counties_reporting, dates, regions, 'United_States_counties', 'counties')])
+
+# Save as csv, json, in the Parquet dataset and as dashboard shards
+write_outputs(us_counties_data, 'United_States_counties')
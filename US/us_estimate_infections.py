@@ -1,69 +1,46 @@
 # Purpose: To read and process the wastewater data from the US to estimate the number of newly infected individuals
+import os
+import sys
 import pandas as pd
 import numpy as np
-import pandas as pd
-from sodapy import Socrata
 
-# Read fecal shedding model
-shedding = pd.read_csv('FecalSheddingModel.csv', index_col=0)
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.aggregation import mean_by_region, region_weights, sum_by_region, to_long
+from pipeline.deconvolution import load_shedding_kernel
+from pipeline.incremental import deconvolve_frame_incremental
+from pipeline.socrata import read_dataset, sync_dataset
+from pipeline.formatting import concat_long, write_outputs
+from pipeline.series import SiteSeries
 
 # Get US data
-
-client = Socrata("data.cdc.gov", None)
-results_data = client.get("g653-rqe2", limit=200000000)
-
-# Convert to pandas DataFrame
-ww_us = pd.DataFrame.from_records(results_data)
-#ww_us = pd.read_csv('NWSS_Public_SARS-CoV-2_Concentration_in_Wastewater_Data.csv')
-
-# Get all rows for which "normalization" column has the value "flow-population"
-ww_us = ww_us[ww_us['normalization'] == 'flow-population']
-
-# Select columns of interest
-ww = ww_us.copy()
-ww = ww[['date', 'key_plot_id', 'pcr_conc_smoothed']]
+# Download the rows added since the last run into the local cache
+sync_dataset("g653-rqe2")
+sync_dataset("2ew6-ywp6")
+
+# Read only the flow-population normalized concentrations after 2021-06-01, with locations as categoricals
+ww = read_dataset("g653-rqe2", columns=['date', 'key_plot_id', 'pcr_conc_smoothed'],
+                  filters=[('normalization', '==', 'flow-population'), ('date', '>', pd.Timestamp('2021-06-01'))])
+#ww = pd.read_csv('NWSS_Public_SARS-CoV-2_Concentration_in_Wastewater_Data.csv')
 ww.columns = ['Date', 'key_plot_id', 'gc/capita/day']
 
-# Convert date to datetime
-ww['Date'] = pd.to_datetime(ww['Date'])
-
-# Using only dates after 2021-06-01
-ww = ww[ww['Date'] > '2021-06-01']
-
 # Sort dates from oldest to newest for each location
 ww = ww.sort_values(by=['key_plot_id', 'Date'])
 
-# Get all unique Locations
-locations = ww['key_plot_id'].unique()
-
-# Load the population data
-results_pop = client.get("2ew6-ywp6", limit=200000000)
-
-# Convert to pandas DataFrame
-pop = pd.DataFrame.from_records(results_pop)
+# Load the population data after 2021-06-01
+pop = read_dataset("2ew6-ywp6", columns=['key_plot_id', 'population_served', 'date_end'],
+                   filters=[('date_end', '>', pd.Timestamp('2021-06-01'))])
 #pop = pd.read_csv('NWSS_Public_SARS-CoV-2_Wastewater_Metric_Data.csv')
 
-# Select only the columns of interest
-pop = pop[['key_plot_id', 'population_served', 'date_end']]
-
 # Rename the columns
 pop.columns = ['key_plot_id', 'Inhabitants', 'Date']
 
-# Convert date to datetime
-pop['Date'] = pd.to_datetime(pop['Date'])
-
-# Using only dates after 2021-06-01
-pop = pop[pop['Date'] > '2021-06-01']
-
 # Remove duplicates
 pop = pop.drop_duplicates()
 
 # Add the population data to the wastewater data in an "inhabitants" column
 ww = ww.merge(pop, how='left', on=['key_plot_id', 'Date'])
-
-# Make sure that the values are numeric
-ww['gc/capita/day'] = pd.to_numeric(ww['gc/capita/day'], errors='coerce')
-ww['Inhabitants'] = pd.to_numeric(ww['Inhabitants'], errors='coerce')
+del pop
 
 # Convert negative values to 0
 ww['gc/capita/day'] = ww['gc/capita/day'].clip(lower=0)
@@ -73,235 +50,48 @@ ww['mil_gc_per_capita_per_day'] = ww['gc/capita/day'] / 1000000
 ww['bil_gc_per_day'] = ww['mil_gc_per_capita_per_day'] * ww['Inhabitants']
 ww['bil_gc_per_day'] = ww['bil_gc_per_day'] / 1000
 
-# Transform dataframe such that dates are unique and every location has one column
-ww2 = ww.copy()
-ww = ww.pivot(index='Date', columns='key_plot_id', values='bil_gc_per_day')
-ww2 = ww2.pivot(index='Date', columns='key_plot_id', values='mil_gc_per_capita_per_day')
-
-# Make new column for each location with the name plus "_mil_gc/cap"
-for col in ww2.columns:
-    ww2[col + '_mil_gc/cap'] = ww2[col]
+# Transform dataframe into one (dates x locations) array per measure
+series = SiteSeries.from_long(ww, 'Date', 'key_plot_id', {'bil_gc': 'bil_gc_per_day', 'mil_gc/cap': 'mil_gc_per_capita_per_day',
+                                                          'population': 'Inhabitants'})
+del ww
 
-# Delete the old columns
-ww2 = ww2.drop(columns=locations)
-
-# Add the new columns to the original dataframe
-ww = ww.merge(ww2, how='left', left_on='Date', right_on='Date')
+# Days with a sample of every sewershed
+sample_dates, sampled = series.dates, ~np.isnan(series['bil_gc'])
 
 # Add missing dates and interpolate missing values using linear interpolation
-ww = ww.resample('D').asfreq()
-ww = ww.interpolate(method='linear', axis = 0)
+series = series.daily()
+
+# 1 on the days with a sample, 0 on the days interpolated between them
+series['sampled'] = np.zeros((len(series.dates), len(series.sites)))
+series['sampled'][series.dates.get_indexer(sample_dates)] = sampled
 
-# Make new columns with 7 day rolling average for each location
-#for loc in locations:
-#    ww[loc + '_7day_avg'] = ww[loc + '_mil_gc/cap'].rolling(window = 7,min_periods=1).mean()
+# Keep the daily gene copies and population served of every sewershed for the SEIRV fits (pipeline/seirv_fleet.py),
+# which only fit the days with a sample
+series.save('.cache/us_sites.npz', ['bil_gc', 'population', 'sampled'])
 
-# Make new columns with 3-day average by taking the last day, the present day and the next day
-for loc in locations:
-    ww[loc + '_3day_avg'] = (ww[loc + '_mil_gc/cap'].shift(1) + ww[loc + '_mil_gc/cap'] + ww[loc + '_mil_gc/cap'].shift(-1)) / 3
+# Make new measure with 3-day average by taking the last day, the present day and the next day
+series['3day_avg'] = series.centered_mean('mil_gc/cap')
 
 
 # Estimate new infections
 # Make list of 14 first entries in gc in billions column of shedding
-shedding_list = shedding['gc in billions'].tolist()[:14]
-
-
-# Initialize new infections columns
-for loc in locations:
-    ww[loc + '_new_inf_total'] = [0] * len(ww)
+shedding_list = load_shedding_kernel('FecalSheddingModel.csv')
 
 # Fill all empty cells with 0
-ww=ww.fillna(0)
+series.fillna(0)
 
-# Fill in the rest of the new infections columns
-for loc in locations:
-    for i in range(13, len(ww)):
-        ww.iloc[i,ww.columns.get_loc(loc + '_new_inf_total')] = (ww.iloc[i,ww.columns.get_loc(loc)]- ((ww.iloc[i-1,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[1])+(ww.iloc[i-2,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[2])+(ww.iloc[i-3,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[3])+(ww.iloc[i-4,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[4])+(ww.iloc[i-5,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[5])+(ww.iloc[i-6,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[6])+(ww.iloc[i-7,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[7])+(ww.iloc[i-8,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[8])+(ww.iloc[i-9,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[9])+(ww.iloc[i-10,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[10])+(ww.iloc[i-11,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[11])+(ww.iloc[i-12,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[12])+(ww.iloc[i-13,ww.columns.get_loc(loc + '_new_inf_total')]*shedding_list[13])))/shedding_list[0]
-#print(ww.tail())
-# Make new column with 3-day average of new infections by taking the last day, the present day and the next day
-for loc in locations:
-    ww[loc + '_new_inf_3day'] = (ww[loc + '_new_inf_total'].shift(1) + ww[loc + '_new_inf_total'] + ww[loc + '_new_inf_total'].shift(-1)) / 3
+# Estimate the new infections of all locations at once, resuming from the previous run's state
+series['new_inf_total'] = deconvolve_frame_incremental(series.frame('bil_gc'), series.sites, shedding_list, '.cache/us_deconvolution_state.npz').to_numpy()
 
-# Restructure for Tableau
-df_new = ww.copy()
+# Make new measure with 3-day average of new infections by taking the last day, the present day and the next day
+series['new_inf_3day'] = series.centered_mean('new_inf_total')
 
 # Delete last row to avoid null entries
-df_new = df_new[:-1]
-
-# Get new index
-df_new = df_new.reset_index()
-
-# Select the columns we need, that is Date, all ending in '_3day_avg' and all ending in '_new_inf_3day'
-df = df_new[['Date']]
-for col in df_new.columns:
-    if col.endswith('_3day_avg') or col.endswith('_new_inf_3day'):
-        df[col] = df_new[col]
-
-
-# Rename the columns by sustituting '_3day_avg' with '_wastewater' and '_new_inf_3day' with '_inf'
-df.columns = df.columns.str.replace('_3day_avg', '-wastewater')
-df.columns = df.columns.str.replace('_new_inf_3day', '-inf')
-
-# "Melt" the data so each row is a unique date-region combination
-df_melted = df.melt(id_vars='Date', var_name='Region_and_Measure', value_name='Value')
-
-# Separate the Region_and_Measure column into separate 'Region' and 'Measure' columns
-df_melted[['Region', 'Measure']] = df_melted['Region_and_Measure'].str.split('-', expand=True, n=1)
-
-# Drop the now redundant 'Region_and_Measure' column
-df_melted = df_melted.drop(columns='Region_and_Measure')
-
-# To make data uniform across different files, add a 'Country' column
-df_melted['Country'] = 'United_States'
-
-# Reorder the columns
-df_melted = df_melted[['Country', 'Region', 'Date', 'Measure', 'Value']]
-
-# Change any negative values to 0
-df_melted['Value'] = df_melted['Value'].clip(lower=0)
-
-# Load the sewershed jurisdiction data
-ww_us2 = pd.DataFrame.from_records(results_pop)
-
-sewershed_data = ww_us2[['wwtp_jurisdiction', 'key_plot_id', 'population_served']].drop_duplicates()
-sewershed_data['population_served'] = pd.to_numeric(sewershed_data['population_served'], errors='coerce')
-
-# Filter the first dataframe to only include rows where "Measure" is "inf"
-infection_data = df_melted[df_melted["Measure"] == "inf"]
-
-# Join the two dataframes on the "Region" column from the first dataframe and the "rwzi_name" column from the second dataframe
-combined_data = infection_data.merge(sewershed_data, left_on="Region", right_on="key_plot_id", how="inner")
-
-# Group by "Date" and "province" and calculate the sum of "Value" multiplied by "fraction" here assumed 1 for each group
-grouped_data = combined_data.groupby(["Date", "wwtp_jurisdiction"]).apply(lambda df: (df["Value"]).sum()).reset_index()
-
-# Extract NYC data
-nyc_infdata = grouped_data[grouped_data['wwtp_jurisdiction'] == 'New York City']
-
-# Merge NYC data with NY data based on Date
-merged_nyc_inf_data = pd.merge(grouped_data[grouped_data['wwtp_jurisdiction'] == 'New York'], 
-                       nyc_infdata, 
-                       on='Date', 
-                       how='left', 
-                       suffixes=('', '_nyc'))
+series = series.take(slice(None, -1))
 
-# Add the wastewater data of NYC to NY for each date
-merged_nyc_inf_data['0'] += merged_nyc_inf_data['0_nyc'].fillna(0)
-
-# Drop the unnecessary columns
-merged_nyc_inf_data.drop(columns=['wwtp_jurisdiction_nyc', '0_nyc'], inplace=True)
-
-# Change column name from '0' to 0
-merged_nyc_inf_data.rename(columns={'0': 0}, inplace=True)
-
-# Append this updated NY data back to the original dataframe
-grouped_data = pd.concat([grouped_data[grouped_data['wwtp_jurisdiction'] != 'New York'], merged_nyc_inf_data], ignore_index=True)
-#grouped_data = grouped_data[grouped_data['wwtp_jurisdiction'] != 'New York'].append(merged_nyc_inf_data, ignore_index=True)
-
-# Rename the columns to match the original dataframe
-grouped_data.columns = ["Date", "Region", "Value"]
-
-# Add the "Country" and "Measure" columns
-grouped_data["Country"] = "United_States"
-grouped_data["Measure"] = "inf"
-
-# Reorder the columns to match the original dataframe
-grouped_data = grouped_data[["Country", "Region", "Date", "Measure", "Value"]]
-
-# Filter the first dataframe to only include rows where "Measure" is "wastewater"
-wastewater_data = df_melted[df_melted["Measure"] == "wastewater"]
-
-# Join the two dataframes on the "Region" column from the first dataframe and the "rwzi_name" column from the second dataframe
-combined_data2 = wastewater_data.merge(sewershed_data, left_on="Region", right_on="key_plot_id", how="inner")
-
-# For each date and province, calculate the sum of wastewater values weighted by the sewershed's population serving the province
-grouped_waste = combined_data2.groupby(["Date", "wwtp_jurisdiction"]).apply(lambda df: (df["Value"] * df["population_served"]).sum()).reset_index()
-
-## Make sure to add New York City values for each date to New York State values
-# Extract NYC data using the correct column name
-nyc_wwdata = grouped_waste[grouped_waste['wwtp_jurisdiction'] == 'New York City']
-
-# Merge NYC data with NY data based on Date
-merged_nyc_data = pd.merge(grouped_waste[grouped_waste['wwtp_jurisdiction'] == 'New York'], 
-                       nyc_wwdata, 
-                       on='Date', 
-                       how='left', 
-                       suffixes=('', '_nyc'))
-
-# Add the wastewater data of NYC to NY for each date
-merged_nyc_data['0'] += merged_nyc_data['0_nyc'].fillna(0)
-
-# Drop the unnecessary columns
-merged_nyc_data.drop(columns=['wwtp_jurisdiction_nyc', '0_nyc'], inplace=True)
-
-# Change column name from '0' to 0
-merged_nyc_data.rename(columns={'0': 0}, inplace=True)
-
-# Append this updated NY data back to the original dataframe
-grouped_waste = pd.concat([grouped_waste[grouped_waste['wwtp_jurisdiction'] != 'New York'], merged_nyc_data], ignore_index=True)
-#grouped_waste = grouped_waste[grouped_waste['wwtp_jurisdiction'] != 'New York'].append(merged_nyc_data, ignore_index=True)
-
-# Add a column of 0s and 1s to combined_data2 to indicate whether the value is >0 or not
-combined_data2["Value>0"] = np.where(combined_data2["Value"] > 0, 1, 0)
-
-# For each date and state, calculate the sum of populations served by the sewersheds
-grouped_pop = combined_data2.groupby(["Date", "wwtp_jurisdiction"]).apply(lambda df: (df["population_served"] * df["Value>0"]).sum()).reset_index()
-#grouped_pop = combined_data2.groupby(["Date", "wwtp_jurisdiction"])["population_served"].sum().reset_index()
-
-## Make sure to add New York City values for each date to New York State values
-# Extract NYC data using the correct column name
-nyc_popdata = grouped_pop[grouped_pop['wwtp_jurisdiction'] == 'New York City']
-
-# Merge NYC data with NY data based on Date
-merged_nyc_pop_data = pd.merge(grouped_pop[grouped_pop['wwtp_jurisdiction'] == 'New York'], 
-                       nyc_popdata, 
-                       on='Date', 
-                       how='left', 
-                       suffixes=('', '_nyc'))
-
-# Add the wastewater data of NYC to NY for each date
-merged_nyc_pop_data['0'] += merged_nyc_pop_data['0_nyc'].fillna(0)
-
-# Drop the unnecessary columns
-merged_nyc_pop_data.drop(columns=['wwtp_jurisdiction_nyc', '0_nyc'], inplace=True)
-
-# Change column name from '0' to 0
-merged_nyc_pop_data.rename(columns={'0': 0}, inplace=True)
-
-# Append this updated NY data back to the original dataframe
-grouped_pop = pd.concat([grouped_pop[grouped_pop['wwtp_jurisdiction'] != 'New York'], merged_nyc_pop_data], ignore_index=True)
-#grouped_pop = grouped_pop[grouped_pop['wwtp_jurisdiction'] != 'New York'].append(merged_nyc_pop_data, ignore_index=True)
-
-# Join the two grouped dataframes on "Date" and state
-grouped_data2 = grouped_waste.merge(grouped_pop, on=["Date", "wwtp_jurisdiction"], how="inner")
-
-# Divide the total wastewater value by the total population for each province to get the per capita wastewater value
-grouped_data2["Value"] = grouped_data2["0_x"] / grouped_data2["0_y"]
-
-# Drop the unnecessary columns
-grouped_data2 = grouped_data2.drop(columns=["0_x", "0_y"])
-
-# Rename the columns to match the original dataframe
-grouped_data2.columns = ["Date", "Region", "Value"]
-
-# Add the "Country" and "Measure" columns
-grouped_data2["Country"] = "United_States"
-grouped_data2["Measure"] = "wastewater"
-
-# Reorder the columns to match the original dataframe
-grouped_data2 = grouped_data2[["Country", "Region", "Date", "Measure", "Value"]]
-
-# Append the new dataframe to the inf dataframe
-#us_data = pd.concat([grouped_data, grouped_data2], ignore_index=True)
-
-# Append the new dataframe to the original dataframe
-#updated_us_data = pd.concat([grouped_data3, df_melted], ignore_index=True)
-
-# CSV
-#updated_us_data.to_csv('United_States_cleaned.csv', index=False)
-
-# Json
-#updated_us_data.to_json('United_States_cleaned.json', orient='records')
+# Load the sewershed jurisdiction data, as plain strings so that grouping only sees jurisdictions with data
+sewershed_data = read_dataset("2ew6-ywp6", columns=['wwtp_jurisdiction', 'key_plot_id', 'population_served']).drop_duplicates()
+sewershed_data = sewershed_data.astype({'wwtp_jurisdiction': str, 'key_plot_id': str})
 
 # Define the census_population_2022 data
 census_population_2022 = {
@@ -319,25 +109,34 @@ census_population_2022 = {
     "New York City": 8335897 
 }
 
-# Calculate coverage ratio for each state on each date
-grouped_pop['coverage_ratio'] = grouped_pop.apply(lambda row: row[0] / census_population_2022.get(row['wwtp_jurisdiction'], 1), axis=1)
+# New York City is part of New York State, and every state is part of the nation
+census_population_2022['United States'] = sum(v for k, v in census_population_2022.items() if k != 'New York City')
+parents = {state: 'United States' for state in census_population_2022 if state not in ('United States', 'New York City')}
+parents['New York City'] = 'New York'
 
+# Infections and wastewater of every sewershed as (dates x sewersheds) arrays, changing any negative values to 0
+infection_data = series['new_inf_3day'].clip(min=0)
+wastewater_data = series['3day_avg'].clip(min=0)
+dates = series.dates
+sites = series.sites
 
-# Merge the grouped_data_df with the coverage ratios from grouped_pop_df
-adjusted_data_df = pd.merge(grouped_data, grouped_pop[['Date', 'wwtp_jurisdiction', 'coverage_ratio']], 
-                            left_on=['Date', 'Region'], right_on=['Date', 'wwtp_jurisdiction'], how='left')
+# Sparse sewershed -> jurisdiction matrices, counting each sewershed once per jurisdiction row or by its population served
+counts, regions = region_weights(sites, sewershed_data, 'key_plot_id', 'wwtp_jurisdiction', parents=parents)
+populations, _ = region_weights(sites, sewershed_data, 'key_plot_id', 'wwtp_jurisdiction', 'population_served', parents=parents)
 
-# Adjust the "Value" column by dividing by the "coverage_ratio"
-adjusted_data_df['Adjusted Value'] = adjusted_data_df['Value'] / adjusted_data_df['coverage_ratio']
+# Sum the infections of each jurisdiction, and average the wastewater values weighted by the population
+# of the sewersheds that report a value on each date
+infections = sum_by_region(infection_data, counts)
+wastewater, population_covered = mean_by_region(wastewater_data, populations)
 
-# Drop the extra columns
-adjusted_data_df.drop(columns=['wwtp_jurisdiction', 'coverage_ratio', 'Value'], inplace=True)
-
-# Rename the "Adjusted Value" column to "Value"
-adjusted_data_df.rename(columns={'Adjusted Value': 'Value'}, inplace=True)
+# Calculate coverage ratio for each state on each date and scale the infections to the whole state
+coverage_ratio = population_covered / np.array([census_population_2022.get(region, 1) for region in regions])
+with np.errstate(invalid='ignore', divide='ignore'):
+    infections = infections / coverage_ratio
 
 # Append the dataframes for inf and wastewater
-us_data = pd.concat([adjusted_data_df, grouped_data2], ignore_index=True)
+us_data = concat_long([to_long(infections, dates, regions, 'United_States', 'inf'),
+                       to_long(wastewater, dates, regions, 'United_States', 'wastewater')])
 
 # Get official data for each state
 confirmed_cases_data = pd.read_csv('covid_confirmed_usafacts.csv')
@@ -410,10 +209,7 @@ statewise_new_cases['Region'] = statewise_new_cases['Region'].replace(abbreviati
 statewise_new_cases = statewise_new_cases[statewise_new_cases['Date'] > '2021-06-01']
 
 # Append the official_new_cases_data to us_data_with_ratio
-us_data_combined = pd.concat([us_data, statewise_new_cases], ignore_index=True)
-
-# Save to csv
-us_data_combined.to_csv('United_States_cleaned.csv', index=False)
+us_data_combined = concat_long([us_data, statewise_new_cases])
 
-# Save to json
-us_data_combined.to_json('United_States_cleaned.json', orient='records')
+# Save as csv, json, in the Parquet dataset and as dashboard shards
+write_outputs(us_data_combined, 'United_States')
@@ -1,36 +1,20 @@
-import requests
-from datetime import datetime, timedelta
-# https://d1t7q96h7r5kqm.cloudfront.net/2023-12-04_automated_csvs/cases_by_census_region_nationwide.csv
-def download_csv(base_url, start_date, days_back, file_extension):
-    for i in range(days_back):
-        # Calculate the date for the file
-        date_for_file = start_date - timedelta(days=i)
-        date_str = date_for_file.strftime("%Y-%m-%d")  # Adjust format if needed
-
-        # Construct the file URL
-        file_url = f"{base_url}{date_str}{file_extension}"
-
-        # Attempt to download the file
-        response = requests.get(file_url)
-        if response.status_code == 200:
-            # Save the file if found
-            file_path = f'US_Biobot_data_{date_str}.csv'
-            with open(file_path, 'wb') as file:
-                file.write(response.content)
-            return f"CSV file for {date_str} downloaded successfully at {file_path}.", file_path
-
-    return "No CSV file found in the specified date range.", None
-
-# Base URL and other parameters
-base_url = "https://d1t7q96h7r5kqm.cloudfront.net/"  # Replace with actual base URL
-start_date = datetime.now()
-days_back = 14  # Number of days to go back from today
-file_extension = "_automated_csvs/wastewater_by_census_region_nationwide.csv"  # File extension
+import os
+import sys
+import pandas as pd
 
-# Call the function to download the CSV
-result, file_path = download_csv(base_url, start_date, days_back, file_extension)
+# Make the shared pipeline package importable when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pipeline.biobot import DAYS_BACK, download_latest
 
-import pandas as pd
+# https://d1t7q96h7r5kqm.cloudfront.net/2023-12-04_automated_csvs/cases_by_census_region_nationwide.csv
+# Newest nationwide and county files of the last 14 days, downloaded in one pass. The nightly run downloads
+# them once with `python -m pipeline.biobot` and runs this script and wwUSbiobot_c.py with FETCH_MODE=replay,
+# so that they read the same snapshots from the cache without probing the server again.
+files = download_latest()
+date_str, file_path = files['nationwide']
+if file_path is None:
+    sys.exit(f'No Biobot snapshot found in the last {DAYS_BACK} days')
+print(f'Nationwide Biobot data of {date_str}')
 
 # Read the CSV into a pandas DataFrame, making sure to parse the first column as dates
 # Specify the correct date format if pandas does not recognize it automatically
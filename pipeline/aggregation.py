@@ -0,0 +1,77 @@
+# Purpose: Aggregate sewershed series into provinces, states and national totals with sparse matrix products
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from pipeline.formatting import grid_frame
+from pipeline.timing import timed
+
+
+def _ancestors(region, parents):
+    # The region itself followed by its parent, grandparent, ...
+    chain = [region]
+    while chain[-1] in parents:
+        if parents[chain[-1]] in chain:
+            raise ValueError(f'Parent links of {region} form a cycle')
+        chain.append(parents[chain[-1]])
+    return chain
+
+
+@timed('aggregation')
+def region_weights(sites, links, site_col, region_col, weight_col=None, parents=None):
+    """Build the sparse (sites x regions) matrix that maps site values to region totals.
+
+    `links` has one row per share of a site in a region (rows of the same site and region add
+    up); `weight_col` is the weight of the share, 1 if None. `parents` maps a region to the
+    region that contains it (e.g. {'New York City': 'New York', 'New York': 'United States'}),
+    and every region also receives the weights of all regions below it.
+    Returns the matrix and the list of regions of its columns.
+    """
+    parents = parents or {}
+    links = links[links[site_col].isin(sites)]
+    site_index = pd.Index(sites)
+
+    direct = links[region_col].unique().tolist()
+    chains = {region: _ancestors(region, parents) for region in direct}
+    regions = sorted({region for chain in chains.values() for region in chain})
+    region_index = {region: i for i, region in enumerate(regions)}
+
+    # Shares without a weight (e.g. unknown population) count as 0
+    weights = np.ones(len(links)) if weight_col is None else np.nan_to_num(links[weight_col].to_numpy(dtype=float))
+    matrix = sparse.coo_matrix((weights, (site_index.get_indexer(links[site_col]),
+                                          [region_index[region] for region in links[region_col]])),
+                               shape=(len(sites), len(regions))).tocsr()
+
+    # Roll every region up into its ancestors: (regions x regions) matrix of the parent chains
+    rows = [region_index[region] for region in direct for _ in chains[region]]
+    cols = [region_index[ancestor] for region in direct for ancestor in chains[region]]
+    rollup = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(regions), len(regions)))
+    return matrix @ rollup, regions
+
+
+@timed('aggregation')
+def sum_by_region(values, weights):
+    """Weighted sum of the (dates x sites) `values` in every region; missing values count as 0."""
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    return np.asarray((weights.T @ values.T).T)
+
+
+@timed('aggregation')
+def mean_by_region(values, weights, mask=None):
+    """Weighted mean of the (dates x sites) `values` in every region.
+
+    Only the sites where the (dates x sites) `mask` is true count on a date, by default those
+    whose value is positive (so a missing or 0 value does not count). Returns the means and the
+    total weight of the sites that count, e.g. the population covered on every date.
+    """
+    values = np.asarray(values, dtype=float)
+    mask = values > 0 if mask is None else np.asarray(mask, dtype=bool)
+    total = sum_by_region(np.where(mask, values, 0), weights)
+    covered = sum_by_region(mask, weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / covered, covered
+
+
+def to_long(values, dates, regions, country, measure):
+    """Long-format rows (Country, Region, Date, Measure, Value) of a (dates x regions) array, ordered by date."""
+    return grid_frame(country, np.asarray(values)[None], dates, regions, [measure], date_major=True)
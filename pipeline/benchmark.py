@@ -0,0 +1,470 @@
+# Purpose: Time the country pipelines on synthetic data of any size, and check their results against golden files
+#
+# Usage: python -m pipeline.benchmark [nwss rivm finland] [--sites N] [--days N] [--every N] [--repeat N]
+#                                     [--report benchmark_report.json] [--baseline OLD_REPORT] [--update-golden]
+#
+# Runs offline. The inputs are made from the fecal shedding model and laid out in a scratch directory the way
+# each country script reads them: the Socrata Parquet cache of the NWSS data (US), and the remote CSV files of
+# the Netherlands and Finland as responses recorded in the fetch cache, which the scripts read in 'replay' mode.
+# Every scenario runs the country script itself, as the runner does, and reports the seconds of the stages of
+# pipeline.timing: reading inputs, pivot/interpolate, deconvolution, aggregation, writing outputs and the rest.
+import argparse
+import json
+import os
+import platform
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from pipeline import fetch, timing
+from pipeline.deconvolution import load_shedding_kernel
+from pipeline.formatting import CATEGORIES, COLUMNS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHEDDING_MODEL = os.path.join(ROOT, 'FecalSheddingModel.csv')
+SEWERSHED_FRACTIONS = os.path.join(ROOT, 'Sewershed area fraction covered by province.csv')
+
+# Results of every scenario at GOLDEN_SCALES. Every row that the country scripts of the baseline commit 0c9e914
+# (before the shared pipeline package) also write on the same inputs holds the value of those scripts; the only
+# other rows are the national rollups ('Netherlands', 'United States') added with the sparse aggregation. The
+# national infections of the Netherlands are the sum of its provinces; those of the US are scaled by the national
+# coverage, as every state is by its own. --update-golden rewrites the files from the current code.
+GOLDEN_DIR = os.path.join(ROOT, 'pipeline', 'benchmark_golden')
+
+REPORT_PATH = 'benchmark_report.json'
+
+# Country script of every scenario and the name of the outputs it writes
+SCRIPTS = {
+    'nwss': ('US/us_estimate_infections.py', 'United_States'),
+    'rivm': ('Netherlands/netherlands_estimate_infections.py', 'Netherlands'),
+    'finland': ('Finland/finland_estimate_infections.py', 'Finland'),
+}
+
+# Stages of pipeline.timing in the order of a pipeline, and the time of a run outside all of them
+STAGES = ['download', 'read inputs', 'pivot/interpolate', 'deconvolution', 'aggregation', 'write outputs', 'other']
+
+# Size of the inputs of every scenario, close to the data of its country: number of sites, number of days
+# and days between two samples of a site
+SCALES = {
+    'nwss': {'sites': 1300, 'days': 1000, 'every': 3},
+    'rivm': {'sites': 315, 'days': 900, 'every': 2},
+    'finland': {'sites': 9, 'days': 450, 'every': 7},
+}
+
+# Smaller inputs on which the results are compared with the golden files
+GOLDEN_SCALES = {
+    'nwss': {'sites': 12, 'days': 120, 'every': 3},
+    'rivm': {'sites': 12, 'days': 120, 'every': 2},
+    'finland': {'sites': 9, 'days': 120, 'every': 7},
+}
+
+# First day of the inputs, the day after the first date each script keeps
+FIRST_DAY = {'nwss': '2021-06-02', 'rivm': '2021-07-02', 'finland': '2023-01-02'}
+
+# Share of the scheduled samples that are missing
+MISSED = 0.05
+
+# Jurisdictions of the NWSS sites (the states of the census populations of the US script) and the
+# abbreviations of the official case counts
+STATES = {
+    'Alabama': 'AL', 'Alaska': 'AK', 'Arizona': 'AZ', 'Arkansas': 'AR', 'California': 'CA', 'Colorado': 'CO',
+    'Connecticut': 'CT', 'Delaware': 'DE', 'District of Columbia': 'DC', 'Florida': 'FL', 'Georgia': 'GA',
+    'Hawaii': 'HI', 'Idaho': 'ID', 'Illinois': 'IL', 'Indiana': 'IN', 'Iowa': 'IA', 'Kansas': 'KS',
+    'Kentucky': 'KY', 'Louisiana': 'LA', 'Maine': 'ME', 'Maryland': 'MD', 'Massachusetts': 'MA', 'Michigan': 'MI',
+    'Minnesota': 'MN', 'Mississippi': 'MS', 'Missouri': 'MO', 'Montana': 'MT', 'Nebraska': 'NE', 'Nevada': 'NV',
+    'New Hampshire': 'NH', 'New Jersey': 'NJ', 'New Mexico': 'NM', 'New York': 'NY', 'North Carolina': 'NC',
+    'North Dakota': 'ND', 'Ohio': 'OH', 'Oklahoma': 'OK', 'Oregon': 'OR', 'Pennsylvania': 'PA',
+    'Rhode Island': 'RI', 'South Carolina': 'SC', 'South Dakota': 'SD', 'Tennessee': 'TN', 'Texas': 'TX',
+    'Utah': 'UT', 'Vermont': 'VT', 'Virginia': 'VA', 'Washington': 'WA', 'West Virginia': 'WV',
+    'Wisconsin': 'WI', 'Wyoming': 'WY',
+}
+
+# Remote inputs of the Netherlands and Finland scripts
+RIVM_URL = 'https://data.rivm.nl/covid-19/COVID-19_rioolwaterdata.csv'
+FINLAND_URL = 'https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/fi_wastewater_data.csv'
+FINLAND_ESTIMATES_URL = ('https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/'
+                         'FinlandEstimCasesSewersheds.csv')
+
+# Treatment plants of the Finland script and the number of residents they serve
+FINLAND_PLANTS = {'Espoo': 390000, 'Helsinki': 860000, 'Joensuu': 98000, 'Jyväskylä': 154600, 'Kuopio': 90697,
+                  'Oulu': 200000, 'Tampere': 200000, 'Turku': 300000, 'Vaasa': 69500}
+
+# Plants of the official Finnish case estimates read by the script (all but Espoo), in the order of FINLAND_PLANTS
+FINLAND_ESTIMATE_PLANTS = ['Viikinmäki', 'Kuhasalo', 'Nenäinniemi', 'Lehtoniemi', 'Taskila', 'Viinikanlahti',
+                           'Kakolanmäki', 'Pått']
+
+# Relative difference allowed between a result and its golden value
+RTOL = 1e-9
+
+# A stage is a regression when it is this many times slower than in the baseline report, and at least
+# MIN_SLOWDOWN seconds slower
+SLOWDOWN = 1.5
+MIN_SLOWDOWN = 0.05
+
+
+def _shedding(rng, sites, days):
+    # Daily billion gene copies shed in every sewershed (days x sites), from three waves of new infections
+    # convolved with the whole fecal shedding model, and the population served by every sewershed
+    kernel = load_shedding_kernel(SHEDDING_MODEL, length=None)
+    population = np.round(10 ** rng.uniform(4, 6.5, sites))
+    t = np.arange(days + len(kernel))[:, None]
+    infections = np.full((len(t), sites), 1e-4 * population)
+    for _ in range(3):
+        center = rng.uniform(0, len(t), sites)
+        width = rng.uniform(10, 40, sites)
+        size = rng.uniform(0.01, 0.1, sites) * population
+        infections += size * np.exp(-0.5 * ((t - center) / width) ** 2) / (width * np.sqrt(2 * np.pi))
+    copies = lfilter(kernel, [1.0], infections, axis=0)[len(kernel):]
+    return copies * rng.lognormal(0, 0.3, copies.shape), population
+
+
+def _samples(rng, days, sites, every):
+    # (day, site) of every sample: each site is sampled every `every` days from a random first day,
+    # and MISSED of the samples are missing
+    phase = rng.integers(0, every, sites)
+    day, site = np.nonzero((np.arange(days)[:, None] - phase) % every == 0)
+    keep = rng.random(len(day)) >= MISSED
+    return day[keep], site[keep]
+
+
+def _record_csv(directory, url, df, **kwargs):
+    # Make `df` the recorded response of `url` in the fetch cache of `directory`
+    fetch.record(url, df.to_csv(index=False, **kwargs).encode('utf-8'), os.path.join(directory, fetch.CACHE_DIR))
+
+
+def generate_nwss(directory, sites, days, every, seed=0):
+    """Write the inputs of the US script: the Socrata cache of both NWSS datasets and the official case counts."""
+    rng = np.random.default_rng([seed, 0])
+    copies, population = _shedding(rng, sites, days)
+    day, site = _samples(rng, days, sites, every)
+    dates = pd.Timestamp(FIRST_DAY['nwss']) + pd.to_timedelta(day, unit='D')
+    names = np.array([f'NWSS_{k:05d}' for k in range(sites)])
+    jurisdictions = np.array(list(STATES))[rng.integers(0, len(STATES), sites)]
+
+    # Concentrations in gene copies per person per day; every tenth site only has microbial normalization
+    concentrations = pd.DataFrame({
+        'key_plot_id': names[site], 'date': dates,
+        'normalization': np.where(site % 10 == 9, 'microbial', 'flow-population'),
+        'pcr_conc_smoothed': copies[day, site] * 1e9 / population[site],
+    })
+    # One metric row per sample, over the 15 days up to it
+    metrics = pd.DataFrame({
+        'key_plot_id': names[site], 'wwtp_jurisdiction': jurisdictions[site], 'population_served': population[site],
+        'date_start': dates - pd.Timedelta(days=14), 'date_end': dates,
+    })
+    for dataset, df in (('g653-rqe2', concentrations), ('2ew6-ywp6', metrics)):
+        path = os.path.join(directory, '.cache', 'socrata', dataset)
+        os.makedirs(path)
+        strings = {col: 'string' for col in df.columns if df[col].dtype == object}
+        df.astype(strings).to_parquet(os.path.join(path, 'part-000000.parquet'), index=False)
+
+    # Cumulative confirmed cases of one county per state, from a week before the first day
+    case_dates = pd.date_range(pd.Timestamp(FIRST_DAY['nwss']) - pd.Timedelta(days=7), periods=days + 7, freq='D')
+    cumulative = np.cumsum(rng.poisson(50, (len(STATES), len(case_dates))), axis=1)
+    cases = pd.DataFrame(cumulative, columns=case_dates.strftime('%Y-%m-%d'))
+    cases.insert(0, 'countyFIPS', 1000 * np.arange(1, len(STATES) + 1))
+    cases.insert(1, 'County Name', [f'{state} County' for state in STATES])
+    cases.insert(2, 'State', list(STATES.values()))
+    cases.insert(3, 'StateFIPS', np.arange(1, len(STATES) + 1))
+    cases.to_csv(os.path.join(directory, 'covid_confirmed_usafacts.csv'), index=False)
+    return len(concentrations)
+
+
+def generate_rivm(directory, sites, days, every, seed=0):
+    """Write the inputs of the Netherlands script: the RIVM measurements, the population of every sewershed
+    and their province fractions.
+
+    The sewersheds are those of the province fractions of the repository, followed by made-up
+    ones that each lie in one province when more sites are asked for.
+    """
+    rng = np.random.default_rng([seed, 1])
+    copies, population = _shedding(rng, sites, days)
+    day, site = _samples(rng, days, sites, every)
+    dates = pd.Timestamp(FIRST_DAY['rivm']) + pd.to_timedelta(day, unit='D')
+
+    fractions = pd.read_csv(SEWERSHED_FRACTIONS)
+    known = fractions['rwzi_name'].unique()
+    names = np.array(list(known[:sites]) + [f'RWZI {k:04d}' for k in range(len(known), sites)], dtype=object)
+    provinces = fractions.drop_duplicates('province')[['province']]
+    extra = provinces.iloc[rng.integers(0, len(provinces), max(sites - len(known), 0))]
+    fractions = pd.concat([fractions[fractions['rwzi_name'].isin(names)],
+                           extra.assign(rwzi_code=0, rwzi_name=names[len(known):], population=population[len(known):],
+                                        fraction=1.0)], ignore_index=True)
+    fractions[['rwzi_code', 'rwzi_name', 'population', 'province', 'fraction']].to_csv(
+        os.path.join(directory, 'Sewershed area fraction covered by province.csv'), index=False)
+
+    # RNA flow per 100,000 inhabitants per day, with ';' as separator like the RIVM file
+    codes = 1000 + np.arange(sites)
+    _record_csv(directory, RIVM_URL, pd.DataFrame({
+        'Date_measurement': dates.strftime('%Y-%m-%d'), 'RWZI_AWZI_code': codes[site], 'RWZI_AWZI_name': names[site],
+        'RNA_flow_per_100000': copies[day, site] * 1e14 / population[site],
+    }), sep=';')
+    os.makedirs(os.path.join(directory, 'Netherlands'))
+    pd.DataFrame({'rwzi_code': codes, 'inwoners': population.astype(int)}).to_csv(
+        os.path.join(directory, 'Netherlands', 'Netherlands_people_served_by_sewershed.csv'), index=False)
+    return len(day)
+
+
+def generate_finland(directory, sites, days, every, seed=0):
+    """Write the inputs of the Finland script: the measurements and the official case estimates of its plants.
+
+    The script reads the nine plants of FINLAND_PLANTS, so `sites` is not used.
+    """
+    sites = len(FINLAND_PLANTS)
+    rng = np.random.default_rng([seed, 2])
+    copies, _ = _shedding(rng, sites, days)
+    population = np.array(list(FINLAND_PLANTS.values()), dtype=float)
+    day, site = _samples(rng, days, sites, every)
+    dates = pd.Timestamp(FIRST_DAY['finland']) + pd.to_timedelta(day, unit='D')
+    names = np.array(list(FINLAND_PLANTS), dtype=object)
+
+    # Million gene copies per 1000 residents per day
+    _record_csv(directory, FINLAND_URL, pd.DataFrame({
+        'Date of sample': dates.strftime('%Y-%m-%d'), 'Location of treatment plant': names[site],
+        'Normalized RNA count using the RNA standard': copies[day, site] * 1000000 / population[site],
+    }))
+
+    # Weekly case estimates of every plant, all reported on the same days
+    weeks = pd.date_range(FIRST_DAY['finland'], periods=max(days // 7, 1), freq='7D')
+    estimates = rng.poisson(200, (len(weeks), len(FINLAND_ESTIMATE_PLANTS)))
+    _record_csv(directory, FINLAND_ESTIMATES_URL, pd.DataFrame({
+        'Treatment plant': np.tile(FINLAND_ESTIMATE_PLANTS, len(weeks)),
+        'Date of reporting': np.repeat(weeks.strftime('%Y-%m-%d'), len(FINLAND_ESTIMATE_PLANTS)),
+        'COVID-19 cases, estimate': estimates.ravel(),
+    }))
+    return len(day)
+
+
+GENERATORS = {'nwss': generate_nwss, 'rivm': generate_rivm, 'finland': generate_finland}
+
+
+def generate(name, directory, sites, days, every, seed=0):
+    """Lay out the inputs of a scenario in `directory` like the repository root its script runs in.
+
+    Returns the number of wastewater samples.
+    """
+    shutil.copy(SHEDDING_MODEL, os.path.join(directory, 'FecalSheddingModel.csv'))
+    return GENERATORS[name](directory, sites, days, every, seed)
+
+
+@contextmanager
+def _replay_in(directory):
+    # Run in `directory` with the remote inputs read from the recorded responses, like `runner --replay`
+    previous, argv, mode = os.getcwd(), sys.argv, fetch.DEFAULT_MODE
+    os.chdir(directory)
+    fetch.DEFAULT_MODE = 'replay'
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+        sys.argv = argv
+        fetch.DEFAULT_MODE = mode
+
+
+def run(name, inputs, trace_memory=False):
+    """Run the country script of a scenario on a fresh copy of its `inputs`.
+
+    Returns the seconds of every stage of pipeline.timing (and 'other' for the rest of the run),
+    the most memory allocated at any time as traced by tracemalloc (which slows the run down, so
+    such runs are not timed) or None, and the long-format outputs the script wrote.
+    """
+    script, output = SCRIPTS[name]
+    path = os.path.join(ROOT, script)
+    with tempfile.TemporaryDirectory(prefix=f'benchmark-{name}-run-') as scratch:
+        # A copy, so that the outputs and saved states of earlier runs are not reused
+        directory = os.path.join(scratch, 'root')
+        shutil.copytree(inputs, directory)
+        with _replay_in(directory), warnings.catch_warnings():
+            # The pandas warnings of the scripts are not of interest here
+            warnings.simplefilter('ignore')
+            sys.argv = [path]
+            timing.TIMINGS.clear()
+            if trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            try:
+                runpy.run_path(path, run_name='__main__')
+                seconds = time.perf_counter() - started
+                peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+            finally:
+                if trace_memory:
+                    tracemalloc.stop()
+            result = pd.read_csv(f'{output}_cleaned.csv', parse_dates=['Date'])[COLUMNS]
+    stages = dict(timing.TIMINGS)
+    stages['other'] = max(seconds - sum(stages.values()), 0.0)
+    return stages, peak, result
+
+
+def run_scenario(name, sites, days, every, seed=0, repeat=3, trace_memory=True):
+    """Generate the inputs of a scenario once, then run it `repeat` times and once more to trace memory.
+
+    Returns the report of the scenario: the seconds of every stage (the fastest run, and all
+    runs), the peak memory of the run in MB, and the result of the last run.
+    """
+    with tempfile.TemporaryDirectory(prefix=f'benchmark-{name}-') as inputs:
+        started = time.perf_counter()
+        input_rows = generate(name, inputs, sites, days, every, seed)
+        generated = time.perf_counter() - started
+
+        runs = []
+        for _ in range(repeat):
+            stages, _, result = run(name, inputs)
+            runs.append(stages)
+        peak = None
+        if trace_memory:
+            _, peak, result = run(name, inputs, trace_memory=True)
+
+    report = {'scale': {'sites': sites, 'days': days, 'every': every}, 'seed': seed, 'input_rows': input_rows,
+              'output_rows': len(result), 'generate_seconds': round(generated, 4), 'stages': {}}
+    for stage in STAGES:
+        if not any(stage in seconds for seconds in runs):
+            continue
+        seconds = [seconds.get(stage, 0.0) for seconds in runs]
+        report['stages'][stage] = {'seconds': round(min(seconds), 4), 'runs': [round(s, 4) for s in seconds]}
+    report['seconds'] = round(min(sum(seconds.values()) for seconds in runs), 4) if runs else None
+    report['peak_mb'] = round(peak / 2 ** 20, 2) if peak is not None else None
+    return report, result
+
+
+def golden_path(name):
+    return os.path.join(GOLDEN_DIR, f'{name}.csv.gz')
+
+
+def compare(result, golden, rtol=RTOL):
+    """Compare long-format rows with the golden ones, matching them by Country, Region, Date and Measure.
+
+    Returns a dict with the status ('match' or 'mismatch'), the number of golden rows, of rows
+    missing from or not in the golden file, of values that differ by more than `rtol`, and the
+    largest relative difference. Missing values match missing values.
+    """
+    keys = ['Country', 'Region', 'Date', 'Measure']
+    result = result.astype({col: str for col in CATEGORIES})
+    golden = golden.astype({col: str for col in CATEGORIES})
+    merged = result.merge(golden, on=keys, how='outer', suffixes=('', '_golden'), indicator=True)
+    both = merged[merged['_merge'] == 'both']
+    value = both['Value'].to_numpy(dtype=float)
+    expected = both['Value_golden'].to_numpy(dtype=float)
+    both_missing = np.isnan(value) & np.isnan(expected)
+    different = ~both_missing & ~np.isclose(value, expected, rtol=rtol, atol=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relative = np.abs(value - expected) / np.abs(expected)
+    relative = relative[~both_missing & (expected != 0)]
+    report = {
+        'rows': len(golden),
+        'missing_rows': int((merged['_merge'] == 'right_only').sum()),
+        'extra_rows': int((merged['_merge'] == 'left_only').sum()),
+        'different_values': int(different.sum()),
+        'max_relative_difference': float(np.nanmax(relative)) if len(relative) else 0.0,
+    }
+    ok = not (report['missing_rows'] or report['extra_rows'] or report['different_values'])
+    return {'status': 'match' if ok else 'mismatch', **report}
+
+
+def check_golden(name, seed=0, update=False):
+    """Run a scenario at its golden scale and compare the result with its golden file (or write it with `update`)."""
+    scale = GOLDEN_SCALES[name]
+    _, result = run_scenario(name, seed=seed, repeat=1, trace_memory=False, **scale)
+    path = golden_path(name)
+    if update:
+        os.makedirs(GOLDEN_DIR, exist_ok=True)
+        # No time stamp in the gzip header, so an unchanged result gives an unchanged file
+        result.to_csv(path, index=False, compression={'method': 'gzip', 'mtime': 0})
+        return {'status': 'updated', 'rows': len(result), 'scale': scale}
+    if not os.path.exists(path):
+        return {'status': 'missing', 'scale': scale}
+    golden = pd.read_csv(path, parse_dates=['Date'])[COLUMNS]
+    return {**compare(result, golden), 'scale': scale}
+
+
+def regressions(report, baseline, slowdown=SLOWDOWN, min_slowdown=MIN_SLOWDOWN):
+    """Stages of a scenario report that are slower than in the baseline report of the same scenario and scale."""
+    if baseline is None or baseline.get('scale') != report['scale']:
+        return []
+    slower = []
+    for stage, measured in report['stages'].items():
+        before = baseline.get('stages', {}).get(stage)
+        if not before:
+            continue
+        if measured['seconds'] > slowdown * before['seconds'] and measured['seconds'] - before['seconds'] > min_slowdown:
+            slower.append({'stage': stage, 'seconds': measured['seconds'], 'baseline_seconds': before['seconds']})
+    return slower
+
+
+def _max_rss_mb():
+    # Largest resident set size of this process so far, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return round(rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10, 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the country pipelines on synthetic data.')
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run (default: all of {', '.join(SCRIPTS)})")
+    parser.add_argument('--sites', type=int, help='Number of sites (default: see SCALES; Finland always has 9)')
+    parser.add_argument('--days', type=int, help='Number of days')
+    parser.add_argument('--every', type=int, help='Days between two samples of a site')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per scenario; the fastest one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic inputs')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the run that traces memory')
+    parser.add_argument('--report', default=REPORT_PATH, help='JSON file of the report')
+    parser.add_argument('--baseline', help='Earlier report; stages much slower than in it are reported as regressions')
+    parser.add_argument('--update-golden', action='store_true', help='Write the golden files from the current code')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCRIPTS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (available: {', '.join(SCRIPTS)})")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    report = {'created': pd.Timestamp.now(tz='UTC').isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'scenarios': {}}
+    failed = False
+    for name in args.scenarios or list(SCRIPTS):
+        scale = {key: getattr(args, key) or value for key, value in SCALES[name].items()}
+        if name == 'finland':
+            scale['sites'] = len(FINLAND_PLANTS)
+        scenario, _ = run_scenario(name, seed=args.seed, repeat=args.repeat, trace_memory=not args.no_memory, **scale)
+        # The golden files are made with seed 0
+        scenario['golden'] = check_golden(name, update=args.update_golden)
+        scenario['regressions'] = regressions(scenario, (baseline or {}).get('scenarios', {}).get(name))
+        report['scenarios'][name] = scenario
+        failed = failed or scenario['golden']['status'] == 'mismatch' or bool(scenario['regressions'])
+
+        peak = f", peak {scenario['peak_mb']:.1f} MB" if scenario['peak_mb'] is not None else ''
+        print(f"{name}: {scale['sites']} sites x {scale['days']} days, a sample every {scale['every']} days, "
+              f"{scenario['input_rows']} input rows, {scenario['output_rows']} output rows")
+        for stage, measured in scenario['stages'].items():
+            print(f'  {stage:<18} {measured["seconds"]:8.3f} s')
+        print(f"  {'total':<18} {scenario['seconds']:8.3f} s{peak}, golden: {scenario['golden']['status']}")
+        for slower in scenario['regressions']:
+            print(f"  regression: {slower['stage']} took {slower['seconds']:.3f} s, {slower['baseline_seconds']:.3f} s before")
+        if scenario['golden']['status'] == 'missing':
+            print('  no golden file; write it with --update-golden')
+
+    report['max_rss_mb'] = _max_rss_mb()
+    report['ok'] = not failed
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report in {args.report}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
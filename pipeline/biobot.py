@@ -0,0 +1,115 @@
+# Purpose: Find the newest daily Biobot snapshot and download its nationwide and county files through the HTTP cache
+#
+# Usage: python -m pipeline.biobot [--days-back N]
+#
+# Downloads both files once; US/wwUSBiobot.py and US/wwUSbiobot_c.py run afterwards with FETCH_MODE=replay then
+# find the same snapshots in the cache without sending any request.
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+from pipeline import fetch, vintages
+from pipeline.timing import timed
+
+BASE_URL = 'https://d1t7q96h7r5kqm.cloudfront.net/'
+
+# Files of every snapshot, after '<YYYY-MM-DD>' in their URL
+FILES = {
+    'nationwide': '_automated_csvs/wastewater_by_census_region_nationwide.csv',
+    'county': '_automated_csvs/wastewater_by_county.csv',
+}
+
+# Vintage stores (see pipeline.vintages) keeping every snapshot, one per file
+VINTAGES = {name: os.path.join(vintages.BIOBOT_DIR, name) for name in FILES}
+
+# Number of days to go back from today
+DAYS_BACK = 14
+
+# Requests at a time while probing the snapshot dates
+PROBES = 8
+
+
+def snapshot_url(date, name, base_url=BASE_URL):
+    """URL of file `name` (see FILES) of the snapshot of `date` (YYYY-MM-DD)."""
+    return f'{base_url}{date}{FILES[name]}'
+
+
+def candidate_dates(start_date=None, days_back=DAYS_BACK):
+    """Dates (YYYY-MM-DD) of the `days_back` days up to `start_date` (today if None), newest first."""
+    start_date = start_date or datetime.now()
+    return [(start_date - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days_back)]
+
+
+def _exists(session, url):
+    # HEAD request: only the status, not the body
+    try:
+        return session.head(url, allow_redirects=True, timeout=fetch.TIMEOUT).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def latest_dates(names=FILES, start_date=None, days_back=DAYS_BACK, base_url=BASE_URL, session=None,
+                 cache_dir=fetch.CACHE_DIR):
+    """{name: date of the newest snapshot that has file `name`, or None} over the candidate dates.
+
+    Every file of every candidate date is probed at once with a HEAD request, over the keep-alive
+    session of pipeline.fetch. In its 'replay' mode the cache is probed instead.
+    """
+    session = session or fetch.get_session()
+    dates = candidate_dates(start_date, days_back)
+    urls = [(name, date, snapshot_url(date, name, base_url)) for name in names for date in dates]
+    if fetch.DEFAULT_MODE == 'replay':
+        found = [fetch.cached(url, cache_dir) is not None for _, _, url in urls]
+    else:
+        with ThreadPoolExecutor(max_workers=PROBES) as executor:
+            found = list(executor.map(lambda probe: _exists(session, probe[2]), urls))
+    latest = {name: None for name in names}
+    # Dates are newest first
+    for (name, date, _), exists in zip(urls, found):
+        if exists and latest[name] is None:
+            latest[name] = date
+    return latest
+
+
+@timed('download')
+def download_latest(names=FILES, start_date=None, days_back=DAYS_BACK, base_url=BASE_URL, session=None,
+                    cache_dir=fetch.CACHE_DIR):
+    """Download file `name` of the newest snapshot that has it, for every name of `names` in the same pass.
+
+    The files are fetched at once through the cache of pipeline.fetch, so a file downloaded before
+    is only revalidated. Files listed in VINTAGES are also added to their vintage store, as the
+    rows that changed since the previous snapshot (nothing if the snapshot is already stored).
+
+    Returns {name: (date, path of the local copy)}, with (None, None) for a file without any snapshot.
+    """
+    session = session or fetch.get_session()
+    latest = latest_dates(names, start_date, days_back, base_url, session, cache_dir)
+    found = [name for name in names if latest[name] is not None]
+    with ThreadPoolExecutor(max_workers=max(len(found), 1)) as executor:
+        paths = dict(zip(found, executor.map(
+            lambda name: fetch.fetch(snapshot_url(latest[name], name, base_url), cache_dir, session=session), found)))
+
+    files = {name: (None, None) for name in names}
+    for name in found:
+        files[name] = (latest[name], paths[name])
+        if name in VINTAGES:
+            vintages.add(paths[name], latest[name], VINTAGES[name])
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download the newest nationwide and county files of the Biobot snapshots.')
+    parser.add_argument('--days-back', type=int, default=DAYS_BACK, help=f'Days to go back from today (default: {DAYS_BACK})')
+    args = parser.parse_args(argv)
+    files = download_latest(days_back=args.days_back)
+    for name, (date, _) in files.items():
+        print(f'{name}: {date}' if date else f'{name}: no snapshot in the last {args.days_back} days')
+    return 0 if all(path is not None for _, path in files.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
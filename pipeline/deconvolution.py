@@ -0,0 +1,159 @@
+# Purpose: Shared engine to estimate newly infected individuals from wastewater gene copies using the fecal shedding model
+import functools
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.linalg import cho_solve_banded, cholesky_banded
+from scipy.signal import lfilter
+
+from pipeline.fetch import read_csv
+from pipeline.timing import timed
+
+# Number of days of the fecal shedding model used by the country scripts
+KERNEL_LENGTH = 14
+
+# Estimation mode used when a script does not ask for one: 'recursive' or 'regularized'
+DEFAULT_METHOD = os.environ.get('DECONVOLUTION_METHOD', 'recursive')
+
+
+def load_shedding_kernel(path='FecalSheddingModel.csv', length=KERNEL_LENGTH):
+    """Return the first `length` entries of the 'gc in billions' column of the fecal shedding model.
+
+    `path` can be a local file or a URL, which is read through the cache of pipeline.fetch. Pass
+    `length=None` to use the full model.
+    """
+    kernel = _read_shedding_model(path)
+    if length is not None:
+        kernel = kernel[:length]
+    return kernel.copy()
+
+
+@functools.lru_cache(maxsize=None)
+def _read_shedding_model(path):
+    # Read every model once per process; the pipeline runner loads it before starting the pipelines
+    shedding = read_csv(path, index_col=0)
+    return shedding['gc in billions'].dropna().to_numpy(dtype=float)
+
+
+def deconvolve(signal, kernel, start=None, method=None, **options):
+    """Estimate new infections from daily billion gene copies for every site at once.
+
+    `signal` is a (days x sites) array (a 1-D array is treated as a single site). Infections before
+    `start` are 0; `start` defaults to len(kernel) - 1 and can be given per site as a sequence.
+
+    `method` is 'recursive' (the inverse filter of the original scripts) or 'regularized' (a
+    non-negative, smoothed least-squares fit, see `deconvolve_regularized`). Extra keyword
+    arguments are passed to the regularized solver.
+    """
+    method = method or DEFAULT_METHOD
+    if method == 'recursive':
+        solver = _deconvolve_recursive
+    elif method == 'regularized':
+        solver = functools.partial(deconvolve_regularized, **options)
+    else:
+        raise ValueError(f"Unknown deconvolution method: {method}")
+
+    kernel = np.asarray(kernel, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    squeeze = signal.ndim == 1
+    if squeeze:
+        signal = signal[:, None]
+
+    if start is None:
+        start = len(kernel) - 1
+    starts = np.broadcast_to(np.asarray(start, dtype=int), (signal.shape[1],))
+
+    infections = np.zeros_like(signal)
+    # Solve all sites that share a start day in a single call
+    for s in np.unique(starts):
+        cols = np.flatnonzero(starts == s)
+        if s < len(signal):
+            infections[s:, cols] = solver(signal[s:, cols], kernel)
+
+    if squeeze:
+        return infections[:, 0]
+    return infections
+
+
+def _deconvolve_recursive(signal, kernel):
+    # inf[i] = (signal[i] - sum_{k>=1} kernel[k] * inf[i - k]) / kernel[0], the recursion of the
+    # original per-cell loops, run as an IIR linear filter along the day axis. NaNs propagate
+    # exactly as they did in the loops.
+    return lfilter([1.0], kernel, signal, axis=0)
+
+
+def _convolution_matrix(kernel, n):
+    # Lower-triangular banded Toeplitz matrix K with (K inf)[i] = sum_k kernel[k] * inf[i - k]
+    return sparse.diags(list(kernel), offsets=[-k for k in range(len(kernel))], shape=(n, n), format='csr')
+
+
+def _to_upper_banded(matrix, bandwidth):
+    # Upper banded storage of a symmetric sparse matrix, as used by scipy.linalg.cholesky_banded
+    n = matrix.shape[0]
+    banded = np.zeros((bandwidth + 1, n))
+    for k in range(bandwidth + 1):
+        banded[bandwidth - k, k:] = matrix.diagonal(k)
+    return banded
+
+
+def deconvolve_regularized(signal, kernel, smoothness=0.1, max_iter=500, tol=1e-4):
+    """Fit non-negative new infections to a (days x sites) signal in one pass over the whole series.
+
+    Minimizes ||K inf - signal||^2 + smoothness * sum(kernel)^2 * ||D inf||^2 subject to inf >= 0,
+    where K is the banded lower-triangular Toeplitz matrix of the shedding kernel and D takes
+    second differences. Missing (NaN) days are left out of the fit.
+
+    The constraint is handled with ADMM. The banded system matrix is factored once per pattern of
+    missing days and every iteration solves all sites of that pattern together. For n days and a
+    kernel of length L, a banded Cholesky factorization costs O(n * L^2) and every solve O(n * L)
+    per site, so the cost grows linearly with the days and sites but quadratically with L.
+    """
+    kernel = np.asarray(kernel, dtype=float)
+    signal = np.asarray(signal, dtype=float)
+    n = len(signal)
+    observed = ~np.isnan(signal)
+
+    total_shedding = kernel.sum()
+    rho = total_shedding ** 2
+    K = _convolution_matrix(kernel, n)
+    D = sparse.diags([1.0, -2.0, 1.0], offsets=[0, 1, 2], shape=(max(n - 2, 0), n), format='csr')
+    smoothing = smoothness * total_shedding ** 2 * (D.T @ D) + rho * sparse.identity(n)
+    bandwidth = max(len(kernel) - 1, 2)
+
+    infections = np.zeros_like(signal)
+    patterns, groups = np.unique(observed, axis=1, return_inverse=True)
+    for g in range(patterns.shape[1]):
+        cols = np.flatnonzero(groups.ravel() == g)
+        weights = patterns[:, g].astype(float)
+        target = np.where(observed[:, cols], signal[:, cols], 0.0)
+
+        system = K.T @ sparse.diags(weights) @ K + smoothing
+        factor = cholesky_banded(_to_upper_banded(system, bandwidth))
+        rhs = K.T @ target
+
+        z = np.zeros_like(target)
+        u = np.zeros_like(target)
+        for _ in range(max_iter):
+            y = cho_solve_banded((factor, False), rhs + rho * (z - u))
+            z_new = np.maximum(y + u, 0)
+            u += y - z_new
+            primal = np.linalg.norm(y - z_new)
+            dual = np.linalg.norm(z_new - z)
+            z = z_new
+            scale = max(np.linalg.norm(z), 1e-12)
+            if primal < tol * scale and dual < tol * scale:
+                break
+        infections[:, cols] = z
+
+    return infections
+
+
+@timed('deconvolution')
+def deconvolve_frame(ww, columns, kernel, start=None, suffix='_new_inf_total', method=None, **options):
+    """Deconvolve the given columns of a daily wide-format frame and return the new infections.
+
+    The result has one column per input column, named with `suffix`, and the index of `ww`.
+    """
+    infections = deconvolve(ww[list(columns)].to_numpy(dtype=float), kernel, start=start, method=method, **options)
+    return pd.DataFrame(infections, index=ww.index, columns=[str(col) + suffix for col in columns])
@@ -0,0 +1,222 @@
+# Purpose: Download the remote inputs of the pipelines over keep-alive sessions into a revalidated local cache
+import calendar
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from pipeline.timing import stage, timed
+
+# Bodies are stored once per content under objects/<sha256>; urls/ holds what is known about every URL
+# and parsed/ the frames read from the bodies
+CACHE_DIR = '.cache/http'
+
+# 'revalidate' asks the server whether the cached copy of a URL is still current (a conditional GET that
+# costs one 304 response if it is) and downloads it otherwise. 'replay' serves the cached copies without
+# any network access, e.g. to run or benchmark the pipelines offline.
+MODES = ['revalidate', 'replay']
+DEFAULT_MODE = os.environ.get('FETCH_MODE', 'revalidate')
+
+# Seconds during which a copy that was revalidated is used without asking the server again, e.g. by the
+# pipelines after the runner prefetched their inputs (0: always revalidate)
+MAX_AGE = float(os.environ.get('FETCH_MAX_AGE', 0))
+
+# Seconds to wait for the server to connect and to send data
+TIMEOUT = (30, 300)
+
+CHUNK_SIZE = 1 << 20
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """Keep-alive session shared by the downloads of this process.
+
+    A process forked from the one that made the session gets its own, so that two processes never
+    share a connection.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=3)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def is_url(path):
+    return str(path).startswith(('http://', 'https://'))
+
+
+def _entry_path(url, cache_dir):
+    return os.path.join(cache_dir, 'urls', hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+
+def _object_path(digest, cache_dir):
+    return os.path.join(cache_dir, 'objects', digest)
+
+
+def _replace(path, write, mode='w'):
+    # Write a file through a temporary file in the same directory, so that readers never see it half written
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def cached(url, cache_dir=CACHE_DIR):
+    """What the cache knows about `url` (its sha256, ETag, Last-Modified, size and times), or None."""
+    try:
+        with open(_entry_path(url, cache_dir), encoding='utf-8') as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return entry if os.path.exists(_object_path(entry['sha256'], cache_dir)) else None
+
+
+def _age(entry):
+    # Seconds since the cached copy was last downloaded or revalidated
+    if not entry.get('checked'):
+        return float('inf')
+    return time.time() - calendar.timegm(time.strptime(entry['checked'], TIME_FORMAT))
+
+
+def _save_entry(entry, cache_dir):
+    _replace(_entry_path(entry['url'], cache_dir), lambda f: json.dump(entry, f, indent=1))
+
+
+def _store_body(response, cache_dir):
+    # Stream the body to a temporary file while hashing it, then move it to its content address
+    digest = hashlib.sha256()
+    size = 0
+    directory = os.path.join(cache_dir, 'objects')
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        os.replace(tmp, _object_path(digest.hexdigest(), cache_dir))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return digest.hexdigest(), size
+
+
+def _remove_unused(digest, cache_dir):
+    # Delete a body, and the frames parsed from it, once no URL refers to it anymore
+    directory = os.path.join(cache_dir, 'urls')
+    for name in os.listdir(directory):
+        try:
+            with open(os.path.join(directory, name), encoding='utf-8') as f:
+                if json.load(f)['sha256'] == digest:
+                    return
+        except (OSError, ValueError, KeyError):
+            continue
+    parsed = os.path.join(cache_dir, 'parsed')
+    paths = [_object_path(digest, cache_dir)]
+    if os.path.isdir(parsed):
+        paths += [os.path.join(parsed, name) for name in os.listdir(parsed) if name.startswith(digest)]
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+@timed('download')
+def fetch(url, cache_dir=CACHE_DIR, mode=None, session=None):
+    """Return the path of a local copy of `url`, downloading it only if it changed since it was cached.
+
+    With a cached copy the request carries its ETag (If-None-Match) and Last-Modified date
+    (If-Modified-Since), so an unchanged source is answered with 304 Not Modified and no body.
+    A new body is streamed to disk and stored under its sha256; identical bodies of several URLs
+    or versions are stored once. A copy revalidated less than MAX_AGE seconds ago is returned
+    without a request. In 'replay' mode (see MODES) the cached copy is always returned without a
+    request, and a URL that was never downloaded raises FileNotFoundError.
+
+    Local paths are returned unchanged.
+    """
+    if not is_url(url):
+        return url
+    mode = mode or DEFAULT_MODE
+    if mode not in MODES:
+        raise ValueError(f"Unknown fetch mode: {mode} (available: {', '.join(MODES)})")
+    entry = cached(url, cache_dir)
+    if mode == 'replay':
+        if entry is None:
+            raise FileNotFoundError(f'{url} has no recorded response in {cache_dir}')
+        return _object_path(entry['sha256'], cache_dir)
+    if entry is not None and MAX_AGE and _age(entry) < MAX_AGE:
+        return _object_path(entry['sha256'], cache_dir)
+
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    now = time.strftime(TIME_FORMAT, time.gmtime())
+    with (session or get_session()).get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 304 and entry is not None:
+            entry['checked'] = now
+            _save_entry(entry, cache_dir)
+            return _object_path(entry['sha256'], cache_dir)
+        response.raise_for_status()
+        digest, size = _store_body(response, cache_dir)
+        new_entry = {'url': url, 'sha256': digest, 'size': size, 'etag': response.headers.get('ETag'),
+                     'last_modified': response.headers.get('Last-Modified'),
+                     'content_type': response.headers.get('Content-Type'), 'fetched': now, 'checked': now}
+    _save_entry(new_entry, cache_dir)
+    if entry is not None and entry['sha256'] != digest:
+        _remove_unused(entry['sha256'], cache_dir)
+    return _object_path(digest, cache_dir)
+
+
+def read_csv(path, cache_dir=CACHE_DIR, mode=None, **kwargs):
+    """pd.read_csv(path, **kwargs) of a local file or a URL, a URL being fetched through the cache.
+
+    The frame read from a URL is saved with the body it was parsed from and the arguments of
+    read_csv, so an unchanged source is not parsed again either.
+    """
+    if not is_url(path):
+        return pd.read_csv(path, **kwargs)
+    local = fetch(path, cache_dir, mode)
+    # Frames pickled by another pandas version are parsed again
+    key = hashlib.sha256(json.dumps([pd.__version__, kwargs], sort_keys=True, default=repr).encode()).hexdigest()[:16]
+    parsed = os.path.join(cache_dir, 'parsed', f'{os.path.basename(local)}-{key}.pkl')
+    with stage('read inputs'):
+        if os.path.exists(parsed):
+            return pd.read_pickle(parsed)
+        df = pd.read_csv(local, **kwargs)
+        _replace(parsed, lambda f: df.to_pickle(f), mode='wb')
+    return df
+
+
+def record(url, body, cache_dir=CACHE_DIR):
+    """Store the bytes `body` as the cached copy of `url`, as if they had been downloaded.
+
+    The pipelines can then be replayed on made-up inputs, as the benchmark (pipeline/benchmark.py) does.
+    """
+    digest = hashlib.sha256(body).hexdigest()
+    _replace(_object_path(digest, cache_dir), lambda f: f.write(body), mode='wb')
+    now = time.strftime(TIME_FORMAT, time.gmtime())
+    _save_entry({'url': url, 'sha256': digest, 'size': len(body), 'etag': None, 'last_modified': None,
+                 'content_type': None, 'fetched': now, 'checked': now}, cache_dir)
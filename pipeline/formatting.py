@@ -0,0 +1,102 @@
+# Purpose: Shared restructuring and saving of the long-format outputs of the country pipelines
+import numpy as np
+import pandas as pd
+
+from pipeline.shards import write_shards
+from pipeline.store import write_country
+from pipeline.timing import timed
+
+COLUMNS = ['Country', 'Region', 'Date', 'Measure', 'Value']
+
+# Columns stored as categoricals, so that every region, measure and country name is stored once
+CATEGORIES = ['Country', 'Region', 'Measure']
+
+# Number of rows converted to text at a time when writing CSV and JSON
+CHUNK_ROWS = 100000
+
+
+def grid_frame(country, values, dates, regions, measures, date_major=False):
+    """Long-format rows (Country, Region, Date, Measure, Value) of a (measures x dates x regions) array.
+
+    Rows are ordered by measure, region and date, or by measure, date and region with
+    `date_major`. Country, Region and Measure are categoricals built from integer codes.
+    """
+    values = np.asarray(values, dtype=float)
+    n_measures, n_dates, n_regions = values.shape
+    if date_major:
+        region_codes = np.tile(np.arange(n_regions), n_measures * n_dates)
+        date_codes = np.tile(np.repeat(np.arange(n_dates), n_regions), n_measures)
+    else:
+        region_codes = np.tile(np.repeat(np.arange(n_regions), n_dates), n_measures)
+        date_codes = np.tile(np.arange(n_dates), n_measures * n_regions)
+        values = values.transpose(0, 2, 1)
+    return pd.DataFrame({
+        'Country': pd.Categorical.from_codes(np.zeros(values.size, dtype=np.int8), [country]),
+        'Region': pd.Categorical.from_codes(region_codes, pd.Index(regions)),
+        'Date': np.asarray(dates)[date_codes],
+        'Measure': pd.Categorical.from_codes(np.repeat(np.arange(n_measures), n_dates * n_regions), pd.Index(measures)),
+        'Value': values.ravel(),
+    })
+
+
+def melt_measures(df, country, sep='_'):
+    """Return the long-format rows (Country, Region, Date, Measure, Value) of a wide frame.
+
+    `df` has a 'Date' column and one column per series named '<Region><sep><Measure>'. Rows are
+    in the order of df.melt(id_vars='Date'); region and measure are split from the column names
+    once per column, not once per row.
+    """
+    columns = [col for col in df.columns if col != 'Date']
+    names = [str(col).split(sep, 1) for col in columns]
+    region_codes, regions = pd.factorize(pd.Index([name[0] for name in names]))
+    measure_codes, measures = pd.factorize(pd.Index([name[1] if len(name) > 1 else None for name in names]))
+
+    n_dates = len(df)
+    return pd.DataFrame({
+        'Country': pd.Categorical.from_codes(np.zeros(n_dates * len(columns), dtype=np.int8), [country]),
+        'Region': pd.Categorical.from_codes(np.repeat(region_codes, n_dates), regions),
+        'Date': np.tile(df['Date'].to_numpy(), len(columns)),
+        'Measure': pd.Categorical.from_codes(np.repeat(measure_codes, n_dates), measures),
+        'Value': df[columns].to_numpy(dtype=float).T.ravel(),
+    })
+
+
+def concat_long(frames):
+    """Concatenate long-format frames, keeping Country, Region and Measure categorical."""
+    frames = list(frames)
+    for col in CATEGORIES:
+        categories = pd.api.types.union_categoricals([pd.Categorical(frame[col]) for frame in frames]).categories
+        frames = [frame.assign(**{col: pd.Categorical(frame[col], categories=categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)[COLUMNS]
+
+
+def write_csv(df, path, chunk_rows=CHUNK_ROWS):
+    """Write `df` like df.to_csv(path, index=False), converting `chunk_rows` rows to text at a time."""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            df.iloc[start:start + chunk_rows].to_csv(f, index=False, header=start == 0)
+
+
+def write_json(df, path, chunk_rows=CHUNK_ROWS):
+    """Write `df` like df.to_json(path, orient='records'), converting `chunk_rows` rows to text at a time."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for start in range(0, len(df), chunk_rows):
+            records = df.iloc[start:start + chunk_rows].to_json(orient='records')
+            if start:
+                f.write(',')
+            f.write(records[1:-1])
+        f.write(']')
+
+
+@timed('write outputs')
+def write_outputs(df, name):
+    """Save the long-format rows of a country as `name`_cleaned.csv/.json, in the Parquet dataset and as shards."""
+    write_csv(df, f'{name}_cleaned.csv')
+    write_json(df, f'{name}_cleaned.json')
+
+    # Parquet dataset of all countries, partitioned by country and measure
+    write_country(df)
+
+    # Per-region columnar shards and manifest for the dashboard
+    write_shards(df)
@@ -0,0 +1,98 @@
+# Purpose: Resume the deconvolution of the previous daily run so that only new or revised days are recomputed
+import os
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from pipeline.deconvolution import DEFAULT_METHOD, deconvolve_frame
+from pipeline.timing import timed
+
+
+def load_state(state_path):
+    """Return the deconvolution state saved by the previous run, or None if there is none."""
+    if not os.path.exists(state_path):
+        return None
+    with np.load(state_path, allow_pickle=False) as state:
+        return {key: state[key] for key in state.files}
+
+
+def save_state(state_path, index, sites, starts, kernel, inputs, infections):
+    """Save the inputs and estimated infections of every site so the next run can resume from them."""
+    directory = os.path.dirname(state_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    np.savez(state_path, index=index, sites=sites, starts=starts, kernel=kernel,
+             inputs=inputs, infections=infections)
+
+
+def _filter_state(past, kernel):
+    # Initial conditions of lfilter([1], kernel) given the last len(kernel) - 1 outputs
+    # (oldest first), i.e. the state the filter had after producing them
+    a = kernel / kernel[0]
+    order = len(kernel) - 1
+    zi = np.zeros((order,) + past.shape[1:])
+    for m in range(order):
+        for k in range(m + 1, order + 1):
+            zi[m] -= a[k] * past[order - k + m]
+    return zi
+
+
+def _first_revised_row(old, new):
+    # First row where a site's input differs from the saved one (len(old) if none does)
+    same = (old == new) | (np.isnan(old) & np.isnan(new))
+    revised = ~same
+    return np.where(revised.any(axis=0), revised.argmax(axis=0), len(old))
+
+
+@timed('deconvolution')
+def deconvolve_frame_incremental(ww, columns, kernel, state_path, start=None, suffix='_new_inf_total'):
+    """Same as deconvolve_frame, but only recomputes the days that are new or revised since the last run.
+
+    The inputs and infections of every site are kept in `state_path`. A site is recomputed from
+    the first day whose input changed, resuming the filter from the infections of the days
+    before it; unchanged sites only process the appended days. A different kernel, start day or
+    date range than the saved one triggers a full recompute. The state is only used with the
+    'recursive' method.
+    """
+    if DEFAULT_METHOD != 'recursive':
+        return deconvolve_frame(ww, columns, kernel, start=start, suffix=suffix)
+
+    columns = list(columns)
+    kernel = np.asarray(kernel, dtype=float)
+    signal = ww[columns].to_numpy(dtype=float)
+    index = np.asarray(ww.index.astype(str), dtype=str)
+    sites = np.asarray([str(col) for col in columns], dtype=str)
+    order = len(kernel) - 1
+
+    if start is None:
+        start = order
+    starts = np.broadcast_to(np.asarray(start, dtype=int), (len(columns),)).copy()
+
+    # Without usable state every site is recomputed from its start day
+    resume = starts.copy()
+    infections = np.zeros_like(signal)
+
+    state = load_state(state_path)
+    n_old = 0 if state is None else len(state['index'])
+    if (state is not None and np.array_equal(state['kernel'], kernel) and n_old <= len(index)
+            and np.array_equal(state['index'], index[:n_old])):
+        saved = {site: k for k, site in enumerate(state['sites'])}
+        cols = np.asarray([j for j, site in enumerate(sites) if site in saved and state['starts'][saved[site]] == starts[j]], dtype=int)
+        if len(cols):
+            old = np.asarray([saved[site] for site in sites[cols]], dtype=int)
+            first = _first_revised_row(state['inputs'][:, old], signal[:n_old, cols])
+            resume[cols] = np.maximum(first, starts[cols])
+            infections[:n_old, cols] = state['infections'][:, old]
+
+    # Resume all sites that share a first recomputed day in a single call
+    for r in np.unique(resume):
+        cols = np.flatnonzero(resume == r)
+        if r >= len(signal):
+            continue
+        past = np.zeros((order, len(cols)))
+        window = infections[max(r - order, 0):r, cols]
+        past[order - len(window):] = window
+        infections[r:, cols], _ = lfilter([1.0], kernel, signal[r:, cols], axis=0, zi=_filter_state(past, kernel))
+
+    save_state(state_path, index, sites, starts, kernel, signal, infections)
+    return pd.DataFrame(infections, index=ww.index, columns=[site + suffix for site in sites])
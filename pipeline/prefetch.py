@@ -0,0 +1,150 @@
+# Purpose: Download the remote inputs of all pipelines at once, a few connections per host, before the pipelines read them
+#
+# Usage: python -m pipeline.prefetch [Canada Finland ...] [--per-host N] [--retries N]
+#
+# The downloads go through pipeline.fetch (URLs) and pipeline.socrata (Socrata datasets), which stream every
+# body to the local cache; the pipelines then read their inputs from that cache.
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+from pipeline import fetch, socrata
+
+# Prefix of the Socrata datasets in SOURCES
+SOCRATA = 'socrata:'
+
+# Remote inputs of every pipeline (the directory of its script): URLs read with pipeline.fetch, and
+# Socrata datasets synced with pipeline.socrata
+SOURCES = {
+    'Canada': [
+        'https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Canada/ww_BC_Canada.csv',
+        'https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/FecalSheddingModel.csv',
+    ],
+    'Finland': [
+        'https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/fi_wastewater_data.csv',
+        'https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/data/Finland/FinlandEstimCasesSewersheds.csv',
+    ],
+    'Netherlands': [
+        'https://data.rivm.nl/covid-19/COVID-19_rioolwaterdata.csv',
+    ],
+    'US': [
+        SOCRATA + 'g653-rqe2',
+        SOCRATA + '2ew6-ywp6',
+    ],
+}
+
+# Downloads from one host at a time
+PER_HOST = 4
+
+# Attempts after a failed download, waiting BACKOFF seconds before the first one and twice as long
+# before every next one (with jitter)
+RETRIES = 4
+BACKOFF = 1.0
+
+
+def _host(source):
+    if source.startswith(SOCRATA):
+        return urlsplit(socrata.BASE_URL).netloc
+    return urlsplit(source).netloc
+
+
+def _download(source):
+    # Worker thread: download one source into its cache
+    if source.startswith(SOCRATA):
+        socrata.sync_dataset(source[len(SOCRATA):])
+    else:
+        fetch.fetch(source)
+
+
+def _retryable(error):
+    # Connection problems, timeouts, rate limits and server errors may pass; other errors will not
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+async def _download_with_retries(source, limits, executor, retries, backoff, rng):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    for attempt in range(retries + 1):
+        # The connection slot of the host is only held while downloading, not while waiting to retry
+        async with limits[_host(source)]:
+            try:
+                await loop.run_in_executor(executor, _download, source)
+                return {'source': source, 'status': 'ok', 'attempts': attempt + 1,
+                        'seconds': time.perf_counter() - started, 'error': None}
+            except Exception as e:
+                error = e
+        if attempt == retries or not _retryable(error):
+            break
+        await asyncio.sleep(backoff * 2 ** attempt * (0.5 + rng.random()))
+    return {'source': source, 'status': 'failed', 'attempts': attempt + 1, 'seconds': time.perf_counter() - started,
+            'error': f'{type(error).__name__}: {error}'}
+
+
+async def prefetch_async(sources, per_host=PER_HOST, retries=RETRIES, backoff=BACKOFF, on_done=None):
+    """Download all `sources` concurrently, at most `per_host` at a time from one host.
+
+    Failed downloads are retried with exponential backoff when the error may pass. `on_done` is
+    called with the result of every source as soon as it is known. Returns the results in the
+    order of `sources`: dicts with the source, 'ok' or 'failed', the attempts, seconds and error.
+    """
+    sources = list(dict.fromkeys(sources))
+    if not sources:
+        return []
+    limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+    rng = random.Random()
+    # The downloads themselves are blocking calls that stream to disk, run on one thread each
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        tasks = [asyncio.ensure_future(_download_with_retries(source, limits, executor, retries, backoff, rng))
+                 for source in sources]
+        for done in asyncio.as_completed(tasks):
+            result = await done
+            if on_done is not None:
+                on_done(result)
+    return [task.result() for task in tasks]
+
+
+def prefetch(sources, **options):
+    """Blocking version of `prefetch_async`."""
+    return asyncio.run(prefetch_async(sources, **options))
+
+
+def pipeline_sources(names):
+    """Sources of the named pipelines, each once."""
+    return list(dict.fromkeys(source for name in names for source in SOURCES.get(name, [])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download the remote inputs of the pipelines concurrently.')
+    parser.add_argument('pipelines', nargs='*', help='Pipelines whose inputs are downloaded (default: all of them)')
+    parser.add_argument('--per-host', type=int, default=PER_HOST, help='Downloads from one host at a time')
+    parser.add_argument('--retries', type=int, default=RETRIES, help='Attempts after a failed download')
+    args = parser.parse_args(argv)
+
+    unknown = sorted(set(args.pipelines) - set(SOURCES))
+    if unknown:
+        parser.error(f"unknown pipelines: {', '.join(unknown)} (available: {', '.join(SOURCES)})")
+
+    def report(result):
+        print(f"{result['source']}: {result['status']} in {result['seconds']:.1f} s"
+              + (f" ({result['error']})" if result['error'] else ''), flush=True)
+
+    started = time.perf_counter()
+    results = prefetch(pipeline_sources(args.pipelines or SOURCES), per_host=args.per_host, retries=args.retries,
+                       on_done=report)
+    print(f'{len(results)} sources in {time.perf_counter() - started:.1f} s')
+    return 0 if all(result['status'] == 'ok' for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
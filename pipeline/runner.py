@@ -0,0 +1,255 @@
+# Purpose: Run all country pipelines concurrently in one invocation and summarize where the time went
+#
+# Usage: python -m pipeline.runner [Canada Finland ...] [--jobs N] [--timeout SECONDS] [--max-age SECONDS] [--replay]
+#                                  [--no-prefetch] [--fail-on-error]
+#
+# A pipeline that fails or times out is reported in the summary and does not stop the others. The exit status is
+# 0 unless --fail-on-error is given and a pipeline did not succeed.
+import argparse
+import glob
+import multiprocessing
+import os
+import runpy
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from pipeline import fetch, prefetch, timing
+from pipeline.deconvolution import load_shedding_kernel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Every country directory with a script matching this pattern is a pipeline
+SCRIPT_PATTERN = '*/*_estimate_infections.py'
+
+# Fecal shedding models read by the pipelines, loaded once before they start
+SHEDDING_MODELS = [
+    'FecalSheddingModel.csv',
+    'https://raw.githubusercontent.com/necsi/WHN-Wastewater-Data/main/FecalSheddingModel.csv',
+]
+
+# Seconds after which a pipeline is stopped
+DEFAULT_TIMEOUT = 3600
+
+# Seconds during which the pipelines use the inputs prefetched by the runner without asking the servers again,
+# unless FETCH_MAX_AGE is set
+DEFAULT_MAX_AGE = 3600
+
+
+def discover(root=ROOT):
+    """Return {country directory: script path} of the pipelines in `root`."""
+    scripts = sorted(glob.glob(os.path.join(root, SCRIPT_PATTERN)))
+    return {os.path.basename(os.path.dirname(path)): path for path in scripts}
+
+
+def load_shared_inputs(remote=True):
+    """Load the inputs used by several pipelines into the caches of this process (only local files unless `remote`)."""
+    for path in SHEDDING_MODELS:
+        if not remote and fetch.is_url(path):
+            continue
+        try:
+            load_shedding_kernel(path)
+        except Exception as e:
+            # The pipeline that needs it reads it again and fails on its own
+            print(f'Could not load {path}: {e}', file=sys.stderr)
+
+
+def _run_script(path, connection):
+    # Worker process: run a country script as if started with `python <script>` from the repository root
+    timing.TIMINGS.clear()
+    sys.argv = [path]
+    try:
+        runpy.run_path(path, run_name='__main__')
+        connection.send(('ok', dict(timing.TIMINGS), None))
+    except BaseException:
+        connection.send(('failed', dict(timing.TIMINGS), traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def _prefetch_sources(sources, connection):
+    # Worker process: download the sources, sending the result of every source as soon as it is known.
+    # The downloads always revalidate, also when the pipelines are told not to.
+    fetch.MAX_AGE = 0
+    try:
+        prefetch.prefetch(sources, on_done=connection.send)
+    finally:
+        connection.close()
+
+
+def _context():
+    # Forked workers inherit the shared inputs loaded by the parent; elsewhere each worker reloads them
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def run_pipelines(names=None, jobs=None, timeout=DEFAULT_TIMEOUT, prefetch_inputs=True):
+    """Run the named pipelines (all if None), at most `jobs` at a time, each in its own process.
+
+    With `prefetch_inputs`, the remote inputs of all pipelines (prefetch.SOURCES) are downloaded
+    at once by a separate process, and every pipeline starts as soon as its own inputs are in
+    the cache. A pipeline whose download failed still starts, and tries again itself.
+
+    Returns {name: {'status', 'seconds', 'stages', 'error'}}, where status is 'ok', 'failed' or
+    'timeout' and stages holds the seconds of the stages of pipeline.timing (downloading, reading
+    inputs, pivoting, deconvolving, aggregating and writing outputs).
+    """
+    scripts = discover()
+    names = list(names or scripts)
+    unknown = [name for name in names if name not in scripts]
+    if unknown:
+        raise ValueError(f"Unknown pipelines: {', '.join(unknown)} (available: {', '.join(scripts)})")
+    jobs = jobs or os.cpu_count() or 1
+
+    os.chdir(ROOT)
+    context = _context()
+    pending = list(names)
+    running = {}
+    results = {}
+
+    # Sources each pipeline still waits for, while the downloader process runs
+    waiting = {}
+    downloads = None
+    sources = prefetch.pipeline_sources(names) if prefetch_inputs else []
+    if sources:
+        waiting = {name: set(prefetch.SOURCES.get(name, [])) for name in names}
+        downloads, sender = context.Pipe(duplex=False)
+        downloader = context.Process(target=_prefetch_sources, args=(sources, sender), name='prefetch')
+        downloader.start()
+        sender.close()
+
+    while pending or running:
+        while len(running) < jobs:
+            ready = [name for name in pending if not waiting.get(name)]
+            if not ready:
+                break
+            name = ready[0]
+            pending.remove(name)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_script, args=(scripts[name], sender), name=name)
+            process.start()
+            sender.close()
+            running[name] = (process, receiver, time.perf_counter())
+
+        # Wake up when a pipeline finishes, a download lands or the earliest deadline passes
+        connections = [receiver for _, receiver, _ in running.values()]
+        if downloads is not None:
+            connections.append(downloads)
+        next_deadline = min((started + timeout for _, _, started in running.values()), default=None)
+        wait(connections, timeout=None if next_deadline is None else max(0.0, next_deadline - time.perf_counter()))
+
+        while downloads is not None and downloads.poll():
+            try:
+                download = downloads.recv()
+            except EOFError:
+                # All downloads are done; any pipeline still waiting downloads its inputs itself
+                downloads.close()
+                downloads = None
+                downloader.join()
+                waiting.clear()
+                break
+            error = f" ({download['error']})" if download['error'] else ''
+            print(f"{download['source']}: {download['status']} in {download['seconds']:.1f} s{error}", flush=True)
+            for missing in waiting.values():
+                missing.discard(download['source'])
+
+        for name, (process, receiver, started) in list(running.items()):
+            seconds = time.perf_counter() - started
+            if receiver.poll():
+                try:
+                    status, stages, error = receiver.recv()
+                except EOFError:
+                    status, stages, error = 'failed', {}, None
+                process.join()
+                if error is None and status == 'failed':
+                    error = f'exited with code {process.exitcode}'
+            elif seconds >= timeout:
+                process.terminate()
+                process.join()
+                status, stages, error = 'timeout', {}, f'stopped after {timeout:.0f} s'
+            else:
+                continue
+            receiver.close()
+            results[name] = {'status': status, 'seconds': seconds, 'stages': stages, 'error': error}
+            del running[name]
+            print(f'{name}: {status} in {seconds:.1f} s', flush=True)
+    return results
+
+
+def format_summary(results, shared_seconds, total_seconds):
+    """Table of the wall time per pipeline and stage."""
+    stages = sorted({stage for result in results.values() for stage in result['stages']})
+    header = ['pipeline', 'status', 'total'] + stages + ['other']
+    rows = []
+    for name, result in results.items():
+        other = result['seconds'] - sum(result['stages'].values())
+        rows.append([name, result['status'], f"{result['seconds']:.1f}"]
+                    + [f"{result['stages'][stage]:.1f}" if stage in result['stages'] else '-' for stage in stages]
+                    + [f'{other:.1f}'])
+    rows.append(['shared inputs', 'ok', f'{shared_seconds:.1f}'] + ['-'] * (len(stages) + 1))
+    rows.append(['all', '', f'{total_seconds:.1f}'] + [''] * (len(stages) + 1))
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(cell.ljust(width) if i < 2 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths)))
+             for row in [header] + rows]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the country pipelines concurrently.')
+    parser.add_argument('pipelines', nargs='*', help='Pipelines to run (default: all of them)')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of pipelines run at once (default: number of CPUs)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Seconds after which a pipeline is stopped')
+    parser.add_argument('--max-age', type=float, default=fetch.MAX_AGE or DEFAULT_MAX_AGE,
+                        help='Seconds during which the pipelines use prefetched inputs without revalidating them '
+                             f'(default: FETCH_MAX_AGE or {DEFAULT_MAX_AGE:.0f})')
+    parser.add_argument('--list', action='store_true', help='List the pipelines and exit')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help='Let every pipeline download its inputs itself when it starts, instead of all at once')
+    parser.add_argument('--replay', action='store_true',
+                        help='Read the remote inputs from the responses cached by earlier runs, without network access')
+    parser.add_argument('--fail-on-error', action='store_true',
+                        help='Exit with status 1 if a pipeline failed or timed out (the others still run)')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, path in discover().items():
+            print(f'{name}: {os.path.relpath(path, ROOT)}')
+        return 0
+
+    unknown = sorted(set(args.pipelines) - set(discover()))
+    if unknown:
+        parser.error(f"unknown pipelines: {', '.join(unknown)}")
+
+    if args.replay:
+        # Also for pipelines started in a fresh interpreter instead of forked
+        os.environ['FETCH_MODE'] = fetch.DEFAULT_MODE = 'replay'
+
+    prefetch_inputs = not args.no_prefetch and fetch.DEFAULT_MODE != 'replay'
+    if prefetch_inputs:
+        # The pipelines use the inputs downloaded for this run without asking the servers again
+        os.environ['FETCH_MAX_AGE'] = str(args.max_age)
+        fetch.MAX_AGE = args.max_age
+
+    started = time.perf_counter()
+    os.chdir(ROOT)
+    # Remote inputs are downloaded with the others when prefetching, and read by the pipelines that use them
+    load_shared_inputs(remote=not prefetch_inputs)
+    shared_seconds = time.perf_counter() - started
+    results = run_pipelines(args.pipelines, jobs=args.jobs, timeout=args.timeout, prefetch_inputs=prefetch_inputs)
+    total_seconds = time.perf_counter() - started
+
+    for name, result in results.items():
+        if result['error']:
+            print(f'\n{name} {result["status"]}:\n{result["error"]}', file=sys.stderr)
+    print()
+    print(format_summary(results, shared_seconds, total_seconds))
+    failed = [name for name, result in results.items() if result['status'] != 'ok']
+    if failed:
+        print(f"\nNot updated: {', '.join(failed)}")
+    return 1 if failed and args.fail_on_error else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+# Purpose: SEIRV model of SARS-CoV-2 infections and viral RNA in wastewater, and fitting of its parameters
+import math
+import multiprocessing
+import os
+
+import numpy as np
+from scipy.integrate import odeint, solve_ivp
+from scipy.optimize import OptimizeResult, minimize
+
+# Rates of movement from E to I and from I to R (inverse durations of incubation and infectiousness)
+SIGMA = 1 / 3
+GAMMA = 1 / 8
+
+# Travel time of the wastewater to the treatment plant in hours
+TRAVEL_TIME = 18
+
+# Temperature model of the decay of viral RNA in the sewer
+TAU0 = 189.6
+Q0 = 2.5
+T0 = 20
+A = 3.624836409841919
+B = 0.020222716119084
+C = 4.466530666828714
+D = 16.229757918464635
+
+# Bounds of (lambda_, alpha, beta, E0)
+PARAM_BOUNDS = [(0, 1E-4), (51, 796), (4.48526e7, 4.48526e7), (10, 5000)]
+
+
+def get_decay(t):
+    """Temperature-adjusted decay rate of viral RNA on day `t`."""
+    T = A * np.sin(B * t - C) + D
+    tau = TAU0 * Q0 ** (-(T - T0) / 10)
+    return np.log(2) / tau
+
+
+def get_eta(t):
+    """Fraction of viruses lost during the travel time on day `t`."""
+    return 1 - np.exp(-get_decay(t) * TRAVEL_TIME)
+
+
+# 1 - get_eta(t) = exp(-_K * exp(_L * (T - T0))), with T the temperature of day t
+_K = TRAVEL_TIME * math.log(2) / TAU0
+_L = math.log(Q0) / 10
+
+
+def _survival(t):
+    # 1 - get_eta(t) of a single day with math instead of numpy, called on every step of the solvers
+    return math.exp(-_K * math.exp(_L * (A * math.sin(B * t - C) + D - T0)))
+
+
+# Fraction of viruses that survive the travel time, at the temperature of day 1
+ETA = get_eta(1)
+
+# Solvers of simulate_seirv_model: odeint (LSODA of ODEPACK) or a method of solve_ivp
+METHODS = ['odeint', 'LSODA', 'BDF', 'Radau']
+
+# Tolerances of the solvers; the objective compares log10 values, so mostly the relative error matters
+RTOL = 1e-8
+ATOL = 1e-6
+
+# Fixed RK4 steps per day of the batched simulator, and the finest steps used for the vectors
+# whose solution is unstable with fewer (fast epidemics, e.g. lambda_ * N0 of 100 per day)
+SUBSTEPS = 8
+MAX_SUBSTEPS = 2048
+
+# Parameter vectors integrated together by sse_batch, bounding the memory of the solutions
+BATCH_SIZE = 4096
+
+
+def seirv_rhs(t, y, lambda_, alpha, beta, eta=ETA):
+    """Derivatives of the state `y` on day `t`, in the argument order of solve_ivp.
+
+    `y` is one state or a (6 x k) array of k states (solve_ivp with vectorized=True). With `eta`
+    None, the decay of the virus follows the temperature of day `t` (get_eta).
+    """
+    # Python floats are faster than numpy scalars for a single state
+    S, E, I = y[:3].tolist() if y.ndim == 1 else (y[0], y[1], y[2])
+    survival = _survival(t) if eta is None else 1 - eta
+    infections = lambda_ * S * I
+    return np.array([-infections, infections - SIGMA * E, SIGMA * E - GAMMA * I, GAMMA * I,
+                     alpha * beta * survival * I, infections])
+
+
+def seirv_jacobian(t, y, lambda_, alpha, beta, eta=ETA):
+    """Analytic Jacobian of seirv_rhs with respect to the state, a (6 x 6) array."""
+    S, I = y[0], y[2]
+    survival = _survival(t) if eta is None else 1 - eta
+    jac = np.zeros((6, 6))
+    jac[0, 0], jac[0, 2] = -lambda_ * I, -lambda_ * S
+    jac[1, 0], jac[1, 1], jac[1, 2] = lambda_ * I, -SIGMA, lambda_ * S
+    jac[2, 1], jac[2, 2] = SIGMA, -GAMMA
+    jac[3, 2] = GAMMA
+    jac[4, 2] = alpha * beta * survival
+    jac[5, 0], jac[5, 2] = lambda_ * I, lambda_ * S
+    return jac
+
+
+def initial_state(param, V0, N0, eta=ETA):
+    """State (S, E, I, R, V, E_cumulative) on the first day, with I0 such that the model sheds V0."""
+    lambda_, alpha, beta, E0 = param
+    I0 = V0 / (alpha * beta * (1 - eta))
+    R0 = 0
+    S0 = N0 - (E0 + I0 + R0)
+    return [S0, E0, I0, R0, V0, E0]
+
+
+def simulate_seirv_model(param, tspan, V0, N0, method='odeint', time_varying=False, rtol=RTOL, atol=ATOL, y0=None):
+    """Solution of the model on the days `tspan`, one row per day.
+
+    `method` is one of METHODS; all of them use the analytic Jacobian. With `time_varying`, the
+    decay of the virus in the sewer follows the temperature of every day instead of day 1.
+    The solution starts from the state `y0` if given (e.g. carried over from an earlier fit),
+    with its exposed and infectious compartments scaled to E0 exposed, and from initial_state
+    otherwise.
+    """
+    lambda_, alpha, beta, E0 = param
+    eta = None if time_varying else ETA
+    if y0 is None:
+        y0 = initial_state(param, V0, N0, get_eta(tspan[0]) if time_varying else ETA)
+    elif y0[1] > 0 and E0 != y0[1]:
+        S, E, I, R, V, E_cumulative = y0
+        ratio = E0 / E
+        y0 = [S - (ratio - 1) * (E + I), E0, ratio * I, R, V, E_cumulative]
+    args = (lambda_, alpha, beta, eta)
+    if method == 'odeint':
+        return odeint(seirv_rhs, y0, tspan, args=args, Dfun=seirv_jacobian, tfirst=True, rtol=rtol, atol=atol)
+    if method not in METHODS:
+        raise ValueError(f'Unknown method {method}, expected one of {METHODS}')
+    sol = solve_ivp(seirv_rhs, (tspan[0], tspan[-1]), y0, method=method, t_eval=tspan, args=args,
+                    jac=seirv_jacobian, vectorized=True, rtol=rtol, atol=atol)
+    if not sol.success:
+        # Same shape as a successful run, so that the objective of the parameters is NaN/inf
+        return np.full((len(tspan), len(y0)), np.nan)
+    return sol.y.T
+
+
+def sse_obj_func(param, tspan, data, N0, method='odeint', time_varying=False, y0=None):
+    """Sum of squared differences between the log10 daily virus of the model and of `data`."""
+    sol = simulate_seirv_model(param, tspan, data[0], N0, method, time_varying, y0=y0)
+    cumVirus = sol[:, 4]
+    if not np.all(np.isfinite(cumVirus)):
+        # The solver failed for these parameters
+        return np.inf
+    dailyVirus = np.diff(cumVirus)
+    temp = np.log10(data[1:]) - np.log10(np.abs(dailyVirus))
+    adiff = temp[~np.isnan(temp)]
+    return np.sum(adiff ** 2)
+
+
+def simulate_batch(params, tspan, V0, N0, substeps=SUBSTEPS, time_varying=False, max_substeps=MAX_SUBSTEPS):
+    """Solutions of the model for a batch of parameter vectors at once.
+
+    `params` is an (n x 4) array of (lambda_, alpha, beta, E0). A fixed-step RK4 integrator
+    advances the (6 x n) states of all vectors together with seirv_rhs, taking `substeps` steps
+    between consecutive days of `tspan`. The vectors whose state turns negative or infinite on a
+    day take that day again with 4 times more steps, up to `max_substeps`. Returns a
+    (days x n x 6) array whose [:, k] matches simulate_seirv_model(params[k], ...); solutions
+    that remain unstable hold NaN.
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    tspan = np.asarray(tspan, dtype=float)
+    lambda_, alpha, beta, E0 = params.T
+    eta = None if time_varying else ETA
+    y = np.array(np.broadcast_arrays(*initial_state(params.T, V0, N0, get_eta(tspan[0]) if time_varying else ETA)))
+
+    sol = np.empty((len(tspan), len(params), 6))
+    sol[0] = y.T
+    with np.errstate(over='ignore', invalid='ignore'):
+        for day in range(1, len(tspan)):
+            t0, t1 = tspan[day - 1], tspan[day]
+            y_next = _rk4(y, t0, t1, substeps, (lambda_, alpha, beta, eta))
+            unstable = ~np.all(y_next >= 0, axis=0)
+            finer = substeps
+            while unstable.any() and finer < max_substeps:
+                finer = min(4 * finer, max_substeps)
+                y_next[:, unstable] = _rk4(y[:, unstable], t0, t1, finer,
+                                           (lambda_[unstable], alpha[unstable], beta[unstable], eta))
+                unstable = ~np.all(y_next >= 0, axis=0)
+            y_next[:, unstable] = np.nan
+            sol[day] = y_next.T
+            y = y_next
+    return sol
+
+
+def _rk4(y, t0, t1, substeps, args):
+    # Advance the (6 x n) states `y` from t0 to t1 with `substeps` RK4 steps
+    h = (t1 - t0) / substeps
+    t = t0
+    for step in range(substeps):
+        k1 = seirv_rhs(t, y, *args)
+        k2 = seirv_rhs(t + h / 2, y + h / 2 * k1, *args)
+        k3 = seirv_rhs(t + h / 2, y + h / 2 * k2, *args)
+        k4 = seirv_rhs(t + h, y + h * k3, *args)
+        y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        t += h
+    return y
+
+
+def sse_batch(params, tspan, data, N0, substeps=SUBSTEPS, time_varying=False, batch_size=BATCH_SIZE):
+    """sse_obj_func of many parameter vectors with one batched simulation per `batch_size` vectors.
+
+    `params` is an (... x 4) array, e.g. a grid of (lambda_, alpha, beta, E0) over two
+    parameters; returns the objective values as an array of shape (...).
+    """
+    params = np.asarray(params, dtype=float)
+    flat = params.reshape(-1, 4)
+    sse = np.empty(len(flat))
+    observed = np.log10(data[1:])[:, None]
+    for first in range(0, len(flat), batch_size):
+        cumVirus = simulate_batch(flat[first:first + batch_size], tspan, data[0], N0, substeps, time_varying)[:, :, 4]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temp = observed - np.log10(np.abs(np.diff(cumVirus, axis=0)))
+        # Days without data do not count, solutions that blew up are infinitely bad
+        total = np.where(np.isnan(temp), 0, temp ** 2).sum(axis=0)
+        total[~np.all(np.isfinite(cumVirus), axis=0)] = np.inf
+        sse[first:first + batch_size] = total
+    return sse.reshape(params.shape[:-1])
+
+
+def _process_context():
+    # Forked workers start without re-importing the calling script
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def _local_fit(args):
+    # One L-BFGS-B search from x0, run in a worker process. It runs on the parameters scaled to
+    # [0, 1] within their bounds: lambda_ (about 1e-7) and E0 (about 1e3) are too far apart for
+    # one finite-difference step size
+    x0, tspan, data, N0, bounds, method, time_varying, y0 = args
+    low = np.array([b[0] for b in bounds], dtype=float)
+    width = np.array([b[1] for b in bounds], dtype=float) - low
+    fixed = width == 0
+    width[fixed] = 1
+    res = minimize(lambda u: sse_obj_func(low + u * width, tspan, data, N0, method, time_varying, y0),
+                   (np.asarray(x0) - low) / width, method='L-BFGS-B', bounds=[(0, 0) if f else (0, 1) for f in fixed])
+    return low + res.x * width, float(res.fun)
+
+
+def multi_start_fit(tspan, data, N0, bounds=PARAM_BOUNDS, max_starts=256, round_size=16, processes=None, seed=0,
+                    patience=3, tol=1e-6, local_fraction=0.5, local_scale=0.1, screen=1, method='odeint',
+                    time_varying=False):
+    """Fit the parameters with independent L-BFGS-B searches started in parallel.
+
+    Starts run in rounds of `round_size` starts, spread over `processes` worker processes (all
+    cores by default). After every round, the best solution so far is shared with the next
+    round: a `local_fraction` of its starts are drawn around it (with a standard deviation of
+    `local_scale` times the width of the bounds), the others uniformly within the bounds. With
+    `screen` above 1, every uniform start is the best of `screen` uniform draws, all of them
+    evaluated with a single sse_batch call per round.
+
+    The search stops after `max_starts` starts, or once the best objective improved by less than
+    a relative `tol` over `patience` rounds. Every start has its own seed derived from `seed`,
+    so the result does not depend on the number or speed of the processes.
+
+    `method` and `time_varying` are passed on to simulate_seirv_model.
+
+    Returns an OptimizeResult with the best `x` and `fun`, and `optima_x` and `optima_fun` of
+    every start.
+    """
+    processes = processes or os.cpu_count() or 1
+    low = np.array([b[0] for b in bounds], dtype=float)
+    high = np.array([b[1] for b in bounds], dtype=float)
+    seeds = np.random.SeedSequence(seed).spawn(max_starts)
+
+    optima_x, optima_fun = [], []
+    best_x, best_fun = None, np.inf
+    stalled = 0
+    with _process_context().Pool(processes) as pool:
+        for first in range(0, max_starts, round_size):
+            x0s, draws = [], {}
+            for k, start_seed in enumerate(seeds[first:first + round_size]):
+                rng = np.random.default_rng(start_seed)
+                if best_x is not None and k < local_fraction * round_size:
+                    x0s.append(np.clip(best_x + rng.normal(0, local_scale, len(low)) * (high - low), low, high))
+                elif screen > 1:
+                    x0s.append(None)
+                    draws[k] = rng.uniform(low, high, (screen, len(low)))
+                else:
+                    x0s.append(rng.uniform(low, high))
+            if draws:
+                sse = sse_batch(np.stack(list(draws.values())), tspan, data, N0, time_varying=time_varying)
+                for (k, candidates), values in zip(draws.items(), sse):
+                    x0s[k] = candidates[np.argmin(values)]
+            starts = [(x0, tspan, data, N0, bounds, method, time_varying, None) for x0 in x0s]
+
+            previous = best_fun
+            for x, fun in pool.map(_local_fit, starts):
+                optima_x.append(x)
+                optima_fun.append(fun)
+                if fun < best_fun:
+                    best_x, best_fun = x, fun
+
+            # Stop once the best objective stalls
+            if np.isfinite(previous) and previous - best_fun <= tol * abs(previous):
+                stalled += 1
+                if stalled >= patience:
+                    break
+            else:
+                stalled = 0
+
+    optima_fun = np.asarray(optima_fun)
+    return OptimizeResult(x=best_x, fun=best_fun, nstarts=len(optima_fun), success=best_x is not None,
+                          optima_x=np.asarray(optima_x), optima_fun=optima_fun)
+
+
+def screened_fit(tspan, data, N0, bounds=PARAM_BOUNDS, screen=512, starts=4, seed=0, method='odeint',
+                 time_varying=False):
+    """Fit the parameters in the calling process, from the best of many uniform draws.
+
+    The `screen` draws are evaluated with one sse_batch call, and L-BFGS-B searches start from the
+    `starts` best of them. Meant for fitting many series at once, one series per process, where
+    multi_start_fit would spread a single series over the processes.
+
+    Returns an OptimizeResult like multi_start_fit.
+    """
+    low = np.array([b[0] for b in bounds], dtype=float)
+    high = np.array([b[1] for b in bounds], dtype=float)
+    draws = np.random.default_rng(seed).uniform(low, high, (screen, len(low)))
+    sse = sse_batch(draws, tspan, data, N0, time_varying=time_varying)
+    optima = [_local_fit((x0, tspan, data, N0, bounds, method, time_varying, None)) for x0 in draws[np.argsort(sse)[:starts]]]
+
+    optima_x = np.array([x for x, _ in optima])
+    optima_fun = np.array([fun for _, fun in optima])
+    best = np.argmin(optima_fun)
+    return OptimizeResult(x=optima_x[best], fun=optima_fun[best], nstarts=len(optima), success=np.isfinite(optima_fun[best]),
+                          optima_x=optima_x, optima_fun=optima_fun)
@@ -0,0 +1,195 @@
+# Purpose: Fit the SEIRV model to the wastewater of every US sewershed, spread over local worker processes with checkpoints
+#
+# Usage: python -m pipeline.seirv_fleet [--days 78] [--end YYYY-MM-DD] [--processes N] [key_plot_id ...]
+#
+# Reads the daily gene copies and population served of every sewershed saved by US/us_estimate_infections.py.
+# Every fitted sewershed is appended to the checkpoint as soon as it is done, so an interrupted run resumes
+# with the sewersheds that are left.
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from pipeline.seirv import PARAM_BOUNDS, screened_fit
+from pipeline.series import SiteSeries
+
+# Written by the US pipeline
+SITES_PATH = '.cache/us_sites.npz'
+
+# One JSON line per fitted sewershed
+CHECKPOINT_PATH = '.cache/seirv_fleet_checkpoint.jsonl'
+
+OUTPUT_PATH = 'United_States_SEIRV_parameters.csv'
+
+# Population served by the DITP plant, for which PARAM_BOUNDS were chosen
+DITP_POPULATION = 2300000
+
+# Fewest samples with a positive gene copy value in the window for a sewershed to be fitted
+MIN_SAMPLES = 12
+
+PARAMETERS = ['lambda_', 'alpha', 'beta', 'E0']
+
+
+def site_bounds(N0, bounds=PARAM_BOUNDS):
+    """Bounds of (lambda_, alpha, beta, E0) for a sewershed serving N0 people.
+
+    The transmission rate per person and the initial exposed population of PARAM_BOUNDS are
+    scaled from the population of the DITP plant to N0, so that lambda_ * N0 and E0 / N0 keep
+    the same range.
+    """
+    scale = N0 / DITP_POPULATION
+    (lambda_low, lambda_high), alpha, beta, (E0_low, E0_high) = bounds
+    return [(lambda_low / scale, lambda_high / scale), alpha, beta, (E0_low * scale, E0_high * scale)]
+
+
+def site_windows(series, days, end=None, min_samples=MIN_SAMPLES):
+    """Yield one fit task per sewershed with enough samples in the `days` days up to `end` (the last date if None).
+
+    A task is a dict with the site, the first and last date, the daily gene copies (NaN on days
+    without a positive value and on the days interpolated between samples, which the objective
+    skips; leading such days removed), the number of samples and N0, the median population served.
+    """
+    last = len(series.dates) - 1 if end is None else series.dates.get_indexer([pd.Timestamp(end)])[0]
+    if last < 0:
+        raise ValueError(f'{end} is not a date of the series')
+    rows = slice(max(last - days + 1, 0), last + 1)
+    # Billion gene copies per day to gene copies per day
+    copies = series['bil_gc'][rows] * 1e9
+    copies[~(copies > 0)] = np.nan
+    if 'sampled' in series:
+        copies[series['sampled'][rows] == 0] = np.nan
+    population = series['population'][rows]
+    dates = series.dates[rows]
+
+    for k, site in enumerate(series.sites):
+        observed = np.flatnonzero(np.isfinite(copies[:, k]))
+        N0 = np.nanmedian(population[:, k]) if np.isfinite(population[:, k]).any() else np.nan
+        if len(observed) < min_samples or not N0 > 0:
+            continue
+        data = copies[observed[0]:, k]
+        yield {'key_plot_id': str(site), 'start': str(dates[observed[0]].date()), 'end': str(dates[-1].date()),
+               'samples': len(observed), 'data': data, 'N0': float(N0)}
+
+
+def _fit_task(task, options):
+    # Worker process: fit one sewershed, returning its row of the parameter table
+    started = time.perf_counter()
+    row = {key: task[key] for key in ('key_plot_id', 'start', 'end', 'samples', 'N0')}
+    row['days'] = len(task['data'])
+    try:
+        # The seed depends on the site only, so a fit gives the same result in any run and order
+        seed = [options['seed'], zlib.crc32(task['key_plot_id'].encode())]
+        res = screened_fit(np.arange(1, len(task['data']) + 1), task['data'], task['N0'], site_bounds(task['N0']),
+                           screen=options['screen'], starts=options['starts'], seed=seed)
+        row.update(dict(zip(PARAMETERS, res.x.tolist())), sse=float(res.fun), status='ok')
+    except Exception:
+        row.update(status='failed', error=traceback.format_exc(limit=3))
+    row['seconds'] = round(time.perf_counter() - started, 3)
+    return row
+
+
+def read_checkpoint(path=CHECKPOINT_PATH):
+    """Rows of the sewersheds fitted so far, {(key_plot_id, start, end, samples): row}.
+
+    A line cut off by an interruption is ignored. Rows of fits that weighted the interpolated days
+    (written before the number of samples was recorded) have no samples, so those sewersheds are
+    fitted again.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[_key(row)] = row
+    return done
+
+
+def _key(task):
+    # Checkpoint key of a task, or of the row of its fit
+    return task['key_plot_id'], task['start'], task['end'], task.get('samples')
+
+
+def _context():
+    # Forked workers start without re-importing numpy and scipy
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def fit_fleet(tasks, checkpoint=CHECKPOINT_PATH, processes=None, screen=512, starts=4, seed=0, retry_failed=False):
+    """Fit every task of site_windows() that is not in the checkpoint yet, `processes` at a time.
+
+    Sewersheds are handed out one at a time to whichever worker is free, longest series first so
+    that the slowest fits do not start last. Each result is appended to `checkpoint` as soon as
+    it arrives. Failed fits are kept in the checkpoint and only run again with `retry_failed`.
+    Returns the parameter table of all tasks, one row per sewershed.
+    """
+    tasks = list(tasks)
+    done = read_checkpoint(checkpoint)
+    keys = [_key(task) for task in tasks]
+    todo = [task for task, key in zip(tasks, keys)
+            if key not in done or (retry_failed and done[key]['status'] != 'ok')]
+    todo.sort(key=lambda task: -len(task['data']))
+    print(f'{len(tasks) - len(todo)} of {len(tasks)} sewersheds already fitted, {len(todo)} to go', flush=True)
+
+    directory = os.path.dirname(checkpoint)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    options = {'screen': screen, 'starts': starts, 'seed': seed}
+    started = time.perf_counter()
+    with open(checkpoint, 'a', encoding='utf-8') as f, _context().Pool(processes or os.cpu_count() or 1) as pool:
+        for n, row in enumerate(pool.imap_unordered(functools.partial(_fit_task, options=options), todo), 1):
+            f.write(json.dumps(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            done[_key(row)] = row
+            if n % 50 == 0 or n == len(todo):
+                elapsed = time.perf_counter() - started
+                left = elapsed / n * (len(todo) - n)
+                print(f'{n}/{len(todo)} fitted in {elapsed:.0f} s, about {left:.0f} s left', flush=True)
+
+    table = pd.DataFrame([done[key] for key in keys])
+    return table.reindex(columns=['key_plot_id', 'start', 'end', 'days', 'samples', 'N0', *PARAMETERS, 'sse', 'status',
+                                  'seconds'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit the SEIRV model to every US sewershed.')
+    parser.add_argument('sites', nargs='*', help='key_plot_id of the sewersheds to fit (default: all)')
+    parser.add_argument('--days', type=int, default=78, help='Length of the fitted window in days')
+    parser.add_argument('--end', help='Last day of the window, YYYY-MM-DD (default: the last day with data)')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--screen', type=int, default=512, help='Uniform draws screened per sewershed')
+    parser.add_argument('--starts', type=int, default=4, help='Local searches per sewershed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--retry-failed', action='store_true', help='Fit the sewersheds that failed in an earlier run again')
+    parser.add_argument('--input', default=SITES_PATH)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--output', default=OUTPUT_PATH)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.input):
+        sys.exit(f'{args.input} not found; run US/us_estimate_infections.py first')
+    tasks = site_windows(SiteSeries.load(args.input), args.days, args.end)
+    if args.sites:
+        sites = set(args.sites)
+        tasks = [task for task in tasks if task['key_plot_id'] in sites]
+    table = fit_fleet(tasks, args.checkpoint, args.processes, args.screen, args.starts, args.seed, args.retry_failed)
+    table.sort_values('key_plot_id').to_csv(args.output, index=False)
+    print(f"{(table['status'] == 'ok').sum()} of {len(table)} sewersheds fitted, parameters in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# Purpose: Sample the posterior of the SEIRV parameters with an ensemble of walkers, and predict daily incidence from the samples
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from pipeline.seirv import PARAM_BOUNDS, _process_context, simulate_batch, sse_batch
+
+PARAMETERS = ['lambda_', 'alpha', 'beta', 'E0']
+CHAIN_COLUMNS = ['step', 'walker', *PARAMETERS, 'log_prob']
+
+# Quantiles of the posterior predictive incidence
+QUANTILES = [0.025, 0.25, 0.5, 0.75, 0.975]
+
+# Scale parameter of the stretch move (Goodman & Weare 2010)
+STRETCH = 2.0
+
+# Fewest new points handed to a worker process. sse_batch costs about as much for one vector as for a thousand
+# (its loop over the days dominates), so the halves of an ordinary ensemble are simulated in a single call.
+MIN_CHUNK = 1024
+
+
+def _sse_chunk(args):
+    # Worker process: objective of a chunk of parameter vectors
+    points, tspan, data, N0, time_varying = args
+    return sse_batch(points, tspan, data, N0, time_varying=time_varying)
+
+
+class Posterior:
+    """Log posterior of (lambda_, alpha, beta, E0) given the daily virus `data`.
+
+    The prior is uniform within `bounds`. The log10 differences between the model and the data
+    are independent Gaussian errors with variance `sigma2`, so the log likelihood is
+    -sse_obj_func / (2 * sigma2). Values are cached by parameter vector, so a point that comes
+    back is not simulated again.
+    """
+
+    def __init__(self, tspan, data, N0, sigma2, bounds=PARAM_BOUNDS, time_varying=False, cache_size=100000):
+        self.tspan, self.data, self.N0, self.sigma2 = tspan, data, N0, sigma2
+        self.low = np.array([b[0] for b in bounds], dtype=float)
+        self.high = np.array([b[1] for b in bounds], dtype=float)
+        self.time_varying = time_varying
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def remember(self, points, log_prob):
+        """Add known log posteriors of the rows of `points` to the cache, e.g. those of a saved chain."""
+        self.cache.update(zip((point.tobytes() for point in np.atleast_2d(points)), log_prob))
+
+    def __call__(self, points, pool=None, chunks=1):
+        """Log posterior of every row of the (n x 4) `points`.
+
+        The new points are simulated in one sse_batch call, or in up to `chunks` calls on `pool`
+        when there are at least MIN_CHUNK of them for every call.
+        """
+        points = np.atleast_2d(points)
+        log_prob = np.full(len(points), -np.inf)
+        keys = [point.tobytes() for point in points]
+        inside = np.all((points >= self.low) & (points <= self.high), axis=1)
+        new = [k for k in np.flatnonzero(inside) if keys[k] not in self.cache]
+        if new:
+            chunks = max(min(chunks, len(new) // MIN_CHUNK), 1) if pool is not None else 1
+            args = [(points[part], self.tspan, self.data, self.N0, self.time_varying) for part in np.array_split(new, chunks)]
+            sse = np.concatenate(pool.map(_sse_chunk, args) if chunks > 1 else [_sse_chunk(a) for a in args])
+            if len(self.cache) + len(new) > self.cache_size:
+                self.cache.clear()
+            self.cache.update(zip((keys[k] for k in new), -sse / (2 * self.sigma2)))
+        for k in np.flatnonzero(inside):
+            log_prob[k] = self.cache[keys[k]]
+        return log_prob
+
+
+def error_variance(sse, data, bounds=PARAM_BOUNDS):
+    """Variance of the log10 errors estimated from the objective of the point estimate."""
+    observed = np.count_nonzero(np.isfinite(np.log10(data[1:])))
+    free = sum(low < high for low, high in bounds)
+    return sse / max(observed - free, 1)
+
+
+def read_chain(path, walkers=None):
+    """Thinned chain saved by sample_posterior, or None if there is none.
+
+    A row cut off by an interruption is ignored, as are the rows of any step that does not have
+    all `walkers` (by default the most walkers saved for a step).
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    # Only whole lines: a row is written together with its line end
+    text = text[:text.rfind('\n') + 1]
+    if not text:
+        return None
+    chain = pd.read_csv(io.StringIO(text), dtype=float).dropna(subset=['step', 'walker', *PARAMETERS])
+    chain = chain.astype({'step': int, 'walker': int})
+    counts = chain.groupby('step')['walker'].nunique()
+    complete = counts.index[counts == (walkers or counts.max())] if len(counts) else []
+    return chain[chain['step'].isin(complete)].reset_index(drop=True)
+
+
+def sample_posterior(tspan, data, N0, x0, sigma2, bounds=PARAM_BOUNDS, walkers=32, steps=2000, thin=10, scale=0.01,
+                     chain_path=None, processes=None, seed=0, time_varying=False):
+    """Sample the posterior with the affine-invariant ensemble sampler (stretch move of Goodman & Weare).
+
+    The walkers start around the point estimate `x0`, with a relative spread `scale` of every
+    free parameter. Each half of the ensemble moves at once: its proposals are simulated with
+    sse_batch in one call, or split over `processes` worker processes for an ensemble large enough
+    to gain from it (MIN_CHUNK proposals for each process). Every `thin` steps the positions and
+    log posteriors of all walkers are appended to the CSV file `chain_path`. If that file already
+    holds a chain, sampling resumes from its last complete step until `steps` steps.
+
+    Returns the thinned chain as a DataFrame with CHAIN_COLUMNS.
+    """
+    rng = np.random.default_rng(seed)
+    posterior = Posterior(tspan, data, N0, sigma2, bounds, time_varying)
+    free = posterior.low < posterior.high
+    saved = read_chain(chain_path) if chain_path else None
+    if saved is not None:
+        # Drop what an interruption left of an unfinished step, so the next steps are appended to whole rows
+        with open(chain_path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            saved[CHAIN_COLUMNS].to_csv(f, index=False)
+        os.replace(chain_path + '.tmp', chain_path)
+
+    if saved is not None and len(saved):
+        first = int(saved['step'].max())
+        positions = saved[saved['step'] == first].sort_values('walker')[PARAMETERS].to_numpy(dtype=float)
+        walkers = len(positions)
+        # The saved log posteriors of the walkers are not simulated again
+        posterior.remember(saved[PARAMETERS].to_numpy(dtype=float), saved['log_prob'].to_numpy(dtype=float))
+        # Continue the random stream where the saved steps left it, so a resumed chain does not repeat draws
+        rng = np.random.default_rng([seed, first])
+    else:
+        first = 0
+        positions = np.tile(np.asarray(x0, dtype=float), (walkers, 1))
+        spread = rng.normal(0, scale, (walkers, free.sum())) * np.abs(positions[:, free])
+        positions[:, free] = np.clip(positions[:, free] + spread, posterior.low[free], posterior.high[free])
+    if walkers < 2 * free.sum():
+        raise ValueError(f'Need at least {2 * free.sum()} walkers for {free.sum()} free parameters')
+
+    rows = [] if saved is None else [saved]
+    processes = min(processes or os.cpu_count() or 1, walkers // 2 // MIN_CHUNK)
+    pool = _process_context().Pool(processes) if processes > 1 else None
+    try:
+        log_prob = posterior(positions, pool, processes)
+        if first == 0:
+            rows.append(_save_step(chain_path, 0, positions, log_prob))
+        halves = np.arange(walkers) % 2
+        for step in range(first + 1, steps + 1):
+            for half in (0, 1):
+                moving, others = np.flatnonzero(halves == half), np.flatnonzero(halves != half)
+                # Stretch every walker of this half towards or away from a walker of the other half
+                z = ((STRETCH - 1) * rng.random(len(moving)) + 1) ** 2 / STRETCH
+                partners = positions[rng.choice(others, len(moving))]
+                proposals = positions[moving].copy()
+                proposals[:, free] = partners[:, free] + z[:, None] * (positions[moving][:, free] - partners[:, free])
+                proposed = posterior(proposals, pool, processes)
+                with np.errstate(invalid='ignore'):
+                    accept = np.log(rng.random(len(moving))) < (free.sum() - 1) * np.log(z) + proposed - log_prob[moving]
+                positions[moving[accept]] = proposals[accept]
+                log_prob[moving[accept]] = proposed[accept]
+            if step % thin == 0:
+                rows.append(_save_step(chain_path, step, positions, log_prob))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return pd.concat(rows, ignore_index=True)[CHAIN_COLUMNS]
+
+
+def _save_step(path, step, positions, log_prob):
+    # Rows of the walkers of one step, appended to the chain file at `path` (if any) with a header if the file is new
+    chunk = pd.DataFrame({'step': step, 'walker': np.arange(len(positions)),
+                          **dict(zip(PARAMETERS, positions.T)), 'log_prob': log_prob})
+    if not path:
+        return chunk
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    new = not os.path.exists(path)
+    with open(path, 'a', encoding='utf-8', newline='') as f:
+        chunk.to_csv(f, index=False, header=new)
+        f.flush()
+        os.fsync(f.fileno())
+    return chunk
+
+
+def predictive_quantiles(chain, tspan_pred, V0, N0, burn=0.5, draws=1000, quantiles=QUANTILES, seed=0,
+                         time_varying=False):
+    """Quantiles of the daily incidence predicted by the posterior on the days of `tspan_pred`.
+
+    `draws` samples are taken from the chain after dropping the first `burn` fraction of its
+    steps, and simulated together with simulate_batch. Returns a frame with one row per day of
+    tspan_pred[:-1] (the new exposures from that day to the next, as in the plot of the point
+    estimate) and one column per quantile.
+    """
+    after = chain[chain['step'] >= burn * chain['step'].max()]
+    rng = np.random.default_rng(seed)
+    params = after[PARAMETERS].to_numpy(dtype=float)[rng.integers(0, len(after), draws)]
+    sol = simulate_batch(params, tspan_pred, V0, N0, time_varying=time_varying)
+    incidence = np.diff(sol[:, :, 5], axis=0)
+    return pd.DataFrame(np.nanquantile(incidence, quantiles, axis=1).T, index=pd.Index(tspan_pred[:-1], name='day'),
+                        columns=quantiles)
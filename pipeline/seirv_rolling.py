@@ -0,0 +1,68 @@
+# Purpose: Refit the SEIRV model over sliding or expanding windows, each window starting from the optimum and state of the previous one
+import time
+
+import numpy as np
+import pandas as pd
+
+from pipeline.seirv import (ETA, GAMMA, PARAM_BOUNDS, _local_fit, get_eta, initial_state, multi_start_fit,
+                            simulate_seirv_model)
+
+PARAMETERS = ['lambda_', 'alpha', 'beta', 'E0']
+
+# Factor by which a sliding window may rescale the exposed and infectious people carried over from the previous window
+CARRIED_RANGE = 10
+
+
+def windows(n_days, length, step, expanding=False):
+    """(first, last) day indices of the windows over a series of `n_days` days, `last` excluded.
+
+    Windows end every `step` days. Sliding windows are `length` days long; expanding windows all
+    start on the first day, the first of them `length` days long.
+    """
+    return [(0 if expanding else last - length, last) for last in range(length, n_days + 1, step)]
+
+
+def rolling_fit(data, N0, length, step, expanding=False, bounds=PARAM_BOUNDS, first_fit=None, method='odeint',
+                time_varying=False, **fit_options):
+    """Fit the parameters on every window of the daily virus `data`.
+
+    The first window is fitted from scratch with multi_start_fit (`fit_options`), unless its
+    result is given as `first_fit`. Every later window runs a single L-BFGS-B search started
+    from the optimum of the previous window. Sliding windows also start from the state the
+    previous fit reached on their first day, so only the days of the window are integrated and
+    E0 is no longer fitted. Days are numbered from 1 on the first day of `data`, so a
+    time-varying decay follows the calendar.
+
+    Returns one row per window with its first and last day, the parameters, the objective, the
+    effective reproduction number lambda_ * S / gamma on its first day and the seconds it took.
+    """
+    rows = []
+    previous = None
+    for first, last in windows(len(data), length, step, expanding):
+        started = time.perf_counter()
+        tspan = np.arange(first + 1, last + 1)
+        window = data[first:last]
+        y0 = None
+        if previous is None:
+            res = first_fit or multi_start_fit(tspan, window, N0, bounds, method=method, time_varying=time_varying,
+                                               **fit_options)
+            x, fun = res.x, res.fun
+        else:
+            x = previous['x']
+            window_bounds = bounds
+            if not expanding:
+                # State reached on the first day of this window by the fit of the previous window
+                y0 = simulate_seirv_model(x, np.arange(previous['tspan'][0], first + 2), previous['data'][0], N0, method,
+                                          time_varying, y0=previous['y0'])[-1]
+                # E0 becomes the number exposed on the first day, starting from the carried-over value
+                x = np.array([*x[:3], y0[1]])
+                window_bounds = [*bounds[:3], (y0[1] / CARRIED_RANGE, y0[1] * CARRIED_RANGE)]
+            x, fun = _local_fit((x, tspan, window, N0, window_bounds, method, time_varying, y0))
+
+        if y0 is None:
+            y0 = initial_state(x, window[0], N0, get_eta(tspan[0]) if time_varying else ETA)
+        S0 = y0[0]
+        rows.append({'first_day': first + 1, 'last_day': last, **dict(zip(PARAMETERS, x)), 'sse': fun,
+                     'R_t': x[0] * S0 / GAMMA, 'seconds': time.perf_counter() - started})
+        previous = {'x': x, 'tspan': tspan, 'data': window, 'y0': y0 if not expanding else None}
+    return pd.DataFrame(rows)
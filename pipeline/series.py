@@ -0,0 +1,120 @@
+# Purpose: Hold the measures of all sites of a country on one (date x site) grid, instead of one frame column per site and measure
+import os
+
+import numpy as np
+import pandas as pd
+
+from pipeline.formatting import grid_frame
+from pipeline.timing import timed
+
+
+class SiteSeries:
+    """Daily values of several measures for a set of sites.
+
+    Every measure is a (dates x sites) float array on the same `dates` and `sites`, so that a new
+    measure is one array and not one column per site, and site names never have to be parsed out
+    of column names.
+    """
+
+    def __init__(self, dates, sites, measures=None):
+        self.dates = pd.DatetimeIndex(dates, name='Date')
+        self.sites = pd.Index(sites)
+        self.measures = {}
+        for name, values in (measures or {}).items():
+            self[name] = values
+
+    @classmethod
+    @timed('pivot/interpolate')
+    def from_long(cls, df, date_col, site_col, measures):
+        """Build the series from a long frame with one row per date and site.
+
+        `measures` maps the name of every measure to the column of `df` that holds it. Sites are
+        kept in the order in which they first appear, dates are sorted.
+        """
+        dates, date_codes = np.unique(df[date_col].to_numpy(), return_inverse=True)
+        site_codes, sites = pd.factorize(df[site_col])
+        # Plain labels, also for categorical columns
+        sites = np.asarray(sites)
+        series = cls(dates, sites)
+        for name, col in measures.items():
+            values = np.full((len(dates), len(sites)), np.nan)
+            values[date_codes, site_codes] = df[col].to_numpy(dtype=float)
+            series[name] = values
+        return series
+
+    def __getitem__(self, name):
+        return self.measures[name]
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values, dtype=float)
+        if values.shape != (len(self.dates), len(self.sites)):
+            raise ValueError(f'{name} has shape {values.shape}, expected {(len(self.dates), len(self.sites))}')
+        self.measures[name] = values
+
+    def __contains__(self, name):
+        return name in self.measures
+
+    def frame(self, name):
+        """One measure as a (dates x sites) frame, without copying."""
+        return pd.DataFrame(self.measures[name], index=self.dates, columns=self.sites, copy=False)
+
+    @timed('pivot/interpolate')
+    def daily(self, interpolate=True):
+        """Return the series on every day between the first and last date, linearly interpolating the added days."""
+        dates = pd.date_range(self.dates[0], self.dates[-1], freq='D', name='Date')
+        rows = dates.get_indexer(self.dates)
+        series = SiteSeries(dates, self.sites)
+        for name, values in self.measures.items():
+            filled = np.full((len(dates), len(self.sites)), np.nan)
+            filled[rows] = values
+            if interpolate:
+                filled = pd.DataFrame(filled).interpolate(method='linear', axis=0).to_numpy()
+            series[name] = filled
+        return series
+
+    def centered_mean(self, name, window=3):
+        """Mean over `window` days centred on every day (e.g. the last, present and next day); NaN where incomplete."""
+        values = self.measures[name]
+        half = window // 2
+        n = len(values)
+        total = np.full(values.shape, np.nan)
+        if n > 2 * half:
+            total[half:n - half] = values[0:n - 2 * half]
+            for k in range(1, window):
+                total[half:n - half] += values[k:n - 2 * half + k]
+        return total / window
+
+    def fillna(self, value=0.0):
+        """Replace missing values of every measure in place."""
+        for values in self.measures.values():
+            values[np.isnan(values)] = value
+        return self
+
+    def take(self, rows):
+        """Series restricted to the dates selected by `rows` (a slice or an index array)."""
+        return SiteSeries(self.dates[rows], self.sites, {name: values[rows] for name, values in self.measures.items()})
+
+    def save(self, path, measures=None):
+        """Save the series (the given measures, all if None) as a .npz file that load() reads back."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        measures = list(self.measures) if measures is None else list(measures)
+        arrays = {f'measure_{i}': self.measures[name] for i, name in enumerate(measures)}
+        np.savez(path, dates=self.dates.to_numpy().astype('datetime64[D]'), sites=np.array(self.sites, dtype=str),
+                 names=np.array(measures, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Series saved by save()."""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['dates'], data['sites'], {name: data[f'measure_{i}'] for i, name in enumerate(data['names'])})
+
+    def to_long(self, country, measures):
+        """Long-format rows (Country, Region, Date, Measure, Value) of the sites.
+
+        `measures` maps the name of a measure in the series to its name in the output. Rows are
+        ordered by measure, site and date.
+        """
+        values = np.stack([self.measures[name] for name in measures])
+        return grid_frame(country, values, self.dates, self.sites, list(measures.values()))
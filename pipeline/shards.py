@@ -0,0 +1,109 @@
+# Purpose: Write one small columnar JSON file per country and region, plus a manifest, for the index.html dashboard
+import gzip
+import json
+import math
+import os
+import re
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SHARD_DIR = 'shards'
+
+
+def _file_name(region):
+    # File-system and URL safe name of a region
+    return re.sub(r'[^\w-]+', '_', str(region)).strip('_') or 'region'
+
+
+def _value(x):
+    return None if x is None or (isinstance(x, float) and math.isnan(x)) else x
+
+
+def _write_json(path, payload):
+    # Write the JSON file together with precompressed copies for servers that serve them
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(body)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(body, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(body))
+
+
+def _load_manifest(root):
+    path = os.path.join(root, 'manifest.json')
+    if not os.path.exists(path):
+        return {'countries': {}}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+@contextmanager
+def _manifest_lock(root):
+    # Pipelines running concurrently update the same manifest one at a time
+    with open(os.path.join(root, 'manifest.lock'), 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def write_shards(df, root=SHARD_DIR):
+    """Write the long-format rows of `df` as one columnar JSON shard per (country, region).
+
+    A shard holds a single date vector and one value vector per measure:
+    {"country": ..., "region": ..., "dates": [...], "measures": {"inf": [...], ...}}.
+    The entries of the countries in `df` are replaced in `root`/manifest.json, which lists the
+    regions, measures, date range and shard file of every country.
+    """
+    os.makedirs(root, exist_ok=True)
+    df = df.dropna(subset=['Region', 'Measure'])
+    countries = {}
+
+    for country, rows in df.groupby('Country', sort=False, observed=True):
+        country_dir = os.path.join(root, str(country))
+        if os.path.isdir(country_dir):
+            for name in os.listdir(country_dir):
+                os.remove(os.path.join(country_dir, name))
+        os.makedirs(country_dir, exist_ok=True)
+
+        # If a region appears twice for the same date and measure, the first row wins
+        wide = (rows.assign(Date=pd.to_datetime(rows['Date']), Region=rows['Region'].astype(str), Measure=rows['Measure'].astype(str))
+                .groupby(['Region', 'Date', 'Measure'], sort=True)['Value'].first()
+                .unstack('Measure'))
+
+        regions = {}
+        used = set()
+        for region, values in wide.groupby(level='Region', sort=True):
+            values = values.droplevel('Region').dropna(axis=1, how='all')
+            name = _file_name(region)
+            while name in used:
+                name += '_'
+            used.add(name)
+
+            dates = values.index.strftime('%Y-%m-%d').tolist()
+            measures = {measure: [_value(x) for x in values[measure].tolist()] for measure in values.columns}
+            file = f'{country}/{name}.json'
+            _write_json(os.path.join(root, file), {'country': country, 'region': region, 'dates': dates, 'measures': measures})
+            regions[region] = {'file': file, 'measures': list(measures), 'start': dates[0] if dates else None,
+                               'end': dates[-1] if dates else None}
+
+        countries[str(country)] = {'regions': regions}
+
+    with _manifest_lock(root):
+        manifest = _load_manifest(root)
+        manifest['countries'] = dict(sorted({**manifest['countries'], **countries}.items()))
+        path = os.path.join(root, 'manifest.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(path + '.tmp', path)
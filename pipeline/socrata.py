@@ -0,0 +1,238 @@
+# Purpose: Incrementally download Socrata (data.cdc.gov) datasets page by page into a local Parquet cache
+import json
+import os
+import shutil
+import time
+import pandas as pd
+from pipeline import fetch
+from pipeline.timing import timed
+
+# Columns and types of the NWSS datasets used by the US pipeline. `key` identifies a row, so
+# rows that are updated upstream replace their cached version. Columns listed in `categories`
+# are read back as categoricals.
+DATASETS = {
+    # NWSS Public SARS-CoV-2 Concentration in Wastewater Data
+    'g653-rqe2': {
+        'columns': ['key_plot_id', 'date', 'normalization', 'pcr_conc_smoothed'],
+        'key': ['key_plot_id', 'date'],
+        'dates': ['date'],
+        'numeric': ['pcr_conc_smoothed'],
+        'categories': ['key_plot_id', 'normalization'],
+    },
+    # NWSS Public SARS-CoV-2 Wastewater Metric Data
+    '2ew6-ywp6': {
+        'columns': ['key_plot_id', 'wwtp_jurisdiction', 'population_served', 'date_start', 'date_end'],
+        'key': ['key_plot_id', 'date_start', 'date_end'],
+        'dates': ['date_start', 'date_end'],
+        'numeric': ['population_served'],
+        'categories': ['key_plot_id', 'wwtp_jurisdiction'],
+    },
+}
+
+BASE_URL = 'https://data.cdc.gov'
+CACHE_DIR = '.cache/socrata'
+PAGE_SIZE = 50000
+# Number of part files after which the cache of a dataset is rewritten as a single file
+MAX_PARTS = 32
+# Days after which a dataset is downloaded again in full, which drops the rows deleted upstream
+FULL_SYNC_DAYS = float(os.environ.get('SOCRATA_FULL_SYNC_DAYS', 7))
+
+
+def _dataset_dir(dataset, cache_dir):
+    return os.path.join(cache_dir, dataset)
+
+
+def _load_meta(dataset, cache_dir):
+    path = os.path.join(_dataset_dir(dataset, cache_dir), '_meta.json')
+    if not os.path.exists(path):
+        return {'cursor': None, 'parts': 0}
+    with open(path) as f:
+        meta = json.load(f)
+    # Caches written before the cursor held an ':id' resume with every row of their high-water time
+    if 'cursor' not in meta:
+        meta['cursor'] = [meta.pop('high_water'), ''] if meta.get('high_water') else None
+    return meta
+
+
+def _save_meta(dataset, cache_dir, meta):
+    path = os.path.join(_dataset_dir(dataset, cache_dir), '_meta.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp', path)
+
+
+def _part_paths(dataset, cache_dir, directory=None):
+    directory = directory or _dataset_dir(dataset, cache_dir)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.parquet'))
+
+
+def _typed_frame(records, config):
+    # Convert one page of JSON records into a frame with the configured columns and types
+    df = pd.DataFrame.from_records(records, columns=config['columns'])
+    for col in config['columns']:
+        if col in config['dates']:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+        elif col in config['numeric']:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        else:
+            df[col] = df[col].astype('string')
+    return df
+
+
+def _after(cursor):
+    # SoQL condition for the rows after `cursor` = [':updated_at', ':id'] in the order of the pages
+    updated_at, row_id = cursor
+    return f":updated_at > '{updated_at}' OR (:updated_at = '{updated_at}' AND :id > '{row_id}')"
+
+
+def _fetch_pages(session, url, params, page_size, cursor=None, headers=None):
+    # Yield (page, cursor of its last row) for the rows after `cursor`, `page_size` rows at a time. Every
+    # page starts after the last row of the previous one rather than at an offset, so rows that share an
+    # ':updated_at' time are neither skipped nor repeated across pages, or when a sync resumes.
+    while True:
+        query = {**params, '$limit': page_size}
+        if cursor:
+            query['$where'] = _after(cursor)
+        response = session.get(url, params=query, headers=headers, timeout=300)
+        response.raise_for_status()
+        page = response.json()
+        if not page:
+            return
+        cursor = [page[-1][':updated_at'].rstrip('Z'), page[-1][':id']]
+        yield page, cursor
+        if len(page) < page_size:
+            return
+
+
+@timed('download')
+def sync_dataset(dataset, base_url=BASE_URL, cache_dir=CACHE_DIR, page_size=PAGE_SIZE, session=None, app_token=None):
+    """Download the rows of `dataset` that were added or updated since the last sync.
+
+    Rows are requested in pages ordered by the Socrata ':updated_at' and ':id' system fields,
+    starting after the last row of the cache, and every page is written to its own Parquet part
+    file, so memory use is bounded by the page size. The cursor is saved with every page, so an
+    interrupted sync resumes where it stopped. Returns the number of rows downloaded.
+
+    Rows deleted upstream never show up in an incremental sync, so every FULL_SYNC_DAYS days the
+    whole dataset is downloaded again into a staging directory, which replaces the cache once
+    it is complete (an interrupted full sync resumes as well).
+
+    In the 'replay' mode of pipeline.fetch nothing is downloaded and the cache is used as it is, as
+    it is when the dataset was synced less than pipeline.fetch.MAX_AGE seconds ago.
+    """
+    if fetch.DEFAULT_MODE == 'replay':
+        return 0
+    config = DATASETS[dataset]
+    session = session or fetch.get_session()
+    app_token = app_token or os.environ.get('SOCRATA_APP_TOKEN')
+    # Sent with these requests only, as the session is shared with other hosts
+    headers = {'X-App-Token': app_token} if app_token else None
+
+    os.makedirs(_dataset_dir(dataset, cache_dir), exist_ok=True)
+    meta = _load_meta(dataset, cache_dir)
+    if fetch.MAX_AGE and time.time() - meta.get('synced', 0) < fetch.MAX_AGE:
+        return 0
+    params = {
+        '$select': ', '.join([':updated_at', ':id'] + config['columns']),
+        '$order': ':updated_at, :id',
+    }
+    url = f"{base_url.rstrip('/')}/resource/{dataset}.json"
+
+    staging = os.path.join(_dataset_dir(dataset, cache_dir), 'resync')
+    if 'resync' not in meta and time.time() - meta.get('full_synced', 0) > FULL_SYNC_DAYS * 86400:
+        shutil.rmtree(staging, ignore_errors=True)
+        # The parts replaced by the full download, and the part number reserved for the downloaded ones
+        meta['resync'] = {'cursor': None, 'parts': 0, 'base': meta['parts'],
+                          'obsolete': [os.path.basename(path) for path in _part_paths(dataset, cache_dir)]}
+        meta['parts'] += 1
+        _save_meta(dataset, cache_dir, meta)
+    # Progress of a full sync is kept in meta['resync'], of an incremental one in meta itself
+    progress = meta.get('resync', meta)
+    directory = staging if 'resync' in meta else _dataset_dir(dataset, cache_dir)
+    os.makedirs(directory, exist_ok=True)
+
+    downloaded = 0
+    for page, cursor in _fetch_pages(session, url, params, page_size, progress['cursor'], headers):
+        df = _typed_frame(page, config)
+        df.to_parquet(os.path.join(directory, f"part-{progress['parts']:06d}.parquet"), index=False)
+        progress['cursor'] = cursor
+        progress['parts'] += 1
+        _save_meta(dataset, cache_dir, meta)
+        downloaded += len(page)
+
+    if 'resync' in meta:
+        # Replace the cache with the complete download. Every step can be repeated if it is interrupted.
+        resync = meta['resync']
+        for path in _part_paths(dataset, cache_dir, staging):
+            os.replace(path, os.path.join(_dataset_dir(dataset, cache_dir),
+                                          f"part-{resync['base']:06d}-{os.path.basename(path)[len('part-'):]}"))
+        for name in resync['obsolete']:
+            if os.path.exists(os.path.join(_dataset_dir(dataset, cache_dir), name)):
+                os.remove(os.path.join(_dataset_dir(dataset, cache_dir), name))
+        meta['cursor'] = meta.pop('resync')['cursor']
+        meta['full_synced'] = time.time()
+        _save_meta(dataset, cache_dir, meta)
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if len(_part_paths(dataset, cache_dir)) > MAX_PARTS:
+        compact_dataset(dataset, cache_dir)
+    # Time of the last complete sync
+    meta = _load_meta(dataset, cache_dir)
+    meta['synced'] = time.time()
+    _save_meta(dataset, cache_dir, meta)
+    return downloaded
+
+
+def _concat_parts(parts, categories):
+    # Concatenate part frames, giving every categorical column the same sorted categories
+    for col in categories:
+        values = pd.api.types.union_categoricals([part[col] for part in parts], sort_categories=True).categories
+        for part in parts:
+            part[col] = part[col].cat.set_categories(values)
+    return pd.concat(parts, ignore_index=True)
+
+
+@timed('read inputs')
+def read_dataset(dataset, cache_dir=CACHE_DIR, columns=None, filters=None):
+    """Return the cached rows of `dataset`, keeping only the latest version of every row.
+
+    Only `columns` are read, and `filters` (pyarrow filters such as
+    [('normalization', '==', 'flow-population')]) are applied while the part files are parsed, so
+    excluded rows and columns are never materialized. Filters should only use columns that do not
+    change between versions of a row.
+    """
+    config = DATASETS[dataset]
+    columns = list(columns or config['columns'])
+    read_columns = list(dict.fromkeys(columns + config['key']))
+    categories = [col for col in read_columns if col in config.get('categories', [])]
+
+    parts = []
+    for path in _part_paths(dataset, cache_dir):
+        part = pd.read_parquet(path, columns=read_columns, filters=filters)
+        for col in categories:
+            part[col] = part[col].astype('category')
+        parts.append(part)
+    if not parts:
+        return pd.DataFrame({col: pd.Series(dtype='string') for col in columns})
+    df = _concat_parts(parts, categories)
+    # Later parts hold the most recent version of updated rows
+    df = df.drop_duplicates(subset=config['key'], keep='last', ignore_index=True)
+    return df[columns]
+
+
+def compact_dataset(dataset, cache_dir=CACHE_DIR):
+    """Rewrite the part files of `dataset` as a single deduplicated file."""
+    paths = _part_paths(dataset, cache_dir)
+    if len(paths) <= 1:
+        return
+    meta = _load_meta(dataset, cache_dir)
+    # Strings like the downloaded parts, so that every part reads back with the same types
+    df = read_dataset(dataset, cache_dir)
+    df = df.astype({col: 'string' for col in DATASETS[dataset].get('categories', [])})
+    df.to_parquet(os.path.join(_dataset_dir(dataset, cache_dir), f"part-{meta['parts']:06d}.parquet"), index=False)
+    meta['parts'] += 1
+    _save_meta(dataset, cache_dir, meta)
+    for path in paths:
+        os.remove(path)
@@ -0,0 +1,94 @@
+# Purpose: Keep the cleaned outputs of all countries in one Parquet dataset partitioned by country and measure
+import argparse
+import glob
+import os
+import shutil
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+OUTPUT_DIR = 'cleaned_parquet'
+
+# The dataset is not committed; it can be rebuilt from the committed CSV outputs of the pipelines
+CSV_PATTERN = '*_cleaned.csv'
+
+SCHEMA = pa.schema([
+    ('Country', pa.string()),
+    ('Region', pa.dictionary(pa.int32(), pa.string())),
+    ('Date', pa.date32()),
+    ('Measure', pa.string()),
+    ('Value', pa.float64()),
+])
+
+
+def _dictionary(values):
+    # Dictionary-encoded strings; categoricals are used as they are, without converting every row to a string
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return pa.array(values).cast(pa.dictionary(pa.int32(), pa.string()))
+    return pa.array(values.astype(str), pa.string()).dictionary_encode()
+
+
+def _to_table(df):
+    # Arrow table of a long-format frame, sorted so row groups can be skipped by region and date
+    df = df[['Country', 'Region', 'Date', 'Measure', 'Value']]
+    for col in ('Region', 'Measure'):
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df = df.assign(**{col: df[col].cat.reorder_categories(sorted(df[col].cat.categories))})
+    df = df.sort_values(['Measure', 'Region', 'Date'])
+    return pa.table({
+        'Country': pa.array(df['Country'].astype(str), pa.string()),
+        'Region': _dictionary(df['Region']),
+        'Date': pa.array(pd.to_datetime(df['Date']).to_numpy().astype('datetime64[D]'), pa.date32()),
+        'Measure': pa.array(df['Measure'].astype(str), pa.string()),
+        'Value': pa.array(df['Value'].astype(float), pa.float64()),
+    }, schema=SCHEMA)
+
+
+def write_country(df, root=OUTPUT_DIR):
+    """Replace the rows of the countries in `df` (Country, Region, Date, Measure, Value) in the dataset at `root`."""
+    for country in df['Country'].unique():
+        shutil.rmtree(os.path.join(root, f'Country={country}'), ignore_errors=True)
+    ds.write_dataset(_to_table(df), root, format='parquet', partitioning=['Country', 'Measure'],
+                     partitioning_flavor='hive', existing_data_behavior='overwrite_or_ignore',
+                     basename_template='part-{i}.parquet')
+
+
+def read_cleaned(root=OUTPUT_DIR, country=None, measure=None, region=None, columns=None):
+    """Read the long-format rows of the given country, measure and region (any of them if None).
+
+    Only the matching partitions and row groups are read.
+    """
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    conditions = [ds.field(name) == value for name, value in
+                  (('Country', country), ('Measure', measure), ('Region', region)) if value is not None]
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas(date_as_object=False)
+    return df[[name for name in SCHEMA.names if name in df.columns]]
+
+
+def rebuild(paths, root=OUTPUT_DIR):
+    """Write the rows of the cleaned CSV outputs at `paths` into the dataset at `root`."""
+    for path in paths:
+        df = pd.read_csv(path, dtype={'Country': str, 'Region': str, 'Measure': str}, parse_dates=['Date'])
+        write_country(df, root)
+        print(f'{path}: {len(df)} rows')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild the Parquet dataset from the cleaned CSV outputs.')
+    parser.add_argument('paths', nargs='*', help=f'CSV outputs to read (default: {CSV_PATTERN})')
+    parser.add_argument('--root', default=OUTPUT_DIR, help='Directory of the dataset')
+    args = parser.parse_args(argv)
+    paths = args.paths or sorted(glob.glob(CSV_PATTERN))
+    if not paths:
+        print(f'No outputs matching {CSV_PATTERN}', file=sys.stderr)
+        return 1
+    rebuild(paths, args.root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
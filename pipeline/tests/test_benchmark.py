@@ -0,0 +1,18 @@
+# Purpose: Check that the country scripts still give the golden results of the benchmark on its synthetic inputs
+import pytest
+
+from pipeline import benchmark
+
+
+@pytest.mark.parametrize('name', list(benchmark.SCRIPTS))
+def test_golden(name):
+    report = benchmark.check_golden(name)
+    assert report['status'] == 'match', report
+
+
+def test_stages_add_up(tmp_path):
+    benchmark.generate('finland', str(tmp_path), **benchmark.GOLDEN_SCALES['finland'])
+    stages, peak, result = benchmark.run('finland', str(tmp_path))
+    assert {'deconvolution', 'write outputs', 'other'} <= set(stages)
+    assert peak is None
+    assert set(result['Measure']) == {'wastewater', 'inf', 'official'}
@@ -0,0 +1,126 @@
+# Purpose: Test the probing of the Biobot snapshot dates and the download of the newest files against a stub server
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pipeline import biobot, fetch, vintages
+
+START = datetime(2024, 5, 14)
+
+COUNTY = (b'census_region,county_fips,date,display_name,eff_conc_sarscov2_weekly\n'
+          b'Northeast,25025,2024-05-04,"Suffolk County, MA",12.5\n')
+NATIONWIDE = (b'date,display_name,eff_conc_sarscov2_weekly,eff_conc_sarscov2_weekly_rolling\n'
+              b'2024-05-04,Nationwide,310.2,295.7\n')
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves `server.files` ({path: bytes}); HEAD requests to a path of `server.slow` take `server.delay` seconds."""
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.heads.append(self.path)
+            self.server.in_flight += 1
+            self.server.most_in_flight = max(self.server.most_in_flight, self.server.in_flight)
+        try:
+            # Long enough for the other probes to overlap with this one
+            time.sleep(self.server.delay if self.path in self.server.slow else 0.02)
+            self._respond(body=False)
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def do_GET(self):
+        self.server.gets.append(self.path)
+        self._respond(body=True)
+
+    def _respond(self, body):
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files, httpd.slow, httpd.delay = {}, set(), 0
+    httpd.heads, httpd.gets = [], []
+    httpd.lock, httpd.in_flight, httpd.most_in_flight = threading.Lock(), 0, 0
+    httpd.base_url = f'http://127.0.0.1:{httpd.server_address[1]}/'
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    monkeypatch.setattr(fetch, 'DEFAULT_MODE', 'revalidate')
+    monkeypatch.setattr(fetch, 'MAX_AGE', 0)
+    # The snapshots go to stores of the test
+    monkeypatch.setattr(biobot, 'VINTAGES', {name: str(tmp_path / 'vintages' / name) for name in biobot.FILES})
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def path(date, name):
+    return '/' + date + biobot.FILES[name]
+
+
+def download(server, tmp_path):
+    return biobot.download_latest(start_date=START, base_url=server.base_url, cache_dir=str(tmp_path / 'http'))
+
+
+def test_newest_snapshot_of_every_file(server, tmp_path):
+    server.files[path('2024-05-12', 'county')] = COUNTY
+    server.files[path('2024-05-10', 'county')] = b'old'
+    server.files[path('2024-05-09', 'nationwide')] = NATIONWIDE
+    files = download(server, tmp_path)
+
+    assert {name: date for name, (date, _) in files.items()} == {'county': '2024-05-12', 'nationwide': '2024-05-09'}
+    with open(files['county'][1], 'rb') as f:
+        assert f.read() == COUNTY
+    # Every date of both files is probed, several at a time, and only the newest files are downloaded
+    assert len(server.heads) == 2 * biobot.DAYS_BACK
+    assert 1 < server.most_in_flight <= biobot.PROBES
+    assert sorted(server.gets) == [path('2024-05-09', 'nationwide'), path('2024-05-12', 'county')]
+    # Every file is also kept in its own vintage store
+    assert vintages.vintages(biobot.VINTAGES['county'])['date'].tolist() == ['2024-05-12']
+    assert vintages.vintages(biobot.VINTAGES['nationwide'])['date'].tolist() == ['2024-05-09']
+    assert vintages.as_of(root=biobot.VINTAGES['nationwide'])['display_name'].tolist() == ['Nationwide']
+
+
+def test_no_snapshot(server, tmp_path):
+    assert download(server, tmp_path) == {'nationwide': (None, None), 'county': (None, None)}
+    assert server.gets == []
+    assert all(vintages.vintages(root).empty for root in biobot.VINTAGES.values())
+
+
+def test_probe_that_times_out_counts_as_missing(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, 'TIMEOUT', (5, 0.2))
+    server.files[path('2024-05-14', 'nationwide')] = b'too slow'
+    server.files[path('2024-05-11', 'nationwide')] = NATIONWIDE
+    server.files[path('2024-05-13', 'county')] = COUNTY
+    server.slow, server.delay = {path('2024-05-14', 'nationwide')}, 1.0
+    files = download(server, tmp_path)
+    assert files['nationwide'][0] == '2024-05-11'
+    assert files['county'][0] == '2024-05-13'
+
+
+def test_replay_probes_the_cache(server, tmp_path, monkeypatch):
+    server.files[path('2024-05-12', 'county')] = COUNTY
+    server.files[path('2024-05-09', 'nationwide')] = NATIONWIDE
+    downloaded = download(server, tmp_path)
+    requests = len(server.heads) + len(server.gets)
+
+    monkeypatch.setattr(fetch, 'DEFAULT_MODE', 'replay')
+    assert biobot.latest_dates(start_date=START, base_url=server.base_url, cache_dir=str(tmp_path / 'http')) == {
+        'nationwide': '2024-05-09', 'county': '2024-05-12'}
+    assert download(server, tmp_path) == downloaded
+    assert len(server.heads) + len(server.gets) == requests
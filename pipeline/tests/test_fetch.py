@@ -0,0 +1,138 @@
+# Purpose: Test the revalidated download cache against a local HTTP server that answers conditional requests
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pipeline import fetch
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves the bodies of `server.files` ({path: bytes}) with their sha256 as ETag, and 304 for a matching If-None-Match."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Mon, 02 Jan 2023 00:00:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files, httpd.requests = {}, []
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def always_revalidate(monkeypatch):
+    monkeypatch.setattr(fetch, 'DEFAULT_MODE', 'revalidate')
+    monkeypatch.setattr(fetch, 'MAX_AGE', 0)
+
+
+def test_unchanged_source_is_revalidated(server, tmp_path):
+    server.files['/data.csv'] = b'a,b\n1,2\n'
+    url = server.url + '/data.csv'
+    first = fetch.fetch(url, str(tmp_path))
+    second = fetch.fetch(url, str(tmp_path))
+    assert first == second
+    with open(second, 'rb') as f:
+        assert f.read() == b'a,b\n1,2\n'
+    # The second request carries the ETag of the first response and is answered with 304
+    assert server.requests[0][1] is None
+    assert server.requests[1][1] == fetch.cached(url, str(tmp_path))['etag']
+    assert fetch.cached(url, str(tmp_path))['last_modified'] == 'Mon, 02 Jan 2023 00:00:00 GMT'
+
+
+def test_changed_etag_replaces_the_copy(server, tmp_path):
+    url = server.url + '/data.csv'
+    server.files['/data.csv'] = b'a,b\n1,2\n'
+    old = fetch.fetch(url, str(tmp_path))
+    server.files['/data.csv'] = b'a,b\n3,4\n'
+    new = fetch.fetch(url, str(tmp_path))
+    assert new != old
+    with open(new, 'rb') as f:
+        assert f.read() == b'a,b\n3,4\n'
+    # No other URL refers to the old body, so it is deleted
+    assert not os.path.exists(old)
+    assert fetch.cached(url, str(tmp_path))['sha256'] == os.path.basename(new)
+
+
+def test_identical_bodies_are_stored_once(server, tmp_path):
+    server.files['/a.csv'] = server.files['/b.csv'] = b'a,b\n1,2\n'
+    assert fetch.fetch(server.url + '/a.csv', str(tmp_path)) == fetch.fetch(server.url + '/b.csv', str(tmp_path))
+    assert len(os.listdir(tmp_path / 'objects')) == 1
+
+
+def test_replay_never_asks_the_server(server, tmp_path):
+    url = server.url + '/data.csv'
+    server.files['/data.csv'] = b'a,b\n1,2\n'
+    path = fetch.fetch(url, str(tmp_path))
+    server.files['/data.csv'] = b'a,b\n3,4\n'
+    assert fetch.fetch(url, str(tmp_path), mode='replay') == path
+    assert len(server.requests) == 1
+
+
+def test_replay_without_a_recorded_response(server, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        fetch.fetch(server.url + '/never.csv', str(tmp_path), mode='replay')
+    # A recorded URL whose body is gone is not replayed either
+    url = server.url + '/data.csv'
+    server.files['/data.csv'] = b'a,b\n1,2\n'
+    os.unlink(fetch.fetch(url, str(tmp_path)))
+    with pytest.raises(FileNotFoundError):
+        fetch.fetch(url, str(tmp_path), mode='replay')
+    assert server.requests == [('/data.csv', None)]
+
+
+def test_parsed_frames_follow_the_source(server, tmp_path, monkeypatch):
+    url = server.url + '/data.csv'
+    server.files['/data.csv'] = b'a,b\n1,2\n'
+    assert fetch.read_csv(url, str(tmp_path))['a'].tolist() == [1]
+    parsed = os.listdir(tmp_path / 'parsed')
+    assert len(parsed) == 1
+
+    # An unchanged source is not parsed again
+    def fail(*args, **kwargs):
+        raise AssertionError('parsed again')
+    with monkeypatch.context() as patch:
+        patch.setattr(fetch.pd, 'read_csv', fail)
+        assert fetch.read_csv(url, str(tmp_path))['a'].tolist() == [1]
+    # Other arguments give another frame
+    assert fetch.read_csv(url, str(tmp_path), usecols=['b']).columns.tolist() == ['b']
+    assert len(os.listdir(tmp_path / 'parsed')) == 2
+
+    # A changed source is parsed again, and the frames of the old body are deleted with it
+    server.files['/data.csv'] = b'a,b\n3,4\n'
+    assert fetch.read_csv(url, str(tmp_path))['a'].tolist() == [3]
+    assert parsed[0] not in os.listdir(tmp_path / 'parsed')
+    assert len(os.listdir(tmp_path / 'parsed')) == 1
+
+
+def test_record(tmp_path):
+    url = 'https://example.org/data.csv'
+    fetch.record(url, b'a,b\n1,2\n', str(tmp_path))
+    assert fetch.read_csv(url, str(tmp_path), mode='replay')['b'].tolist() == [2]
@@ -0,0 +1,33 @@
+# Purpose: Test that a chain file cut off by an interruption is read back with whole steps only
+import numpy as np
+
+from pipeline.seirv_posterior import CHAIN_COLUMNS, _save_step, read_chain
+
+
+def write_chain(path, steps, walkers=4):
+    for step in steps:
+        _save_step(str(path), step, np.full((walkers, 4), step + 1.0), np.full(walkers, -float(step)))
+
+
+def test_whole_chain(tmp_path):
+    write_chain(tmp_path / 'chain.csv', [0, 10, 20])
+    chain = read_chain(str(tmp_path / 'chain.csv'))
+    assert list(chain.columns) == CHAIN_COLUMNS
+    assert chain.groupby('step')['walker'].count().to_dict() == {0: 4, 10: 4, 20: 4}
+
+
+def test_partial_trailing_row_and_step_are_dropped(tmp_path):
+    path = tmp_path / 'chain.csv'
+    write_chain(path, [0, 10, 20])
+    text = path.read_text()
+    # Interrupted while appending the third row of step 20
+    path.write_text(text[:text.rindex('\n20,2,') + 7])
+    chain = read_chain(str(path))
+    assert sorted(chain['step'].unique()) == [0, 10]
+    assert len(chain) == 8
+
+
+def test_missing_and_empty_files(tmp_path):
+    assert read_chain(str(tmp_path / 'chain.csv')) is None
+    (tmp_path / 'chain.csv').write_text('step,walk')
+    assert read_chain(str(tmp_path / 'chain.csv')) is None
@@ -0,0 +1,133 @@
+# Purpose: Test the incremental Socrata cache against a stub session serving pages like the SODA API
+import re
+
+import pytest
+
+from pipeline import socrata
+
+DATASET = 'g653-rqe2'
+URL = f'{socrata.BASE_URL}/resource/{DATASET}.json'
+
+
+class StubResponse:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.rows
+
+
+class StubSession:
+    """Serves `rows` like the SODA API: ordered by (':updated_at', ':id'), after the cursor of '$where'.
+
+    `fail_after` makes the request after that many pages raise, as an interrupted sync would.
+    """
+
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        assert url == URL
+        if self.fail_after is not None and len(self.requests) >= self.fail_after:
+            raise ConnectionError('interrupted')
+        self.requests.append(params)
+        rows = sorted(self.rows, key=lambda row: (row[':updated_at'], row[':id']))
+        if '$where' in params:
+            updated_at, row_id = re.match(r":updated_at > '([^']*)'.* :id > '([^']*)'", params['$where']).groups()
+            rows = [row for row in rows if (row[':updated_at'].rstrip('Z'), row[':id']) > (updated_at, row_id)]
+        return StubResponse(rows[:params['$limit']])
+
+
+def row(i, updated_at, value=1.0, site='a'):
+    return {':id': f'row-{i:04d}', ':updated_at': updated_at + 'Z', 'key_plot_id': site,
+            'date': f'2024-01-{i % 28 + 1:02d}', 'normalization': 'flow-population', 'pcr_conc_smoothed': str(value)}
+
+
+def read(cache_dir):
+    df = socrata.read_dataset(DATASET, str(cache_dir))
+    return df.astype({'key_plot_id': str}).sort_values(['key_plot_id', 'date']).reset_index(drop=True)
+
+
+@pytest.fixture(autouse=True)
+def revalidate(monkeypatch):
+    monkeypatch.setattr(socrata.fetch, 'DEFAULT_MODE', 'revalidate')
+    monkeypatch.setattr(socrata.fetch, 'MAX_AGE', 0)
+
+
+def test_first_sync(tmp_path):
+    rows = [row(i, '2024-02-01T00:00:00.000') for i in range(10)]
+    assert socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows)) == 10
+    df = read(tmp_path)
+    assert len(df) == 10
+    assert df['pcr_conc_smoothed'].tolist() == [1.0] * 10
+
+
+def test_incremental_sync(tmp_path):
+    rows = [row(i, '2024-02-01T00:00:00.000') for i in range(6)]
+    socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows))
+    # One row updated upstream and two added
+    rows[2] = row(2, '2024-02-02T00:00:00.000', value=5.0)
+    rows += [row(i, '2024-02-02T00:00:00.000') for i in (6, 7)]
+    session = StubSession(rows)
+    assert socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=session) == 3
+    assert session.requests[0]['$where'].startswith(":updated_at > '2024-02-01T00:00:00.000'")
+    df = read(tmp_path)
+    assert len(df) == 8
+    assert df.set_index('date').loc['2024-01-03', 'pcr_conc_smoothed'] == 5.0
+
+
+def test_resume_after_interruption_within_a_timestamp(tmp_path):
+    # A batch update stamps all rows with one time; the sync stops after the first page
+    rows = [row(i, '2024-02-01T00:00:00.000', value=i) for i in range(10)]
+    with pytest.raises(ConnectionError):
+        socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows, fail_after=1))
+    session = StubSession(rows)
+    assert socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=session) == 6
+    # The resumed sync starts after the last row of the saved page, not after its time
+    assert "AND :id > 'row-0003'" in session.requests[0]['$where']
+    assert read(tmp_path)['pcr_conc_smoothed'].tolist() == list(range(10))
+
+
+def test_full_sync_drops_deleted_rows(tmp_path, monkeypatch):
+    rows = [row(i, '2024-02-01T00:00:00.000') for i in range(6)]
+    socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows))
+    del rows[0]
+    # Incremental syncs cannot see the deletion, a full sync can
+    socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows))
+    assert len(read(tmp_path)) == 6
+    monkeypatch.setattr(socrata, 'FULL_SYNC_DAYS', 0)
+    socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows))
+    assert len(read(tmp_path)) == 5
+    assert not (tmp_path / DATASET / 'resync').exists()
+
+
+def test_interrupted_full_sync_keeps_the_cache(tmp_path, monkeypatch):
+    rows = [row(i, '2024-02-01T00:00:00.000') for i in range(10)]
+    socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows))
+    monkeypatch.setattr(socrata, 'FULL_SYNC_DAYS', 0)
+    del rows[0]
+    with pytest.raises(ConnectionError):
+        socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=StubSession(rows, fail_after=1))
+    # The cache is unchanged until the full sync completes, which resumes after its first page
+    assert len(read(tmp_path)) == 10
+    session = StubSession(rows)
+    assert socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=4, session=session) == 5
+    assert len(read(tmp_path)) == 9
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(socrata, 'MAX_PARTS', 3)
+    rows = [row(i, '2024-02-01T00:00:00.000') for i in range(6)]
+    socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=2, session=StubSession(rows))
+    for day in (2, 3):
+        rows = [row(i, f'2024-02-0{day}T00:00:00.000', value=day) if i < 4 else r for i, r in enumerate(rows)]
+        socrata.sync_dataset(DATASET, cache_dir=str(tmp_path), page_size=2, session=StubSession(rows))
+    assert len(socrata._part_paths(DATASET, str(tmp_path))) <= 3
+    df = read(tmp_path)
+    assert len(df) == 6
+    assert df['pcr_conc_smoothed'].tolist() == [3.0] * 4 + [1.0] * 2
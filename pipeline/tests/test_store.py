@@ -0,0 +1,24 @@
+# Purpose: Test that the Parquet dataset rebuilt from the committed CSV outputs holds the rows of every country
+import pandas as pd
+
+from pipeline import store
+
+
+def test_rebuild_from_csv(tmp_path):
+    first = pd.DataFrame({'Country': 'Finland', 'Region': ['Espoo', 'Espoo', 'Oulu'],
+                          'Date': ['2023-01-09', '2023-01-10', '2023-01-09'], 'Measure': 'wastewater',
+                          'Value': [1.5, None, 2.0]})
+    second = pd.DataFrame({'Country': 'United_States', 'Region': ['01001'], 'Date': ['2023-01-09'],
+                           'Measure': 'inf', 'Value': [3.0]})
+    first.to_csv(tmp_path / 'Finland_cleaned.csv', index=False)
+    second.to_csv(tmp_path / 'United_States_cleaned.csv', index=False)
+    root = str(tmp_path / 'cleaned_parquet')
+    assert store.main([str(tmp_path / 'Finland_cleaned.csv'), str(tmp_path / 'United_States_cleaned.csv'),
+                       '--root', root]) == 0
+
+    df = store.read_cleaned(root).sort_values(['Country', 'Region', 'Date'], ignore_index=True)
+    assert df['Country'].tolist() == ['Finland', 'Finland', 'Finland', 'United_States']
+    # Regions that look like numbers are kept as they are written
+    assert df['Region'].astype(str).tolist() == ['Espoo', 'Espoo', 'Oulu', '01001']
+    assert df['Value'].isna().tolist() == [False, True, False, False]
+    assert store.read_cleaned(root, country='Finland', region='Oulu')['Value'].tolist() == [2.0]
@@ -0,0 +1,40 @@
+# Purpose: Test that imported Biobot snapshots go to the store of their file and are rebuilt exactly as of any date
+import os
+
+from pipeline import vintages
+
+COMMENT = '# All data presented on https://biobot.io/data is for personal and academic use only.\n'
+NATIONWIDE = 'date,display_name,eff_conc_sarscov2_weekly,eff_conc_sarscov2_weekly_rolling\n'
+COUNTY = 'census_region,county_fips,date,display_name,eff_conc_sarscov2_weekly\n'
+
+
+def snapshot(tmp_path, date, header, rows):
+    path = tmp_path / f'US_Biobot_data_{date}.csv'
+    path.write_text(COMMENT + header + ''.join(row + '\n' for row in rows), encoding='utf-8')
+    return str(path)
+
+
+def test_snapshots_go_to_the_store_of_their_file(tmp_path):
+    paths = [
+        snapshot(tmp_path, '2024-01-22', NATIONWIDE, ['2024-01-13,Nationwide,500.0,480.0']),
+        snapshot(tmp_path, '2024-02-05', COUNTY, ['Northeast,25025,2024-01-20,"Suffolk County, MA",11.5',
+                                                  'Northeast,25025,2024-01-27,"Suffolk County, MA",12.5']),
+        snapshot(tmp_path, '2024-01-15', NATIONWIDE, ['2024-01-06,Nationwide,520.0,470.0']),
+        snapshot(tmp_path, '2024-01-29', COUNTY, ['Northeast,25025,2024-01-20,"Suffolk County, MA",11.0']),
+    ]
+    assert [vintages.snapshot_file(path) for path in paths] == ['nationwide', 'county', 'nationwide', 'county']
+    root = str(tmp_path / 'stores')
+    vintages.import_snapshots(paths, root, remove=True)
+    assert not any(os.path.exists(path) for path in paths)
+
+    nationwide, county = os.path.join(root, 'nationwide'), os.path.join(root, 'county')
+    assert vintages.vintages(nationwide)['date'].tolist() == ['2024-01-15', '2024-01-22']
+    assert vintages.vintages(county)['date'].tolist() == ['2024-01-29', '2024-02-05']
+    # The county store starts with the first county file, whatever the nationwide files before it
+    assert vintages.vintages(county)['kind'].tolist() == ['full', 'delta']
+    first = 'Northeast,25025,2024-01-20,"Suffolk County, MA",11.0\n'
+    assert vintages.read_text('2024-02-01', county) == COMMENT + COUNTY + first
+    assert vintages.as_of('2024-01-20', nationwide)['eff_conc_sarscov2_weekly'].tolist() == [520.0]
+    # Rows are matched on their county and date, so a revised value is not a removed and an added row
+    changes = vintages.revisions(county)
+    assert changes[['change', 'date']].values.tolist() == [['revised', '2024-01-20'], ['added', '2024-01-27']]
@@ -0,0 +1,38 @@
+# Purpose: Record the wall time spent in each stage of a pipeline, for the summary of the pipeline runner
+import functools
+import time
+from contextlib import contextmanager
+
+# Seconds per stage in this process
+TIMINGS = {}
+_active = []
+
+
+@contextmanager
+def stage(name):
+    """Add the wall time of the block to TIMINGS[name].
+
+    A block inside another stage counts towards the outer stage only, so the stages never overlap
+    and the time outside all of them is what remains of the total.
+    """
+    if _active:
+        yield
+        return
+    _active.append(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _active.pop()
+        TIMINGS[name] = TIMINGS.get(name, 0.0) + time.perf_counter() - started
+
+
+def timed(name):
+    """Decorator version of `stage`."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,341 @@
+# Purpose: Keep the dated vintages of a CSV source as line deltas against the previous one, and rebuild any vintage as of a date
+#
+# Usage: python -m pipeline.vintages import [US_Biobot_data_*.csv ...] [--remove]
+#        python -m pipeline.vintages [--file county|nationwide] list
+#        python -m pipeline.vintages [--file county|nationwide] show DATE [-o FILE]
+#        python -m pipeline.vintages [--file county|nationwide] revisions [-o FILE]
+#
+# Every file of the Biobot snapshots (nationwide and county) has its own store under vintages/biobot, and
+# imported snapshots go to the store of the file they are, by their columns.
+# A store is a directory with an index.json and one gzipped file per stored vintage:
+# - 'full' vintages are the whole file (<date>.csv.gz): the first one, one after a change of the columns and one
+#   every MAX_CHAIN vintages, so that rebuilding a vintage never applies more than MAX_CHAIN deltas.
+# - 'delta' vintages are the rows inserted, replaced or deleted since their parent vintage (<date>.json.gz).
+# - 'same' vintages are byte-identical to an earlier vintage and refer to it without a file.
+# Every vintage is rebuilt and compared byte for byte with its source before it is added.
+import argparse
+import bisect
+import csv
+import difflib
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+from collections import OrderedDict
+
+import pandas as pd
+
+# Stores of the files of the Biobot snapshots, one directory per file
+BIOBOT_DIR = 'vintages/biobot'
+SNAPSHOT_FILES = ['nationwide', 'county']
+STORE_DIR = os.path.join(BIOBOT_DIR, 'county')
+
+# Snapshots written by the Biobot scripts before the store existed, dated by their file name. Both scripts used
+# the same name, so these are nationwide files up to 2024-01-23 and county files from 2024-01-29 on.
+SNAPSHOT_PATTERN = 'US_Biobot_data_*.csv'
+
+# Column that only the county file has
+COUNTY_COLUMN = 'county_fips'
+DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+# Most deltas between a vintage and the full vintage it is rebuilt from
+MAX_CHAIN = 32
+
+# Share of the lines of a vintage above which it is stored in full rather than as a delta
+MAX_DELTA_SHARE = 0.5
+
+# Columns identifying a row, of those a file has; the revisions of a row are reported under this key
+KEY_COLUMNS = ['county_fips', 'display_name', 'date']
+
+# Rebuilt vintages kept in memory, by sha256
+CACHE_SIZE = 4
+
+_cache = OrderedDict()
+
+
+def _load_index(root):
+    path = os.path.join(root, 'index.json')
+    if not os.path.exists(path):
+        return {'vintages': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write(path, body):
+    # Write a file through a temporary file, so that readers never see it half written
+    with open(path + '.tmp', 'wb') as f:
+        f.write(body)
+    os.replace(path + '.tmp', path)
+
+
+def _save_index(index, root):
+    index['vintages'].sort(key=lambda entry: entry['date'])
+    _write(os.path.join(root, 'index.json'), json.dumps(index, indent=1).encode('utf-8'))
+
+
+def _gzip(body):
+    # mtime 0, so that the same content always gives the same bytes
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def _split(text):
+    # Lines without their '\n', so that '\n'.join gives back the exact text
+    return text.split('\n')
+
+
+def _entries(index):
+    return {entry['date']: entry for entry in index['vintages']}
+
+
+def _header(lines):
+    # Index of the line with the column names, after the '#' comments
+    for i, line in enumerate(lines):
+        if not line.startswith('#'):
+            return i
+    return len(lines)
+
+
+def _lines(entry, entries, root):
+    # Lines of a vintage, rebuilt from the nearest full or cached vintage it derives from
+    chain = [entry]
+    while chain[-1]['sha256'] not in _cache and chain[-1]['kind'] != 'full':
+        chain.append(entries[chain[-1]['parent']])
+    base = chain.pop()
+    if base['sha256'] in _cache:
+        lines = _cache[base['sha256']]
+    else:
+        with gzip.open(os.path.join(root, base['file']), 'rt', encoding='utf-8', newline='') as f:
+            lines = _split(f.read())
+    for link in reversed(chain):
+        if link['kind'] == 'delta':
+            with gzip.open(os.path.join(root, link['file']), 'rt', encoding='utf-8') as f:
+                lines = _apply(lines, json.load(f)['ops'])
+    _cache[entry['sha256']] = lines
+    _cache.move_to_end(entry['sha256'])
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return lines
+
+
+def _diff(old, new):
+    # [[first, last, lines]]: old[first:last] is replaced by `lines`, positions in `old`
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    return [[i1, i2, new[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def _apply(old, ops):
+    new = []
+    position = 0
+    for first, last, lines in ops:
+        new += old[position:first]
+        new += lines
+        position = last
+    return new + old[position:]
+
+
+def _chain_length(entry, entries):
+    length = 0
+    while entry['kind'] != 'full':
+        length += entry['kind'] == 'delta'
+        entry = entries[entry['parent']]
+    return length
+
+
+def snapshot_date(path):
+    """Date (YYYY-MM-DD) in the file name of a snapshot."""
+    match = DATE_PATTERN.search(os.path.basename(path))
+    if match is None:
+        raise ValueError(f'No date in the file name of {path}')
+    return match.group(1)
+
+
+def snapshot_file(path):
+    """File of the Biobot snapshots ('nationwide' or 'county') that the file at `path` is, by its columns."""
+    with open(path, encoding='utf-8', newline='') as f:
+        lines = _split(f.read())
+    header = _header(lines)
+    columns = next(csv.reader([lines[header]])) if header < len(lines) else []
+    return 'county' if COUNTY_COLUMN in columns else 'nationwide'
+
+
+def add(path, date=None, root=STORE_DIR):
+    """Add the file at `path` as the vintage of `date` (by default the date in its file name).
+
+    Returns the kind of the stored vintage: 'full', 'delta' or 'same' (as an earlier vintage).
+    Adding the same file again for the same date changes nothing; adding a different one raises
+    ValueError, since later vintages may be stored as deltas against it.
+    """
+    date = date or snapshot_date(path)
+    with open(path, 'rb') as f:
+        body = f.read()
+    sha256 = hashlib.sha256(body).hexdigest()
+    os.makedirs(root, exist_ok=True)
+    index = _load_index(root)
+    entries = _entries(index)
+    if date in entries:
+        if entries[date]['sha256'] != sha256:
+            raise ValueError(f'The vintage of {date} in {root} has other content than {path}')
+        return entries[date]['kind']
+
+    lines = _split(body.decode('utf-8'))
+    entry = {'date': date, 'sha256': sha256, 'size': len(body), 'rows': sum(1 for line in lines[_header(lines) + 1:] if line)}
+    same = [other for other in index['vintages'] if other['sha256'] == sha256]
+    earlier = [other for other in index['vintages'] if other['date'] < date]
+    if same:
+        entry.update(kind='same', parent=same[0]['date'], file=None)
+    elif earlier:
+        parent = earlier[-1]
+        old = _lines(parent, entries, root)
+        ops = _diff(old, lines)
+        changed = sum(len(new) for _, _, new in ops)
+        same_columns = old[_header(old):_header(old) + 1] == lines[_header(lines):_header(lines) + 1]
+        if same_columns and changed <= MAX_DELTA_SHARE * len(lines) and _chain_length(parent, entries) < MAX_CHAIN:
+            entry.update(kind='delta', parent=parent['date'], file=f'{date}.json.gz')
+            _write(os.path.join(root, entry['file']), _gzip(json.dumps({'parent': parent['date'], 'ops': ops},
+                                                                       separators=(',', ':')).encode('utf-8')))
+    if 'kind' not in entry:
+        entry.update(kind='full', parent=earlier[-1]['date'] if earlier else None, file=f'{date}.csv.gz')
+        _write(os.path.join(root, entry['file']), _gzip(body))
+
+    entries[date] = entry
+    if '\n'.join(_lines(entry, entries, root)).encode('utf-8') != body:
+        raise ValueError(f'The vintage of {date} in {root} does not rebuild {path}')
+    index['vintages'].append(entry)
+    _save_index(index, root)
+    return entry['kind']
+
+
+def vintages(root=STORE_DIR):
+    """Index of the store: one row per vintage with its date, kind, parent, sha256, size and rows."""
+    return pd.DataFrame(_load_index(root)['vintages'], columns=['date', 'kind', 'parent', 'file', 'sha256', 'size', 'rows'])
+
+
+def vintage_date(as_of=None, root=STORE_DIR):
+    """Date of the newest vintage published on or before `as_of` (a date or YYYY-MM-DD; the newest if None)."""
+    dates = [entry['date'] for entry in _load_index(root)['vintages']]
+    if as_of is not None:
+        dates = dates[:bisect.bisect_right(dates, pd.Timestamp(as_of).strftime('%Y-%m-%d'))]
+    if not dates:
+        raise LookupError(f'No vintage in {root} as of {as_of}')
+    return dates[-1]
+
+
+def read_text(as_of=None, root=STORE_DIR):
+    """Exact text of the vintage as of `as_of` (see vintage_date)."""
+    date = vintage_date(as_of, root)
+    entries = _entries(_load_index(root))
+    return '\n'.join(_lines(entries[date], entries, root))
+
+
+def as_of(date=None, root=STORE_DIR, **kwargs):
+    """pd.read_csv of the vintage as of `date` (see vintage_date), after its '#' comment lines."""
+    text = read_text(date, root)
+    kwargs.setdefault('skiprows', _header(_split(text)))
+    return pd.read_csv(io.StringIO(text), **kwargs)
+
+
+def _rows(lines, header):
+    # {key: (line, fields)} of the data lines, keyed on the KEY_COLUMNS of `header`
+    columns = next(csv.reader([header]))
+    key = [columns.index(name) for name in KEY_COLUMNS if name in columns]
+    rows = {}
+    for line, fields in zip(lines, csv.reader(lines)):
+        if line:
+            rows[(tuple(columns),) + tuple(fields[i] for i in key)] = line
+    return rows
+
+
+def _changes(old, new):
+    # (removed, revised, added) data lines from `old` to `new`, matched on their key
+    old_header, new_header = _header(old), _header(new)
+    removed, added = [], []
+    for first, last, lines in _diff(old[old_header + 1:], new[new_header + 1:]):
+        removed += old[old_header + 1 + first:old_header + 1 + last]
+        added += lines
+    removed = _rows(removed, old[old_header]) if old_header < len(old) else {}
+    added = _rows(added, new[new_header]) if new_header < len(new) else {}
+    revised = [line for key, line in added.items() if key in removed]
+    return ([line for key, line in removed.items() if key not in added], revised,
+            [line for key, line in added.items() if key not in removed])
+
+
+def revisions(root=STORE_DIR):
+    """Rows added, revised or removed by every vintage since the one before it.
+
+    Returns the rows read with pd.read_csv (the new values of added and revised rows, the last
+    values of removed rows) with the 'vintage' date and the 'change' of every row. Rows are
+    matched on KEY_COLUMNS; a change of the columns removes all rows and adds them again.
+    """
+    index = _load_index(root)
+    entries = _entries(index)
+    frames = []
+    old = None
+    for entry in index['vintages']:
+        new = _lines(entry, entries, root)
+        if old is not None and entry['kind'] != 'same':
+            header = (old[_header(old)], new[_header(new)])
+            for change, lines, columns in zip(['removed', 'revised', 'added'], _changes(old, new), [0, 1, 1]):
+                if lines:
+                    df = pd.read_csv(io.StringIO('\n'.join([header[columns]] + lines)))
+                    frames.append(df.assign(vintage=entry['date'], change=change))
+        old = new
+    if not frames:
+        return pd.DataFrame(columns=['vintage', 'change'])
+    df = pd.concat(frames, ignore_index=True)
+    return df[['vintage', 'change'] + [col for col in df.columns if col not in ('vintage', 'change')]]
+
+
+def import_snapshots(paths, root=BIOBOT_DIR, remove=False):
+    """Add the snapshot files `paths` to the stores under `root`, deleting each once stored if `remove`.
+
+    Every file goes to the store of the file of the snapshots it is (see snapshot_file), in the
+    order of their dates, so that a store never holds vintages of another file.
+    """
+    files = sorted((snapshot_file(path), snapshot_date(path), path) for path in paths)
+    for name, _, path in files:
+        kind = add(path, root=os.path.join(root, name))
+        print(f'{path}: {name} {kind}', flush=True)
+        if remove:
+            os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Store dated snapshots of a CSV source as deltas and rebuild them.')
+    parser.add_argument('--root', default=BIOBOT_DIR, help='Directory of the stores, one per file')
+    parser.add_argument('--file', choices=SNAPSHOT_FILES, default='county',
+                        help='Store to list, show or compare (default: county)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('import', help='Add snapshot files to the stores of their files')
+    command.add_argument('paths', nargs='*', help=f'Snapshot files (default: {SNAPSHOT_PATTERN})')
+    command.add_argument('--remove', action='store_true', help='Delete every snapshot file once it is stored')
+    commands.add_parser('list', help='List the vintages of the store')
+    command = commands.add_parser('show', help='Write the vintage as of a date')
+    command.add_argument('date', nargs='?', help='Date (default: the newest vintage)')
+    command.add_argument('-o', '--output', help='File to write (default: standard output)')
+    command = commands.add_parser('revisions', help='Write the rows added, revised or removed by every vintage')
+    command.add_argument('-o', '--output', help='CSV file to write (default: standard output)')
+    args = parser.parse_args(argv)
+    store = os.path.join(args.root, args.file)
+
+    if args.command == 'import':
+        import_snapshots(args.paths or glob.glob(SNAPSHOT_PATTERN), args.root, args.remove)
+    elif args.command == 'list':
+        print(vintages(store).drop(columns='sha256').to_string(index=False))
+    elif args.command == 'show':
+        text = read_text(args.date, store)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+    else:
+        revisions(store).to_csv(args.output or sys.stdout, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
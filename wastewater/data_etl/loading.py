@@ -0,0 +1,93 @@
+"""
+Bulk loading of the long-format pipeline outputs into the Observation table.
+
+A country is synchronized as a whole: its rows are streamed into a temporary table with COPY,
+inserted or updated with a single INSERT ... ON CONFLICT that skips unchanged values, and rows
+that are no longer in the output are deleted. Rerunning the load with the same data changes
+nothing.
+"""
+import io
+import re
+
+import pandas as pd
+from django.db import connection, transaction
+
+from .models import Observation
+
+TABLE = Observation._meta.db_table
+
+
+def _prepare(df):
+    # Long-format frame with one row per (region, measure, date); the first row wins
+    df = df.dropna(subset=['Region', 'Measure', 'Date'])
+    df = df.assign(Region=df['Region'].astype(str), Measure=df['Measure'].astype(str),
+                   Date=pd.to_datetime(df['Date']).dt.date)
+    return df.drop_duplicates(subset=['Region', 'Measure', 'Date'], keep='first')[['Region', 'Measure', 'Date', 'Value']]
+
+
+def _partition_name(country):
+    return f"{TABLE}_{re.sub(r'[^a-z0-9]+', '_', country.lower()).strip('_')}"
+
+
+def load_country(country, df):
+    """Synchronize the rows of `country` with the long-format frame `df`.
+
+    Returns the number of inserted or updated rows and the number of deleted rows.
+    """
+    df = _prepare(df)
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            return _load_postgresql(country, df)
+        return _load_generic(country, df)
+
+
+def _load_postgresql(country, df):
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {quote(_partition_name(country))} "
+                       f"PARTITION OF {quote(TABLE)} FOR VALUES IN (%s)", [country])
+        # Dropped at the end, so that several countries can be loaded in one outer transaction
+        cursor.execute("CREATE TEMP TABLE observation_stage (region varchar(200), measure varchar(32), "
+                       "date date, value double precision)")
+
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d')
+        buffer.seek(0)
+        cursor.cursor.copy_expert("COPY observation_stage FROM STDIN WITH (FORMAT csv)", buffer)
+
+        cursor.execute(f"""
+            INSERT INTO {quote(TABLE)} AS o (country, region, measure, date, value)
+            SELECT %s, region, measure, date, value FROM observation_stage
+            ON CONFLICT (country, region, measure, date) DO UPDATE SET value = EXCLUDED.value
+            WHERE o.value IS DISTINCT FROM EXCLUDED.value
+        """, [country])
+        changed = cursor.rowcount
+
+        cursor.execute(f"""
+            DELETE FROM {quote(TABLE)} AS o
+            WHERE o.country = %s AND NOT EXISTS (
+                SELECT 1 FROM observation_stage s
+                WHERE s.region = o.region AND s.measure = o.measure AND s.date = o.date)
+        """, [country])
+        deleted = cursor.rowcount
+        cursor.execute("DROP TABLE observation_stage")
+    return changed, deleted
+
+
+def _load_generic(country, df):
+    # Same result through the ORM for databases without COPY (e.g. the SQLite development database)
+    existing = {(region, measure, date): (pk, value) for pk, region, measure, date, value in
+                Observation.objects.filter(country=country).values_list('pk', 'region', 'measure', 'date', 'value')}
+    new, changed = [], []
+    for region, measure, date, value in df.itertuples(index=False):
+        value = None if pd.isna(value) else float(value)
+        found = existing.pop((region, measure, date), None)
+        if found is None:
+            new.append(Observation(country=country, region=region, measure=measure, date=date, value=value))
+        elif found[1] != value:
+            changed.append(Observation(pk=found[0], value=value))
+    Observation.objects.bulk_create(new, batch_size=5000)
+    Observation.objects.bulk_update(changed, ['value'], batch_size=5000)
+    deleted = len(existing)
+    Observation.objects.filter(pk__in=[pk for pk, _ in existing.values()]).delete()
+    return len(new) + len(changed), deleted
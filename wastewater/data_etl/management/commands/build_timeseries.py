@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from data_etl.timeseries import build
+
+
+class Command(BaseCommand):
+    help = "Rebuild the memory-mapped time-series store from the pipelines' Parquet outputs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=settings.TIMESERIES_SOURCE, help='Partitioned Parquet dataset of the cleaned outputs')
+        parser.add_argument('--target', default=settings.TIMESERIES_DIR, help='Directory of the memory-mapped arrays')
+
+    def handle(self, *args, **options):
+        index = build(options['source'], options['target'])
+        self.stdout.write(self.style.SUCCESS(f"Built {len(index['series'])} series (version {index['version']})"))
@@ -0,0 +1,24 @@
+import pandas as pd
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from data_etl.loading import load_country
+
+
+class Command(BaseCommand):
+    help = "Load the pipelines' cleaned outputs into the Observation table, touching only changed rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=settings.TIMESERIES_SOURCE, help='Partitioned Parquet dataset of the cleaned outputs')
+        parser.add_argument('--country', action='append', help='Country to load (default: all countries in the source)')
+
+    def handle(self, *args, **options):
+        countries = options['country']
+        if not countries:
+            countries = sorted(pd.read_parquet(options['source'], columns=['Country'])['Country'].astype(str).unique())
+        for country in countries:
+            df = pd.read_parquet(options['source'], filters=[('Country', '==', country)])
+            if df.empty:
+                raise CommandError(f'No rows for {country} in {options["source"]}')
+            changed, deleted = load_country(country, df)
+            self.stdout.write(self.style.SUCCESS(f'{country}: {len(df)} rows, {changed} inserted or updated, {deleted} deleted'))
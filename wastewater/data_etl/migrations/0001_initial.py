@@ -0,0 +1,33 @@
+# Generated by Django 4.0.8 on 2026-10-18 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Observation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(max_length=64)),
+                ('region', models.CharField(max_length=200)),
+                ('measure', models.CharField(max_length=32)),
+                ('date', models.DateField()),
+                ('value', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='observation',
+            index=models.Index(fields=['region', 'measure', 'date'], name='observation_region_measure'),
+        ),
+        migrations.AddConstraint(
+            model_name='observation',
+            constraint=models.UniqueConstraint(fields=('country', 'region', 'measure', 'date'), name='observation_series_date'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# On PostgreSQL, recreate the (still empty) observation table partitioned by country. Partitions
+# are created per country by data_etl.loading. The primary key and unique constraint must contain
+# the partition key; indexes created on the parent are propagated to every partition.
+PARTITIONED_TABLE = """
+DROP TABLE data_etl_observation;
+CREATE TABLE data_etl_observation (
+    id bigserial NOT NULL,
+    country varchar(64) NOT NULL,
+    region varchar(200) NOT NULL,
+    measure varchar(32) NOT NULL,
+    date date NOT NULL,
+    value double precision NULL,
+    CONSTRAINT data_etl_observation_pkey PRIMARY KEY (country, id),
+    CONSTRAINT observation_series_date UNIQUE (country, region, measure, date)
+) PARTITION BY LIST (country);
+CREATE INDEX observation_region_measure ON data_etl_observation (region, measure, date);
+CREATE INDEX observation_date_brin ON data_etl_observation USING brin (date);
+"""
+
+PLAIN_TABLE = """
+DROP TABLE data_etl_observation;
+CREATE TABLE data_etl_observation (
+    id bigserial NOT NULL PRIMARY KEY,
+    country varchar(64) NOT NULL,
+    region varchar(200) NOT NULL,
+    measure varchar(32) NOT NULL,
+    date date NOT NULL,
+    value double precision NULL,
+    CONSTRAINT observation_series_date UNIQUE (country, region, measure, date)
+);
+CREATE INDEX observation_region_measure ON data_etl_observation (region, measure, date);
+"""
+
+
+def partition_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(PARTITIONED_TABLE)
+
+
+def unpartition_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(PLAIN_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_etl', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_table, unpartition_table),
+    ]
@@ -1,3 +1,25 @@
 from django.db import models
 
-# Create your models here.
+
+class Observation(models.Model):
+    """One value of the long-format pipeline outputs (Country, Region, Date, Measure, Value).
+
+    On PostgreSQL the table is partitioned by country (see migration 0002), with a BRIN index on
+    the date in addition to the indexes below.
+    """
+    country = models.CharField(max_length=64)
+    region = models.CharField(max_length=200)
+    measure = models.CharField(max_length=32)
+    date = models.DateField()
+    value = models.FloatField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['country', 'region', 'measure', 'date'], name='observation_series_date'),
+        ]
+        indexes = [
+            models.Index(fields=['region', 'measure', 'date'], name='observation_region_measure'),
+        ]
+
+    def __str__(self):
+        return f'{self.country} {self.region} {self.measure} {self.date}: {self.value}'
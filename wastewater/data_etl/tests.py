@@ -1,3 +1,149 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from . import timeseries
+from .loading import TABLE, _partition_name, load_country
+from .models import Observation
+
+
+class TimeSeriesApiTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = Path(tempfile.mkdtemp())
+        dates = pd.date_range('2023-01-01', periods=10)
+        rows = []
+        for region, scale in (('IslandHealth', 1.0), ('MetroVancouver', 10.0)):
+            for measure in ('inf', 'wastewater'):
+                rows.append(pd.DataFrame({'Country': 'Canada', 'Region': region, 'Date': dates,
+                                          'Measure': measure, 'Value': np.arange(10) * scale}))
+        df = pd.concat(rows, ignore_index=True)
+        df.loc[3, 'Value'] = np.nan
+        df.to_parquet(cls.tmp / 'source', partition_cols=['Country', 'Measure'], index=False)
+        cls.settings_override = override_settings(TIMESERIES_SOURCE=cls.tmp / 'source', TIMESERIES_DIR=cls.tmp / 'store')
+        cls.settings_override.enable()
+        timeseries.build(cls.tmp / 'source', cls.tmp / 'store')
+        timeseries._store = None
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        shutil.rmtree(cls.tmp)
+        super().tearDownClass()
+
+    def test_catalog(self):
+        response = self.client.get('/data_etl/api/catalog/')
+        self.assertEqual(response.status_code, 200)
+        regions = response.json()['countries']['Canada']
+        self.assertEqual(sorted(regions), ['IslandHealth', 'MetroVancouver'])
+        self.assertEqual(regions['IslandHealth']['inf'], {'start': '2023-01-01', 'end': '2023-01-10'})
+
+    def test_series_date_range(self):
+        response = self.client.get('/data_etl/api/series/', {'country': 'Canada', 'region': 'MetroVancouver',
+                                                             'measure': 'wastewater', 'start': '2023-01-03', 'end': '2023-01-05'})
+        series = response.json()['series']
+        self.assertEqual(series, [{'measure': 'wastewater', 'dates': ['2023-01-03', '2023-01-04', '2023-01-05'],
+                                   'values': [20.0, 30.0, 40.0]}])
+
+    def test_series_missing_values_and_downsampling(self):
+        response = self.client.get('/data_etl/api/series/', {'country': 'Canada', 'region': 'IslandHealth',
+                                                             'measure': 'inf', 'points': 5})
+        series = response.json()['series'][0]
+        self.assertEqual(series['dates'], ['2023-01-01', '2023-01-03', '2023-01-05', '2023-01-07', '2023-01-09'])
+        self.assertEqual(series['values'], [0.5, 2.0, 4.5, 6.5, 8.5])
+
+    def test_unknown_series(self):
+        response = self.client.get('/data_etl/api/series/', {'country': 'Canada', 'region': 'Nowhere'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_rebuild_of_unchanged_source_leaves_mapped_files_alone(self):
+        store = timeseries.get_store()
+        path = self.tmp / 'store' / f'values-{store.version}.npy'
+        modified = path.stat().st_mtime_ns
+        timeseries.build(self.tmp / 'source', self.tmp / 'store')
+        self.assertEqual(path.stat().st_mtime_ns, modified)
+        self.assertEqual(float(store.values[1]), 1.0)
+
+    def test_store_not_built(self):
+        with override_settings(TIMESERIES_DIR=self.tmp / 'missing'):
+            response = self.client.get('/data_etl/api/catalog/')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse((self.tmp / 'missing').exists())
+
+    def test_conditional_get(self):
+        response = self.client.get('/data_etl/api/catalog/')
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.client.get('/data_etl/api/catalog/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class LoadObservationsTests(TestCase):
+    # Runs against the configured database: the COPY loader on PostgreSQL, the ORM loader otherwise
+
+    def frame(self):
+        dates = pd.date_range('2023-01-01', periods=5)
+        return pd.DataFrame({'Country': 'Finland', 'Region': 'Helsinki', 'Date': dates, 'Measure': 'inf',
+                             'Value': [1.0, 2.0, np.nan, 4.0, 5.0]})
+
+    def test_load_is_idempotent(self):
+        self.assertEqual(load_country('Finland', self.frame()), (5, 0))
+        self.assertEqual(load_country('Finland', self.frame()), (0, 0))
+        self.assertEqual(Observation.objects.filter(value__isnull=True).count(), 1)
+
+    def test_reload_touches_changed_rows_only(self):
+        load_country('Finland', self.frame())
+        df = self.frame().iloc[1:]
+        df.loc[4, 'Value'] = 50.0
+        self.assertEqual(load_country('Finland', df), (1, 1))
+        self.assertEqual(sorted(Observation.objects.values_list('value', flat=True), key=str),
+                         sorted([2.0, None, 4.0, 50.0], key=str))
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'needs PostgreSQL (set DATABASE_URL to a local server)')
+class PostgresLoadTests(TestCase):
+    # The COPY and INSERT ... ON CONFLICT loader against the table partitioned by country of migration 0002
+
+    def frame(self, country, values):
+        dates = pd.date_range('2023-01-01', periods=len(values))
+        return pd.DataFrame({'Country': country, 'Region': 'Helsinki', 'Date': dates, 'Measure': 'inf', 'Value': values})
+
+    def rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT country, date, value FROM {connection.ops.quote_name(table)} ORDER BY country, date')
+            return [(country, str(date), value) for country, date, value in cursor.fetchall()]
+
+    def test_table_is_partitioned(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", [TABLE])
+            self.assertEqual(cursor.fetchone(), ('p',))
+
+    def test_insert_reload_update_delete(self):
+        # Insert: the partition of the country is created and holds the rows
+        self.assertEqual(load_country('Finland', self.frame('Finland', [1.0, 2.0, np.nan])), (3, 0))
+        self.assertEqual(self.rows(_partition_name('Finland')),
+                         [('Finland', '2023-01-01', 1.0), ('Finland', '2023-01-02', 2.0), ('Finland', '2023-01-03', None)])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass", [TABLE])
+            self.assertEqual([name for name, in cursor.fetchall()], [_partition_name('Finland')])
+
+        # Reloading the same rows changes nothing, also the missing value
+        self.assertEqual(load_country('Finland', self.frame('Finland', [1.0, 2.0, np.nan])), (0, 0))
+
+        # Update: only the changed value, including from and to a missing one
+        self.assertEqual(load_country('Finland', self.frame('Finland', [1.0, np.nan, 3.0])), (2, 0))
+        self.assertEqual(self.rows(TABLE), [('Finland', '2023-01-01', 1.0), ('Finland', '2023-01-02', None),
+                                            ('Finland', '2023-01-03', 3.0)])
+
+        # Delete: rows no longer in the output go, the rows of other countries stay
+        self.assertEqual(load_country('Canada', self.frame('Canada', [7.0])), (1, 0))
+        self.assertEqual(load_country('Finland', self.frame('Finland', [1.0])), (0, 2))
+        self.assertEqual(self.rows(TABLE), [('Canada', '2023-01-01', 7.0), ('Finland', '2023-01-01', 1.0)])
+        self.assertEqual(self.rows(_partition_name('Canada')), [('Canada', '2023-01-01', 7.0)])
@@ -0,0 +1,187 @@
+"""
+Read-only time-series store for the cleaned pipeline outputs.
+
+The long-format Parquet dataset written by the pipelines is converted once into two flat arrays
+(dates and values, sorted by country, region, measure and date) and a JSON index of the slice
+that belongs to every (country, region, measure). Workers memory-map the arrays, so they share
+the same pages instead of holding their own copies, and a lookup is a dictionary access plus a
+binary search on the dates of one series.
+
+The store is built by `manage.py build_timeseries` after every pipeline run (or at deployment),
+never while serving a request.
+"""
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+INDEX_FILE = 'index.json'
+
+
+class StoreNotBuilt(FileNotFoundError):
+    """The store has not been built yet (see `manage.py build_timeseries`)."""
+
+
+def _source_version(source_dir):
+    # Identifies a pipeline run by the newest modification time of the Parquet files
+    latest = 0.0
+    for dirpath, _, filenames in os.walk(source_dir):
+        for name in filenames:
+            if name.endswith('.parquet'):
+                latest = max(latest, os.path.getmtime(os.path.join(dirpath, name)))
+    return latest
+
+
+def _read_index(target_dir):
+    try:
+        with open(os.path.join(target_dir, INDEX_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save_array(path, array):
+    # Write next to the target and rename, so that a worker mapping an existing file never sees it truncated
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+
+def build(source_dir, target_dir):
+    """Convert the Parquet dataset at `source_dir` into memory-mappable arrays in `target_dir`.
+
+    Nothing is rewritten when the store already holds the current version of the dataset.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    source_mtime = _source_version(source_dir)
+    version = f'{int(source_mtime * 1000):x}'
+    index = _read_index(target_dir)
+    if (index is not None and index['version'] == version
+            and all(os.path.exists(os.path.join(target_dir, index[name])) for name in ('dates', 'values'))):
+        return index
+
+    df = pd.read_parquet(source_dir, columns=['Country', 'Region', 'Date', 'Measure', 'Value'])
+    df = df.astype({'Country': str, 'Region': str, 'Measure': str})
+    df = df.sort_values(['Country', 'Region', 'Measure', 'Date'], ignore_index=True)
+
+    dates = pd.to_datetime(df['Date']).to_numpy('datetime64[D]').astype(np.int32)
+    values = df['Value'].to_numpy(np.float64)
+    _save_array(os.path.join(target_dir, f'dates-{version}.npy'), dates)
+    _save_array(os.path.join(target_dir, f'values-{version}.npy'), values)
+
+    keys = df[['Country', 'Region', 'Measure']]
+    boundaries = np.flatnonzero((keys != keys.shift()).any(axis=1).to_numpy())
+    stops = np.append(boundaries[1:], len(df))
+    series = [[*keys.iloc[start].tolist(), int(start), int(stop)] for start, stop in zip(boundaries, stops)]
+
+    index = {
+        'version': version,
+        'last_modified': datetime.fromtimestamp(source_mtime, tz=timezone.utc).isoformat(),
+        'dates': f'dates-{version}.npy',
+        'values': f'values-{version}.npy',
+        'series': series,
+    }
+    # Replace the index atomically so that running workers never see a partial build
+    path = os.path.join(target_dir, INDEX_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+    # Arrays of earlier builds stay readable by workers that still map them
+    for name in os.listdir(target_dir):
+        if name.endswith('.npy') and version not in name:
+            os.remove(os.path.join(target_dir, name))
+    return index
+
+
+class TimeSeriesStore:
+    """Memory-mapped series indexed by (country, region, measure)."""
+
+    def __init__(self, target_dir):
+        with open(os.path.join(target_dir, INDEX_FILE), encoding='utf-8') as f:
+            index = json.load(f)
+        self.version = index['version']
+        self.last_modified = datetime.fromisoformat(index['last_modified'])
+        self.dates = np.load(os.path.join(target_dir, index['dates']), mmap_mode='r')
+        self.values = np.load(os.path.join(target_dir, index['values']), mmap_mode='r')
+        self.series = {(country, region, measure): (start, stop) for country, region, measure, start, stop in index['series']}
+
+    def catalog(self):
+        """Return the countries, their regions and the measures and date range of every region."""
+        catalog = {}
+        for (country, region, measure), (start, stop) in self.series.items():
+            regions = catalog.setdefault(country, {})
+            entry = regions.setdefault(region, {})
+            entry[measure] = {
+                'start': str(np.datetime64(int(self.dates[start]), 'D')),
+                'end': str(np.datetime64(int(self.dates[stop - 1]), 'D')),
+            }
+        return catalog
+
+    def measures(self, country, region):
+        return sorted(measure for (c, r, measure) in self.series if c == country and r == region)
+
+    def query(self, country, region, measure, start=None, end=None, points=None):
+        """Return the dates (as numpy day numbers) and values of one series, or None if it does not exist.
+
+        `start` and `end` are inclusive dates. With `points`, the series is averaged over
+        consecutive buckets so that at most `points` values are returned.
+        """
+        bounds = self.series.get((country, region, measure))
+        if bounds is None:
+            return None
+        lo, hi = bounds
+        dates = self.dates[lo:hi]
+        if start is not None:
+            lo += int(np.searchsorted(dates, _day_number(start), side='left'))
+        if end is not None:
+            hi = bounds[0] + int(np.searchsorted(dates, _day_number(end), side='right'))
+        dates = np.asarray(self.dates[lo:hi])
+        values = np.asarray(self.values[lo:hi])
+        if points and len(values) > points:
+            dates, values = _downsample(dates, values, points)
+        return dates, values
+
+
+def _day_number(day):
+    return np.datetime64(day, 'D').astype(np.int32)
+
+
+def _downsample(dates, values, points):
+    # Mean of the non-missing values of equally sized consecutive buckets, dated by their first day
+    size = -(-len(values) // points)
+    starts = np.arange(0, len(values), size)
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.0), starts)
+    counts = np.add.reduceat(present.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return dates[starts], means
+
+
+_store = None
+_store_mtime = None
+_lock = threading.Lock()
+
+
+def get_store():
+    """Return the store of this worker, loading it once and again only after a new build.
+
+    Raises StoreNotBuilt if `manage.py build_timeseries` has not been run.
+    """
+    global _store, _store_mtime
+    target_dir = settings.TIMESERIES_DIR
+    path = os.path.join(target_dir, INDEX_FILE)
+    with _lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            raise StoreNotBuilt(f'No time-series store in {target_dir}; run manage.py build_timeseries') from None
+        if _store is None or mtime != _store_mtime:
+            _store = TimeSeriesStore(target_dir)
+            _store_mtime = mtime
+        return _store
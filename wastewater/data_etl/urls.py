@@ -4,4 +4,6 @@ from . import views
 
 urlpatterns = [
     path("", views.index, name="index"),
+    path("api/catalog/", views.catalog, name="catalog"),
+    path("api/series/", views.series, name="series"),
 ]
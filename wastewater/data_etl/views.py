@@ -1,6 +1,81 @@
+import functools
+
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import condition, require_GET
+
+import numpy as np
+
+from .timeseries import StoreNotBuilt, get_store
+
+
+def _requires_store(view):
+    # 503 until the store is built by `manage.py build_timeseries`, which requests never do themselves
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except StoreNotBuilt:
+            return JsonResponse({'error': 'the time-series store is not built yet'}, status=503)
+    return wrapper
+
+
+# Responses only change when the pipeline outputs are rebuilt
+def _etag(request, *args, **kwargs):
+    return get_store().version
+
+
+def _last_modified(request, *args, **kwargs):
+    return get_store().last_modified
+
 
 # Create your views here.
 def index(request):
     return HttpResponse("This is the world wastewater analytics page.")
+
+
+@require_GET
+@_requires_store
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def catalog(request):
+    """Countries, regions, measures and date ranges available from the series endpoint."""
+    return JsonResponse({'countries': get_store().catalog()}, json_dumps_params={'ensure_ascii': False})
+
+
+@require_GET
+@_requires_store
+@condition(etag_func=_etag, last_modified_func=_last_modified)
+def series(request):
+    """Series of one region: ?country=&region=[&measure=inf,wastewater][&start=YYYY-MM-DD][&end=][&points=N]."""
+    store = get_store()
+    country = request.GET.get('country')
+    region = request.GET.get('region')
+    if not country or not region:
+        return JsonResponse({'error': 'country and region are required'}, status=400)
+
+    measures = request.GET.get('measure')
+    measures = measures.split(',') if measures else store.measures(country, region)
+    try:
+        start = np.datetime64(request.GET['start'], 'D') if request.GET.get('start') else None
+        end = np.datetime64(request.GET['end'], 'D') if request.GET.get('end') else None
+        points = int(request.GET['points']) if request.GET.get('points') else None
+    except ValueError:
+        return JsonResponse({'error': 'start and end must be dates and points an integer'}, status=400)
+    if points is not None and points < 1:
+        return JsonResponse({'error': 'points must be positive'}, status=400)
+
+    result = []
+    for measure in measures:
+        found = store.query(country, region, measure, start=start, end=end, points=points)
+        if found is None:
+            continue
+        dates, values = found
+        result.append({
+            'measure': measure,
+            'dates': np.datetime_as_string(dates.astype('datetime64[D]')).tolist(),
+            'values': [None if np.isnan(v) else v for v in values.tolist()],
+        })
+    if not result:
+        return JsonResponse({'error': 'no data for this country, region and measure'}, status=404)
+    return JsonResponse({'country': country, 'region': region, 'series': result},
+                        json_dumps_params={'ensure_ascii': False})